@@ -4,7 +4,7 @@ from typing import Set
 
 from circuits_benchmark.benchmark import vocabs
 from circuits_benchmark.benchmark.common_programs import shift_by
-from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
+from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase, DataLabellingMode
 from circuits_benchmark.benchmark.vocabs import TRACR_PAD, TRACR_BOS
 from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformerBatchInput
 from tracr.rasp import rasp
@@ -20,8 +20,10 @@ class Case1(TracrBenchmarkCase):
   def get_vocab(self) -> Set:
     return vocabs.get_ascii_letters_vocab(count=5)
 
-  def sample_data(self, count, min_seq_len, max_seq_len) -> (HookedTracrTransformerBatchInput, HookedTracrTransformerBatchInput):
-    """Samples random data for this benchmark case, making sure that we get balanced data."""
+  def sample_data(self, count, min_seq_len, max_seq_len, labelling_mode: DataLabellingMode = "rasp", num_workers: int = 0) -> (HookedTracrTransformerBatchInput, HookedTracrTransformerBatchInput):
+    """Samples random data for this benchmark case, making sure that we get balanced data.
+    Outputs are needed while sampling to keep the data balanced, so they are always computed with the RASP program in
+    this process."""
     input_data: HookedTracrTransformerBatchInput = []
     output_data: HookedTracrTransformerBatchInput = []
     sorted_vocab = sorted(self.get_vocab())
@@ -2,7 +2,7 @@ import random
 from typing import Set, List
 
 from circuits_benchmark.benchmark.common_programs import make_shuffle_dyck
-from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
+from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase, DataLabellingMode
 from circuits_benchmark.benchmark.vocabs import TRACR_BOS, TRACR_PAD
 from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformerBatchInput
 from tracr.rasp import rasp
@@ -64,12 +64,10 @@ class Case5(TracrBenchmarkCase):
 
     return input
 
-  def sample_data(self, count, min_seq_len, max_seq_len) -> (HookedTracrTransformerBatchInput, HookedTracrTransformerBatchInput):
+  def sample_data(self, count, min_seq_len, max_seq_len, labelling_mode: DataLabellingMode = "rasp", num_workers: int = 0) -> (HookedTracrTransformerBatchInput, HookedTracrTransformerBatchInput):
     """Samples random data for this benchmark case, making sure that we get half of the data with balanced parentheses/brakets and half with unbalanced ones."""
     input_data: HookedTracrTransformerBatchInput = []
-    output_data: HookedTracrTransformerBatchInput = []
 
-    # we use self.get_correct_output_for_input(sample) to get the correct output for each input
     balanced_data_count = count // 2
     unbalanced_data_count = count - balanced_data_count
 
@@ -81,15 +79,14 @@ class Case5(TracrBenchmarkCase):
       pad_len = max_seq_len - seq_len
       pad = [TRACR_PAD] * pad_len
 
-      output = self.get_correct_output_for_input(balanced_input)
-
       input_data.append([TRACR_BOS] + balanced_input + pad)
-      output_data.append([TRACR_BOS] + output + pad)
 
     sorted_vocab = ['(', ')', 'x', '{', '}']
     for _ in range(unbalanced_data_count):
-      input, output = self.gen_random_input_output(sorted_vocab, min_seq_len, max_seq_len)
-      input_data.append(input)
-      output_data.append(output)
+      input_data.append(self.gen_random_input(sorted_vocab, min_seq_len, max_seq_len))
+
+    # labelling does not depend on the balance of the inputs, so we can do it for the whole batch at once
+    output_data = self.get_correct_outputs_for_inputs(input_data, labelling_mode=labelling_mode,
+                                                      num_workers=num_workers)
 
-    return input_data, output_data
\ No newline at end of file
+    return input_data, output_data
@@ -0,0 +1,169 @@
+import ast
+import hashlib
+import importlib.metadata
+import inspect
+import json
+import os
+import warnings
+from functools import lru_cache
+from typing import FrozenSet, Optional
+
+import numpy as np
+import torch as t
+
+from circuits_benchmark.benchmark.tracr_encoded_dataset import TracrEncodedDataset
+from circuits_benchmark.utils.project_paths import get_default_output_dir
+
+default_dataset_cache_dir = os.path.join(get_default_output_dir(), "datasets_cache")
+
+
+def get_dataset_cache_key(case: "TracrBenchmarkCase", **params) -> str:
+  """Returns a key that identifies the dataset generated for a case with the given parameters.
+  The key changes whenever the parameters, the vocab, or the source code of the case or of the code that generates the
+  data change."""
+  hasher = hashlib.sha256()
+  hasher.update(json.dumps(params, sort_keys=True).encode())
+  hasher.update(repr(sorted(case.get_vocab())).encode())
+
+  # The case file, the files of its base classes (e.g., TracrBenchmarkCase), which contain the default data generation
+  # code, and the project modules they import.
+  update_hash_with_case_sources(hasher, case)
+
+  return f"{case.get_name()}/{hasher.hexdigest()}"
+
+
+def update_hash_with_case_sources(hasher: "hashlib._Hash", case: "TracrBenchmarkCase", *extra_source_files: str):
+  """Feeds to the hasher the source files of the case class and its base classes, of every module of this project that
+  they import (directly or not, e.g., common_programs and vocabs), plus any extra source files and their imports. The
+  installed Tracr version is also fed, since it compiles the programs."""
+  root_files = [inspect.getfile(cls) for cls in type(case).__mro__ if cls is not object] + list(extra_source_files)
+  source_files = set()
+  for root_file in root_files:
+    source_files |= get_project_source_files(os.path.abspath(root_file))
+
+  for source_file in sorted(source_files):
+    hasher.update(os.path.relpath(source_file, _project_root).encode())
+    with open(source_file, "rb") as f:
+      hasher.update(f.read())
+
+  hasher.update(get_tracr_version().encode())
+
+
+# directory that contains the circuits_benchmark package
+_project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@lru_cache(maxsize=None)
+def get_project_source_files(source_file: str) -> FrozenSet[str]:
+  """Returns the source file and every source file of this project that it imports, directly or transitively."""
+  source_files = set()
+  pending = [source_file]
+  while pending:
+    current_file = pending.pop()
+    if current_file in source_files:
+      continue
+    source_files.add(current_file)
+    pending.extend(get_imported_project_files(current_file))
+
+  return frozenset(source_files)
+
+
+def get_imported_project_files(source_file: str):
+  """Returns the source files of the modules of this project that a source file imports (including the packages of
+  the imported modules)."""
+  with open(source_file, "rb") as f:
+    tree = ast.parse(f.read(), filename=source_file)
+
+  module_names = []
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      module_names.extend(alias.name for alias in node.names)
+    elif isinstance(node, ast.ImportFrom):
+      module_name = node.module or ""
+      if node.level > 0:
+        # relative import, resolved from the package of the source file
+        package_dir = os.path.dirname(source_file)
+        for _ in range(node.level - 1):
+          package_dir = os.path.dirname(package_dir)
+        package_name = os.path.relpath(package_dir, _project_root).replace(os.sep, ".")
+        module_name = f"{package_name}.{module_name}" if module_name else package_name
+      module_names.append(module_name)
+      # the imported names may be submodules, e.g., `from circuits_benchmark.benchmark import vocabs`
+      module_names.extend(f"{module_name}.{alias.name}" for alias in node.names)
+
+  imported_files = []
+  for module_name in module_names:
+    if not module_name.startswith("circuits_benchmark"):
+      continue
+    # the module and all its parent packages are imported
+    parts = module_name.split(".")
+    for i in range(1, len(parts) + 1):
+      module_file = get_project_module_file(".".join(parts[:i]))
+      if module_file is not None:
+        imported_files.append(module_file)
+
+  return imported_files
+
+
+def get_project_module_file(module_name: str) -> Optional[str]:
+  """Returns the source file of a module of this project, or None if there is no such module."""
+  module_path = os.path.join(_project_root, *module_name.split("."))
+  for candidate in [f"{module_path}.py", os.path.join(module_path, "__init__.py")]:
+    if os.path.isfile(candidate):
+      return candidate
+  return None
+
+
+def get_tracr_version() -> str:
+  """Returns the installed Tracr version, including the commit it was installed from if it comes from git (which is
+  how this project installs it)."""
+  try:
+    distribution = importlib.metadata.distribution("tracr")
+  except importlib.metadata.PackageNotFoundError:
+    return "unknown"
+  return f"{distribution.version} {distribution.read_text('direct_url.json') or ''}"
+
+
+def get_cached_dataset_dir(key: str, cache_dir: Optional[str] = None) -> str:
+  """Returns the directory where the dataset with the given key is stored. The cache directory defaults to
+  default_dataset_cache_dir, read at call time so that it can be redirected (e.g., by the tests)."""
+  return os.path.join(cache_dir if cache_dir is not None else default_dataset_cache_dir, key)
+
+
+def load_cached_dataset(key: str,
+                        cache_dir: Optional[str] = None,
+                        device: t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu")
+                        ) -> TracrEncodedDataset | None:
+  """Loads a dataset from the cache, or returns None if it is not there.
+  The arrays are memory-mapped, so on CPU the returned tensors share memory with the files on disk."""
+  inputs_path = os.path.join(get_cached_dataset_dir(key, cache_dir), "inputs.npy")
+  targets_path = os.path.join(get_cached_dataset_dir(key, cache_dir), "targets.npy")
+  if not os.path.exists(inputs_path) or not os.path.exists(targets_path):
+    return None
+
+  # Copy-on-write mapping: we never pay for a copy unless someone modifies the tensors in place, in which case the
+  # changes stay in memory and are not written back to the cache.
+  inputs = np.load(inputs_path, mmap_mode="c")
+  targets = np.load(targets_path, mmap_mode="c")
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    inputs, targets = t.from_numpy(inputs), t.from_numpy(targets)
+
+  return TracrEncodedDataset(inputs.to(device), targets.to(device))
+
+
+def save_dataset_to_cache(key: str,
+                          dataset: TracrEncodedDataset,
+                          cache_dir: Optional[str] = None) -> None:
+  """Stores the inputs and targets of a dataset in the cache.
+  Files are written under a temporary name and then renamed, so that concurrent processes never read partial files."""
+  dirname = get_cached_dataset_dir(key, cache_dir)
+  os.makedirs(dirname, exist_ok=True)
+
+  for name, tensor in [("inputs", dataset.get_inputs()), ("targets", dataset.get_targets())]:
+    path = os.path.join(dirname, f"{name}.npy")
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+      np.save(f, tensor.detach().cpu().numpy())
+    os.replace(tmp_path, path)
+
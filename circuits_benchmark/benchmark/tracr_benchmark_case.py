@@ -1,7 +1,10 @@
 import itertools
+import os
 import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from typing import Optional, Sequence, Set, Callable
+from typing import Optional, Sequence, Set, Callable, Literal, TYPE_CHECKING
 
 import iit
 import numpy as np
@@ -11,16 +14,21 @@ from iit.model_pairs.ll_model import LLModel
 from iit.utils.correspondence import Correspondence
 from jaxtyping import Float
 from torch import Tensor
-from tracr.compiler import compiling
-from tracr.compiler.compiling import TracrOutput
 from tracr.rasp import rasp
 from tracr.rasp.rasp import RASPExpr
-from transformer_lens import HookedTransformer
+from tracr.transformer.encoder import CategoricalEncoder
+from transformer_lens import HookedTransformer, HookedTransformerConfig
 from transformer_lens.hook_points import HookedRootModule
 
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
+from circuits_benchmark.benchmark.dataset_cache import get_dataset_cache_key, load_cached_dataset, \
+  save_dataset_to_cache, get_cached_dataset_dir
+from circuits_benchmark.benchmark.tracr_build_cache import TracrBuildArtifact, get_tracr_build_cache_key, \
+  load_cached_tracr_build, save_tracr_build_to_cache
 from circuits_benchmark.benchmark.tracr_dataset import TracrDataset
 from circuits_benchmark.benchmark.tracr_encoded_dataset import TracrEncodedDataset
+from circuits_benchmark.benchmark.tracr_memmap_encoded_dataset import TracrMemmapEncodedDataset
+from circuits_benchmark.benchmark.tracr_streaming_dataset import TracrStreamingDataset
 from circuits_benchmark.benchmark.vocabs import TRACR_BOS, TRACR_PAD
 from circuits_benchmark.metrics.validation_metrics import l2_metric, kl_metric
 from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformer, \
@@ -32,12 +40,40 @@ from circuits_benchmark.utils.iit import make_ll_cfg_for_case
 from circuits_benchmark.utils.iit.correspondence import TracrCorrespondence
 from circuits_benchmark.utils.iit.tracr_model_pair import TracrModelPair
 
+if TYPE_CHECKING:
+  # Compiling imports JAX, so we only import it when we actually compile a case
+  from tracr.compiler.compiling import TracrOutput
+
+# How to produce the ground truth outputs of a case: "rasp" interprets the RASP program (or the case's own labeller)
+# once per sample, "hl_model" labels whole batches with a forward pass of the compiled HL model.
+DataLabellingMode = Literal["rasp", "hl_model"]
+
+# Case instances used by the worker processes of `get_correct_outputs_for_inputs`, so that each worker builds the RASP
+# program of a case only once.
+_worker_cases: dict[type, "TracrBenchmarkCase"] = {}
+
+
+def _label_inputs_in_worker(case_class: type, input_data: HookedTracrTransformerBatchInput):
+  if case_class not in _worker_cases:
+    _worker_cases[case_class] = case_class()
+  return _worker_cases[case_class].get_correct_outputs_for_inputs(input_data, labelling_mode="rasp")
+
+
+def _get_input_index_dtype(total: int) -> np.dtype:
+  """Returns the dtype for indices in an enumeration of `total` sequences: int64 when it can hold all of them, and
+  object (i.e., Python ints) otherwise, since large vocabs and sequence lengths can have more than 2 ** 63 sequences."""
+  return np.dtype(np.int64) if total <= np.iinfo(np.int64).max else np.dtype(object)
+
 
 class TracrBenchmarkCase(BenchmarkCase):
 
   def __init__(self):
     super().__init__()
-    self.tracr_output: TracrOutput | None = None
+    self.tracr_output: "TracrOutput | None" = None
+    self.tracr_build_artifact: TracrBuildArtifact | None = None
+    self.program: rasp.SOp | None = None
+    self.hl_models: dict[tuple[str, bool], HookedTracrTransformer] = {}
+    self.hl_model_cfg: HookedTransformerConfig | None = None
 
   def get_program(self) -> rasp.SOp:
     """Returns the RASP program to be compiled by Tracr."""
@@ -86,8 +122,7 @@ class TracrBenchmarkCase(BenchmarkCase):
                        same_size: bool = False,
                        *args, **kwargs) -> dict:
     """Returns the configuration for the LL model for this benchmark case."""
-    hl_model = self.get_hl_model()
-    cfg_dict = make_ll_cfg_for_case(hl_model, self.get_name(), same_size=same_size)
+    cfg_dict = make_ll_cfg_for_case(self.get_hl_model_cfg(), self.get_name(), same_size=same_size)
 
     if overwrite_cfg_dict is not None:
       cfg_dict.update(overwrite_cfg_dict)
@@ -114,24 +149,55 @@ class TracrBenchmarkCase(BenchmarkCase):
   def get_hl_model(
       self,
       device: str | t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu"),
+      cached: bool = True,
+      compact: bool = False,
       *args, **kwargs
   ) -> HookedTracrTransformer:
     """Returns the transformer_lens reference model for this benchmark case.
-    In IIT terminology, this is the HL model."""
-    tracr_output = self.get_tracr_output()
-    return HookedTracrTransformer.from_tracr_model(tracr_output.model, device=device, *args, **kwargs)
+    In IIT terminology, this is the HL model.
+    The model is built once per device and shared between callers, so its parameters are read-only. Callers that
+    modify the model (e.g., by wrapping its modules) should pass cached=False to get a new instance.
+    If compact is True, the model has a narrower residual stream and produces the same outputs up to floating-point
+    error (see HookedTracrTransformer.compact). Data labelling and encoding always use the full model."""
+    if not cached or args or kwargs:
+      hl_model = HookedTracrTransformer.from_tracr_build_artifact(self.get_tracr_build_artifact(), device=device,
+                                                                  *args, **kwargs)
+      return hl_model.compact() if compact else hl_model
+
+    model_key = (str(t.device(device)), compact)
+    if model_key not in self.hl_models:
+      if compact:
+        hl_model = self.get_hl_model(device=device).compact()
+      else:
+        hl_model = HookedTracrTransformer.from_tracr_build_artifact(self.get_tracr_build_artifact(), device=device)
+      hl_model.requires_grad_(False)
+      self.hl_models[model_key] = hl_model
+
+    return self.hl_models[model_key]
+
+  def get_hl_model_cfg(self) -> HookedTransformerConfig:
+    """Returns the config of the HL model, without building the model. The config is shared, so it should not be
+    modified."""
+    if self.hl_model_cfg is None:
+      self.hl_model_cfg = HookedTransformerConfig.from_dict(self.get_tracr_build_artifact().cfg_dict)
+      self.hl_model_cfg.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu")
+    return self.hl_model_cfg
+
+  def get_d_vocab_out(self) -> int:
+    """Returns the output size of the HL model, without building the model."""
+    return self.get_hl_model_cfg().d_vocab_out
 
   def get_correspondence(self, same_size: bool = False, *args, **kwargs) -> Correspondence:
     """Returns the correspondence between the reference and the benchmark model."""
-    tracr_output = self.get_tracr_output()
+    tracr_build = self.get_tracr_build_artifact()
     if same_size:
-      return TracrCorrespondence.make_identity_corr(tracr_output=tracr_output)
+      return TracrCorrespondence.make_identity_corr(tracr_output=tracr_build)
     else:
-      return TracrCorrespondence.from_output(self, tracr_output)
+      return TracrCorrespondence.from_output(self, tracr_build)
 
   def is_categorical(self) -> bool:
-    """Returns whether the benchmark case is categorical."""
-    return self.get_hl_model().is_categorical()
+    """Returns whether the benchmark case is categorical, without building the HL model."""
+    return isinstance(self.get_tracr_build_artifact().output_encoder, CategoricalEncoder)
 
   def get_clean_data(self,
                      min_samples: Optional[int] = 10,
@@ -139,10 +205,49 @@ class TracrBenchmarkCase(BenchmarkCase):
                      seed: Optional[int] = 42,
                      unique_data: Optional[bool] = False,
                      variable_length_seqs: Optional[bool] = False,
-                     encoded_dataset: bool = True) -> TracrDataset | TracrEncodedDataset:
+                     encoded_dataset: bool = True,
+                     labelling_mode: DataLabellingMode = "rasp",
+                     use_cache: bool = True,
+                     memmap_dataset: bool = False,
+                     num_workers: int = 0) -> TracrDataset | TracrEncodedDataset:
     """Returns clean data for the benchmark case.
     If the number of unique datapoints is between min_samples and max_samples, returns all possible unique datapoints.
-    Otherwise, returns a random sample of max_samples datapoints."""
+    Otherwise, returns a random sample of max_samples datapoints.
+    The labelling_mode only affects how the outputs are computed, the inputs are the same for a given seed.
+    If use_cache is True, encoded datasets generated with a fixed seed are stored on disk and loaded from there on
+    subsequent calls with the same parameters.
+    If memmap_dataset is True, the encoded dataset is backed by memory-mapped files with the targets stored as class
+    indices (see TracrMemmapEncodedDataset), which allows datasets larger than the available memory.
+    If num_workers > 0, the RASP labelling is spread over that many processes. The data is the same as with
+    num_workers=0.
+    If seed is not None, the global random state is reseeded from it once the data is ready, so that the random
+    draws of the caller do not depend on whether the dataset was loaded from the cache."""
+    dataset = self._get_clean_data(min_samples=min_samples, max_samples=max_samples, seed=seed,
+                                   unique_data=unique_data, variable_length_seqs=variable_length_seqs,
+                                   encoded_dataset=encoded_dataset, labelling_mode=labelling_mode,
+                                   use_cache=use_cache, memmap_dataset=memmap_dataset, num_workers=num_workers)
+
+    if seed is not None:
+      # A cache hit skips the draws that generating the data performs, so we leave the same state in both cases.
+      data_seed = int(np.random.SeedSequence(seed).generate_state(1)[0])
+      t.random.manual_seed(data_seed)
+      np.random.seed(data_seed)
+      random.seed(data_seed)
+
+    return dataset
+
+  def _get_clean_data(self,
+                      min_samples: Optional[int],
+                      max_samples: Optional[int],
+                      seed: Optional[int],
+                      unique_data: bool,
+                      variable_length_seqs: bool,
+                      encoded_dataset: bool,
+                      labelling_mode: DataLabellingMode,
+                      use_cache: bool,
+                      memmap_dataset: bool,
+                      num_workers: int) -> TracrDataset | TracrEncodedDataset:
+    """Loads or generates the clean data returned by get_clean_data."""
     max_seq_len = self.get_max_seq_len()
 
     if variable_length_seqs:
@@ -159,37 +264,60 @@ class TracrBenchmarkCase(BenchmarkCase):
       np.random.seed(seed)
       random.seed(seed)
 
+    cache_key = None
+    if use_cache and encoded_dataset and seed is not None:
+      # The encoded targets are always produced by the HL model, so the labelling mode is not part of the key
+      cache_key = get_dataset_cache_key(self,
+                                        min_samples=min_samples,
+                                        max_samples=max_samples,
+                                        seed=seed,
+                                        unique_data=unique_data,
+                                        variable_length_seqs=variable_length_seqs,
+                                        encoded_dataset=encoded_dataset)
+      if memmap_dataset:
+        memmap_dir = os.path.join(get_cached_dataset_dir(cache_key), "memmap")
+        if TracrMemmapEncodedDataset.exists(memmap_dir):
+          return TracrMemmapEncodedDataset(memmap_dir)
+      else:
+        cached_dataset = load_cached_dataset(cache_key)
+        if cached_dataset is not None:
+          return cached_dataset
+
     input_data = None
     output_data = None
+    data_kwargs = {"labelling_mode": labelling_mode, "num_workers": num_workers}
     if min_samples is not None and max_samples is not None and min_samples < self.get_total_data_len() < max_samples:
       # the unique data is between min_samples and max_samples, produce all possible sequences for this vocab
-      input_data, output_data = self.gen_all_data(min_seq_len, max_seq_len)
+      input_data, output_data = self.gen_all_data(min_seq_len, max_seq_len, **data_kwargs)
     elif min_samples is None and max_samples is None:
       # we didn't get max_samples nor min_samples, produce all possible sequences for this vocab
-      input_data, output_data = self.gen_all_data(min_seq_len, max_seq_len)
+      input_data, output_data = self.gen_all_data(min_seq_len, max_seq_len, **data_kwargs)
     elif min_samples is not None and max_samples is None:
       if self.get_total_data_len() < min_samples:
         # we have fewer data than the min_samples, produce at least min_samples, with repeating sequences
-        input_data, output_data = self.sample_data(min_samples, min_seq_len, max_seq_len)
+        input_data, output_data = self.sample_data(min_samples, min_seq_len, max_seq_len, **data_kwargs)
       else:
-        input_data, output_data = self.gen_all_data(min_seq_len, max_seq_len)
+        input_data, output_data = self.gen_all_data(min_seq_len, max_seq_len, **data_kwargs)
+    elif max_samples is not None and unique_data and type(self).sample_data is TracrBenchmarkCase.sample_data:
+      # produce at most max_samples, drawing distinct sequences directly instead of deduplicating afterwards
+      input_data, output_data = self.sample_unique_data(max_samples, min_seq_len, max_seq_len, **data_kwargs)
     elif max_samples is not None:
       # produce at most max_samples
-      input_data, output_data = self.sample_data(max_samples, min_seq_len, max_seq_len)
+      input_data, output_data = self.sample_data(max_samples, min_seq_len, max_seq_len, **data_kwargs)
 
     assert len(set([tuple(o) for o in output_data])) > 1, "All outputs are the same for this case"
 
-    unique_inputs = set()
     if unique_data:
-      # remove duplicates from input_data
+      # remove duplicates from input_data (only needed for data sampled with replacement, e.g. by cases that
+      # override sample_data)
+      unique_inputs = set()
       unique_input_data = []
       unique_output_data = []
-      for i in range(len(input_data)):
-        input = input_data[i]
-        if str(input) not in unique_inputs:
+      for input, output in zip(input_data, output_data):
+        if tuple(input) not in unique_inputs:
           unique_inputs.add(tuple(input))
           unique_input_data.append(input)
-          unique_output_data.append(output_data[i])
+          unique_output_data.append(output)
       input_data = unique_input_data
       output_data = unique_output_data
 
@@ -199,13 +327,43 @@ class TracrBenchmarkCase(BenchmarkCase):
     input_data: HookedTracrTransformerBatchInput = [input_data[i] for i in indices]
     output_data = [output_data[i] for i in indices]
 
+    # targets are encoded with the full HL model, which is the reference the compact one is checked against
     tracr_dataset = TracrDataset(input_data, output_data, self.get_hl_model())
 
-    if encoded_dataset:
-      return tracr_dataset.get_encoded_dataset()
+    if encoded_dataset and memmap_dataset:
+      if cache_key is not None:
+        return tracr_dataset.get_encoded_dataset(memmap_dir=os.path.join(get_cached_dataset_dir(cache_key), "memmap"))
+
+      memmap_dataset = tracr_dataset.get_encoded_dataset(
+        memmap_dir=tempfile.mkdtemp(prefix=f"case_{self.get_name()}_dataset_"))
+      memmap_dataset.remove_files_when_unused()
+      return memmap_dataset
+    elif encoded_dataset:
+      encoded_tracr_dataset = tracr_dataset.get_encoded_dataset()
+      if cache_key is not None:
+        save_dataset_to_cache(cache_key, encoded_tracr_dataset)
+      return encoded_tracr_dataset
     else:
       return tracr_dataset
 
+  def get_streaming_clean_data(self,
+                               seed: int = 42,
+                               samples_per_epoch: Optional[int] = None,
+                               chunk_size: int = 1024,
+                               variable_length_seqs: Optional[bool] = False,
+                               labelling_mode: DataLabellingMode = "hl_model",
+                               device: str | t.device = t.device("cpu")) -> TracrStreamingDataset:
+    """Returns an iterable dataset that samples, labels and encodes clean data lazily, chunk_size samples at a time.
+    Unlike get_clean_data, memory usage does not depend on the number of samples, and samples_per_epoch=None produces
+    an unbounded stream."""
+    return TracrStreamingDataset(self,
+                                 seed=seed,
+                                 samples_per_epoch=samples_per_epoch,
+                                 chunk_size=chunk_size,
+                                 variable_length_seqs=variable_length_seqs,
+                                 labelling_mode=labelling_mode,
+                                 device=device)
+
   def get_total_data_len(self):
     """Returns the total number of possible sequences for the vocab and sequence lengths."""
     vals = sorted(list(self.get_vocab()))
@@ -222,26 +380,65 @@ class TracrBenchmarkCase(BenchmarkCase):
                          min_samples: Optional[int] = 10,
                          max_samples: Optional[int] = 10,
                          seed: Optional[int] = 43,
-                         unique_data: Optional[bool] = False) -> TracrDataset | TracrEncodedDataset:
+                         unique_data: Optional[bool] = False,
+                         labelling_mode: DataLabellingMode = "rasp",
+                         use_cache: bool = True,
+                         memmap_dataset: bool = False,
+                         num_workers: int = 0) -> TracrDataset | TracrEncodedDataset:
     """Returns the corrupted data for the benchmark case.
     Default implementation: re-generate clean data with a different seed."""
-    return self.get_clean_data(min_samples=min_samples, max_samples=max_samples, seed=seed, unique_data=unique_data)
+    return self.get_clean_data(min_samples=min_samples, max_samples=max_samples, seed=seed, unique_data=unique_data,
+                               labelling_mode=labelling_mode, use_cache=use_cache, memmap_dataset=memmap_dataset,
+                               num_workers=num_workers)
 
-  def sample_data(self, n_samples: int, min_seq_len: int, max_seq_len: int):
+  def sample_data(self, n_samples: int, min_seq_len: int, max_seq_len: int,
+                  labelling_mode: DataLabellingMode = "rasp",
+                  num_workers: int = 0):
     """Samples random data for the benchmark case."""
+    input_data = self.sample_inputs(n_samples, min_seq_len, max_seq_len)
+    output_data = self.get_correct_outputs_for_inputs(input_data, labelling_mode=labelling_mode,
+                                                      num_workers=num_workers)
+
+    return input_data, output_data
+
+  def sample_inputs(self, n_samples: int, min_seq_len: int, max_seq_len: int) -> HookedTracrTransformerBatchInput:
+    """Samples the random inputs of the default sample_data, without labelling them."""
     vals = sorted(list(self.get_vocab()))
+    return [self.gen_random_input(vals, min_seq_len, max_seq_len) for _ in range(n_samples)]
 
-    input_data: HookedTracrTransformerBatchInput = []
-    output_data: HookedTracrTransformerBatchInput = []
+  def sample_unique_data(self, n_samples: int, min_seq_len: int, max_seq_len: int,
+                         labelling_mode: DataLabellingMode = "rasp",
+                         num_workers: int = 0):
+    """Samples distinct random data for the benchmark case, uniformly over all sequences with lengths between
+    min_seq_len and max_seq_len. Returns every sequence if there are fewer than n_samples of them."""
+    total = self.get_total_input_ids(min_seq_len, max_seq_len)
+    indices = self.sample_unique_indices(total, min(n_samples, total))
 
-    for _ in range(n_samples):
-      input, output = self.gen_random_input_output(vals, min_seq_len, max_seq_len)
-      input_data.append(input)
-      output_data.append(output)
+    input_data: HookedTracrTransformerBatchInput = \
+      self.get_input_token_table()[self.decode_input_ids(indices, min_seq_len, max_seq_len)].tolist()
+    output_data = self.get_correct_outputs_for_inputs(input_data, labelling_mode=labelling_mode,
+                                                      num_workers=num_workers)
 
     return input_data, output_data
 
-  def gen_random_input_output(self, vals, min_seq_len, max_seq_len) -> (Sequence, Sequence):
+  @staticmethod
+  def sample_unique_indices(total: int, n_samples: int, dense_threshold: int = 2 ** 24) -> np.ndarray:
+    """Returns n_samples distinct indices in [0, total), in increasing order.
+    Small spaces are sampled with a permutation, and larger ones with Floyd's algorithm, which only needs O(n_samples)
+    memory. The indices are int64, or Python ints in an object array if total does not fit in int64."""
+    dtype = _get_input_index_dtype(total)
+    if total <= dense_threshold:
+      indices = np.random.choice(total, size=n_samples, replace=False)
+    else:
+      selected = set()
+      for j in range(total - n_samples, total):
+        idx = random.randint(0, j)
+        selected.add(j if idx in selected else idx)
+      indices = np.array(list(selected), dtype=dtype)
+
+    return np.sort(indices.astype(dtype))
+
+  def gen_random_input(self, vals, min_seq_len, max_seq_len) -> Sequence:
     seq_len = random.randint(min_seq_len, max_seq_len)
 
     # figure out padding
@@ -249,55 +446,156 @@ class TracrBenchmarkCase(BenchmarkCase):
     pad = [TRACR_PAD] * pad_len
 
     sample = np.random.choice(vals, size=seq_len - 1).tolist()  # sample with replacement
-    output = self.get_correct_output_for_input(sample)
 
-    input = [TRACR_BOS] + sample + pad
-    output = [TRACR_BOS] + output + pad
+    return [TRACR_BOS] + sample + pad
+
+  def gen_random_input_output(self, vals, min_seq_len, max_seq_len) -> (Sequence, Sequence):
+    input = self.gen_random_input(vals, min_seq_len, max_seq_len)
+    output = self.get_correct_outputs_for_inputs([input])[0]
 
     return input, output
 
-  def gen_all_data(self, min_seq_len, max_seq_len) -> (
+  def gen_all_data(self, min_seq_len, max_seq_len, labelling_mode: DataLabellingMode = "rasp", num_workers: int = 0) -> (
   HookedTracrTransformerBatchInput, HookedTracrTransformerBatchInput):
     """Generates all possible sequences for the vocab on this case."""
-    vals = sorted(list(self.get_vocab()))
+    token_table = self.get_input_token_table()
+    input_ids = self.gen_all_input_ids(min_seq_len, max_seq_len)
 
-    input_data: HookedTracrTransformerBatchInput = []
-    output_data: HookedTracrTransformerBatchInput = []
+    # Python objects are only built once for the whole matrix, since the RASP program needs them for labelling.
+    input_data: HookedTracrTransformerBatchInput = token_table[input_ids].tolist()
+    output_data = self.get_correct_outputs_for_inputs(input_data, labelling_mode=labelling_mode,
+                                                      num_workers=num_workers)
 
-    for seq_len in range(min_seq_len, max_seq_len + 1):
-      pad_len = max_seq_len - seq_len
-      pad = [TRACR_PAD] * pad_len
+    return input_data, output_data
 
-      count = len(vals) ** (seq_len - 1)
-      for index in range(count):
-        # we want to produce all possible sequences for these lengths, so we convert the index to base len(vals) and
-        # then convert each digit to the corresponding value in vals
-        sample = []
-        base = len(vals)
-        num = index
-        while num:
-          sample.append(vals[num % base])
-          num //= base
+  def get_input_token_table(self) -> np.ndarray:
+    """Returns an object array with the sorted vocab followed by BOS and PAD, so that token ids produced by
+    `gen_all_input_ids` can be mapped back to tracr inputs with a single gather."""
+    vals = sorted(list(self.get_vocab()))
+    token_table = np.empty(len(vals) + 2, dtype=object)
+    token_table[:] = vals + [TRACR_BOS, TRACR_PAD]
+    return token_table
+
+  def gen_all_input_ids(self, min_seq_len: int, max_seq_len: int) -> np.ndarray:
+    """Returns a (n_sequences, max_seq_len) matrix with the ids in `get_input_token_table` of all possible
+    sequences for the vocab on this case, including BOS and PAD.
+    Sequences are enumerated by length, and for each length in lexicographic order of the sorted vocab."""
+    total = self.get_total_input_ids(min_seq_len, max_seq_len)
+    return self.decode_input_ids(np.arange(total, dtype=np.int64), min_seq_len, max_seq_len)
+
+  def get_total_input_ids(self, min_seq_len: int, max_seq_len: int) -> int:
+    """Returns the number of sequences enumerated by `gen_all_input_ids`."""
+    base = len(self.get_vocab())
+    return sum(base ** (seq_len - 1) for seq_len in range(min_seq_len, max_seq_len + 1))
+
+  def decode_input_ids(self, indices: np.ndarray, min_seq_len: int, max_seq_len: int) -> np.ndarray:
+    """Maps indices in the enumeration of `gen_all_input_ids` to the corresponding rows of its output, without
+    materializing the whole enumeration.
+    The arithmetic is done with Python ints if the enumeration has more sequences than int64 can hold."""
+    base = len(self.get_vocab())
+    bos_id, pad_id = base, base + 1
+
+    # first index of each sequence length in the enumeration
+    counts = [base ** (seq_len - 1) for seq_len in range(min_seq_len, max_seq_len + 1)]
+    dtype = _get_input_index_dtype(sum(counts))
+    offsets = np.cumsum(np.array([0] + counts, dtype=dtype))
+    indices = np.asarray(indices).astype(dtype)
+    seq_lens = min_seq_len + np.searchsorted(offsets, indices, side="right") - 1
+
+    input_ids = np.full((len(indices), max_seq_len), pad_id, dtype=np.int64)
+    input_ids[:, 0] = bos_id
+
+    # we convert each index within its length to base len(vals). The last position of each sequence holds the least
+    # significant digit.
+    num = indices - offsets[seq_lens - min_seq_len]
+    for pos in range(max_seq_len - 1, 0, -1):
+      mask = pos < seq_lens
+      input_ids[mask, pos] = num[mask] % base
+      num[mask] //= base
+
+    return input_ids
 
-        if len(sample) < seq_len - 1:
-          # extend with the first value in vocab to fill the sequence
-          sample.extend([vals[0]] * (seq_len - 1 - len(sample)))
+  def get_correct_output_for_input(self, input: Sequence) -> Sequence:
+    """Returns the correct output for the given input.
+    By default, we run the program and use its output as ground truth.
+    """
+    if self.program is None:
+      # Keep a separate instance of the program for evaluation, so that we don't rebuild the RASP graph per sample.
+      self.program = self.get_program()
+    return self.program(input)
+
+  def get_correct_outputs_for_inputs(self,
+                                     input_data: HookedTracrTransformerBatchInput,
+                                     labelling_mode: DataLabellingMode = "rasp",
+                                     batch_size: int = 4096,
+                                     spot_check_size: int = 100,
+                                     num_workers: int = 0) -> HookedTracrTransformerBatchInput:
+    """Returns the correct outputs for a batch of inputs that include BOS and PAD tokens.
+    The outputs also include BOS and PAD tokens, in the same positions as in the inputs.
+
+    With labelling_mode="hl_model", the outputs are produced by the compiled HL model, batch_size inputs at a time,
+    and a random subset of spot_check_size inputs is checked against `get_correct_output_for_input` to guard against
+    mismatches between the RASP program and the compiled model.
+
+    With labelling_mode="rasp" and num_workers > 0, the inputs are split in contiguous shards that are labelled by a
+    pool of num_workers processes, and the outputs are concatenated in the original order. Since labelling does not
+    use any randomness, the result is the same as labelling in this process.
+    """
+    if labelling_mode == "rasp" and num_workers > 0 and len(input_data) > 1:
+      shard_size = max(1, -(-len(input_data) // (num_workers * 4)))
+      shards = [list(input_data[start:start + shard_size]) for start in range(0, len(input_data), shard_size)]
+      with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        labelled_shards = executor.map(_label_inputs_in_worker, [type(self)] * len(shards), shards)
+        return [output for shard in labelled_shards for output in shard]
 
-        # reverse the list to produce the sequence in the correct order
-        sample = sample[::-1]
+    seq_lens = [len(input) - list(input).count(TRACR_PAD) for input in input_data]
 
-        output = self.get_correct_output_for_input(sample)
+    if labelling_mode == "rasp":
+      return [[TRACR_BOS] + self.get_correct_output_for_input(input[1:seq_len]) + [TRACR_PAD] * (len(input) - seq_len)
+              for input, seq_len in zip(input_data, seq_lens)]
 
-        input_data.append([TRACR_BOS] + sample + pad)
-        output_data.append([TRACR_BOS] + output + pad)
+    if labelling_mode != "hl_model":
+      raise ValueError(f"Unknown labelling mode: {labelling_mode}")
 
-    return input_data, output_data
+    hl_model = self.get_hl_model()
+    output_data: HookedTracrTransformerBatchInput = []
+    with t.no_grad():
+      for start in range(0, len(input_data), batch_size):
+        output_data.extend(hl_model(list(input_data[start:start + batch_size]), return_type="decoded"))
+
+    # The HL model produces an output for every position, so we need to restore the padding.
+    for output, seq_len in zip(output_data, seq_lens):
+      output[seq_len:] = [TRACR_PAD] * (len(output) - seq_len)
+
+    # We use a separate generator so that spot-checking does not change the global random state.
+    rng = np.random.default_rng(0)
+    spot_check_indices = rng.choice(len(input_data), size=min(spot_check_size, len(input_data)), replace=False)
+    for idx in spot_check_indices.tolist():
+      input, seq_len = input_data[idx], seq_lens[idx]
+      expected_output = self.get_correct_output_for_input(input[1:seq_len])
+      if not self.outputs_match(output_data[idx][1:seq_len], expected_output):
+        raise ValueError(f"HL model output does not match the RASP program for input {input}: "
+                         f"{output_data[idx][1:seq_len]} != {expected_output}")
+
+    return output_data
+
+  @staticmethod
+  def outputs_match(output: Sequence, expected_output: Sequence, atol: float = 1e-3) -> bool:
+    """Returns whether two decoded outputs are the same, allowing for small differences in numerical values.
+    Positions where the expected output is None are undefined for Tracr, so they match any value."""
+    if len(output) != len(expected_output):
+      return False
+
+    for value, expected_value in zip(output, expected_output):
+      if expected_value is None:
+        continue
+      elif isinstance(value, float) or isinstance(expected_value, float):
+        if value is None or abs(value - expected_value) > atol:
+          return False
+      elif value != expected_value:
+        return False
 
-  def get_correct_output_for_input(self, input: Sequence) -> Sequence:
-    """Returns the correct output for the given input.
-    By default, we run the program and use its output as ground truth.
-    """
-    return self.get_program()(input)
+    return True
 
   def get_validation_metric(
       self,
@@ -309,11 +607,10 @@ class TracrBenchmarkCase(BenchmarkCase):
     """Returns the validation metric for the benchmark case.
     By default, only the l2 and kl metrics are available. Other metrics should override this method.
     """
+    is_categorical = self.is_categorical()
     if metric_name is None:
-      hl_model = self.get_hl_model()
-      metric_name = "l2" if not hl_model.is_categorical() else "kl"
+      metric_name = "l2" if not is_categorical else "kl"
 
-    is_categorical = self.get_hl_model().is_categorical()
     with t.no_grad():
       baseline_output = ll_model(data)
     if metric_name == "l2":
@@ -336,11 +633,17 @@ class TracrBenchmarkCase(BenchmarkCase):
   def get_relative_path_from_root(self) -> str:
     return f"circuits_benchmark/benchmark/cases/case_{self.get_name()}.py"
 
-  def get_tracr_output(self) -> TracrOutput:
+  def get_tracr_output(self) -> "TracrOutput":
     """Compiles a single case to a tracr model."""
     if self.tracr_output is not None:
       return self.tracr_output
 
+    import jax
+    from tracr.compiler import compiling
+
+    # The default of float16 can lead to discrepancies between outputs of the compiled model and the RASP program.
+    jax.config.update('jax_default_matmul_precision', 'float32')
+
     # Reset the RASPExpr ids to ensure reproducibility of Tracr labels
     RASPExpr._ids = itertools.count(1)
 
@@ -361,6 +664,23 @@ class TracrBenchmarkCase(BenchmarkCase):
 
     return tracr_output
 
+  def get_tracr_build_artifact(self, use_cache: bool = True) -> TracrBuildArtifact:
+    """Returns the parts of the compiled tracr model used by the benchmark (see TracrBuildArtifact).
+    If use_cache is True, the artifact is stored on disk after compiling the case, and later calls (also from other
+    processes) load it from there, without compiling the case or importing JAX."""
+    if self.tracr_build_artifact is not None:
+      return self.tracr_build_artifact
+
+    cache_key = get_tracr_build_cache_key(self) if use_cache else None
+    artifact = load_cached_tracr_build(cache_key) if cache_key is not None else None
+    if artifact is None:
+      artifact = TracrBuildArtifact.from_tracr_output(self.get_tracr_output())
+      if cache_key is not None:
+        save_tracr_build_to_cache(cache_key, artifact)
+
+    self.tracr_build_artifact = artifact
+    return artifact
+
   def get_ll_gt_circuit(self, granularity: CircuitGranularity = "acdc_hooks", *args, **kwargs) -> Circuit:
     """Returns the ground truth circuit for the LL model."""
     # This is the identity for now
@@ -368,6 +688,6 @@ class TracrBenchmarkCase(BenchmarkCase):
 
   def get_hl_gt_circuit(self, granularity: CircuitGranularity = "acdc_hooks", *args, **kwargs) -> Circuit:
     """Returns the ground truth circuit for the HL model. I.e., the Tracr-generated model."""
-    tacr_output = self.get_tracr_output()
-    tracr_circuits = build_tracr_circuits(tacr_output.graph, tacr_output.craft_model, granularity=granularity)
+    tracr_build = self.get_tracr_build_artifact()
+    tracr_circuits = build_tracr_circuits(tracr_build.graph, tracr_build.craft_model, granularity=granularity)
     return tracr_circuits.tracr_transformer_circuit
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import pickle
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+import numpy as np
+from networkx import DiGraph
+from tracr.craft.transformers import SeriesWithResiduals
+from tracr.transformer.encoder import CategoricalEncoder, Encoder
+
+from circuits_benchmark.benchmark.dataset_cache import update_hash_with_case_sources
+from circuits_benchmark.transformers import hooked_tracr_transformer, tracr_circuits_builder
+from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformer
+from circuits_benchmark.transformers.tracr_circuits_builder import simplify_tracr_graph
+from circuits_benchmark.utils.project_paths import get_default_output_dir
+
+if TYPE_CHECKING:
+  from tracr.compiler.compiling import TracrOutput
+
+default_tracr_build_cache_dir = os.path.join(get_default_output_dir(), "tracr_build_cache")
+
+
+@dataclass
+class TracrBuildArtifact:
+  """The parts of a compiled Tracr model that the benchmark uses, in a form that can be stored on disk and loaded
+  without compiling the RASP program or importing JAX.
+  Like TracrOutput, it has `graph` and `craft_model` attributes, so it can be used to build the Tracr circuits and
+  correspondence."""
+  cfg_dict: Dict[str, Any]
+  state_dict: Dict[str, np.ndarray]
+  input_encoder: CategoricalEncoder
+  output_encoder: Encoder
+  residual_labels: List[str]
+  graph: DiGraph  # simplified Tracr graph, see simplify_tracr_graph
+  craft_model: SeriesWithResiduals
+
+  @classmethod
+  def from_tracr_output(cls, tracr_output: TracrOutput) -> TracrBuildArtifact:
+    tracr_model = tracr_output.model
+
+    cfg = HookedTracrTransformer.extract_tracr_config(tracr_model)
+    cfg.device = "cpu"
+    tl_model = HookedTracrTransformer(cfg,
+                                      tracr_model.input_encoder,
+                                      tracr_model.output_encoder,
+                                      tracr_model.residual_labels)
+    state_dict = {k: v.cpu().numpy() for k, v in tl_model.extract_tracr_state_dict(tracr_model).items()}
+
+    return cls(cfg_dict=cfg.to_dict(),
+               state_dict=state_dict,
+               input_encoder=tracr_model.input_encoder,
+               output_encoder=tracr_model.output_encoder,
+               residual_labels=list(tracr_model.residual_labels),
+               graph=simplify_tracr_graph(tracr_output.graph),
+               craft_model=tracr_output.craft_model)
+
+
+def get_tracr_build_cache_key(case: "TracrBenchmarkCase") -> str:
+  """Returns a key that identifies the Tracr build of a case. The key changes whenever the source code of the case
+  (which defines the program, vocab and max sequence length), of the modules it imports, or of the code that produces
+  the artifact changes, and whenever the installed Tracr version changes."""
+  hasher = hashlib.sha256()
+  update_hash_with_case_sources(hasher,
+                                case,
+                                __file__,
+                                hooked_tracr_transformer.__file__,
+                                tracr_circuits_builder.__file__)
+  return f"{case.get_name()}/{hasher.hexdigest()}"
+
+
+def get_cached_tracr_build_dir(key: str, cache_dir: Optional[str] = None) -> str:
+  """Returns the directory where the Tracr build with the given key is stored. The cache directory defaults to
+  default_tracr_build_cache_dir, read at call time as in get_cached_dataset_dir."""
+  return os.path.join(cache_dir if cache_dir is not None else default_tracr_build_cache_dir, key)
+
+
+def load_cached_tracr_build(key: str, cache_dir: Optional[str] = None) -> TracrBuildArtifact | None:
+  """Loads a Tracr build from the cache, or returns None if it is not there."""
+  path = os.path.join(get_cached_tracr_build_dir(key, cache_dir), "tracr_build.pkl")
+  if not os.path.exists(path):
+    return None
+
+  with open(path, "rb") as f:
+    return pickle.load(f)
+
+
+def save_tracr_build_to_cache(key: str,
+                              artifact: TracrBuildArtifact,
+                              cache_dir: Optional[str] = None) -> None:
+  """Stores a Tracr build in the cache, writing under a temporary name and renaming as in save_dataset_to_cache."""
+  dirname = get_cached_tracr_build_dir(key, cache_dir)
+  os.makedirs(dirname, exist_ok=True)
+
+  path = os.path.join(dirname, "tracr_build.pkl")
+  tmp_path = f"{path}.tmp-{os.getpid()}"
+  with open(tmp_path, "wb") as f:
+    pickle.dump(artifact, f)
+  os.replace(tmp_path, path)
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import os
+import shutil
+import tempfile
 from typing import List, Any, Optional
 
 import torch as t
@@ -7,6 +10,7 @@ from torch.utils.data import DataLoader
 
 from circuits_benchmark.benchmark.case_dataset import CaseDataset
 from circuits_benchmark.benchmark.tracr_encoded_dataset import TracrEncodedDataset
+from circuits_benchmark.benchmark.tracr_memmap_encoded_dataset import TracrMemmapEncodedDataset
 
 TracrBatchInput = List[List[Any]]
 
@@ -50,11 +54,23 @@ class TracrDataset(CaseDataset):
       collate_fn=lambda x: self.collate_fn(x),
     )
 
-  def get_encoded_dataset(self):
-    encoded_inputs = self.hl_model.map_tracr_input_to_tl_input(self.inputs)
+  def get_encoded_dataset(self, memmap_dir: str | None = None, batch_size: int = 4096):
+    """Encodes the inputs and runs the HL model to produce the targets.
+    If memmap_dir is provided, the dataset is written to that directory batch by batch and returned as a
+    TracrMemmapEncodedDataset, so that the full one-hot targets are never held in memory."""
+    if memmap_dir is not None:
+      return self.get_memmap_encoded_dataset(memmap_dir, batch_size=batch_size)
+
+    return self.encode_inputs(self.inputs, self.hl_model)
+
+  @staticmethod
+  def encode_inputs(inputs: TracrBatchInput, hl_model: "HookedTracrTransformer") -> TracrEncodedDataset:
+    """Encodes the inputs and runs the HL model to produce the targets. Since the targets only depend on the inputs,
+    this also works for inputs that have not been labelled yet."""
+    encoded_inputs = hl_model.map_tracr_input_to_tl_input(inputs)
     with t.no_grad():
-      encoded_outputs = self.hl_model(encoded_inputs)
-      if self.hl_model.is_categorical():
+      encoded_outputs = hl_model(encoded_inputs)
+      if hl_model.is_categorical():
         # take argmax
         argmax_encoded_outputs = t.argmax(encoded_outputs, dim=-1)
         argmax_encoded_outputs[:, 0] = 0 # to make sure that the bos token return redundant information
@@ -64,3 +80,50 @@ class TracrDataset(CaseDataset):
         ).float()
 
     return TracrEncodedDataset(encoded_inputs, encoded_outputs)
+
+  def get_memmap_encoded_dataset(self, dirname: str, batch_size: int = 4096) -> TracrMemmapEncodedDataset:
+    """Writes the encoded dataset to a temporary sibling of dirname and moves it into place once it is complete, as
+    save_dataset_to_cache does with files, so that concurrent processes never truncate files that another one has
+    mapped. dirname must not exist yet or be empty. If another process stores the dataset first, its copy is used."""
+    if TracrMemmapEncodedDataset.exists(dirname):
+      return TracrMemmapEncodedDataset(dirname)
+
+    parent_dir = os.path.dirname(os.path.abspath(dirname))
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dirname = tempfile.mkdtemp(dir=parent_dir, prefix=f"{os.path.basename(dirname)}.tmp-")
+    try:
+      self.write_memmap_encoded_dataset(tmp_dirname, batch_size=batch_size)
+      try:
+        os.replace(tmp_dirname, dirname)
+      except OSError:
+        if not TracrMemmapEncodedDataset.exists(dirname):
+          raise
+    finally:
+      shutil.rmtree(tmp_dirname, ignore_errors=True)
+
+    return TracrMemmapEncodedDataset(dirname)
+
+  def write_memmap_encoded_dataset(self, dirname: str, batch_size: int = 4096) -> None:
+    """Encodes the dataset batch by batch into the files of a TracrMemmapEncodedDataset in dirname."""
+    num_classes = self.hl_model.cfg.d_vocab_out if self.hl_model.is_categorical() else None
+    seq_len = len(self.inputs[0])
+    inputs, targets = TracrMemmapEncodedDataset.create(dirname, len(self.inputs), seq_len, num_classes,
+                                                       d_vocab_out=self.hl_model.cfg.d_vocab_out)
+
+    with t.no_grad():
+      for start in range(0, len(self.inputs), batch_size):
+        end = min(start + batch_size, len(self.inputs))
+        encoded_inputs = self.hl_model.map_tracr_input_to_tl_input(self.inputs[start:end])
+        encoded_outputs = self.hl_model(encoded_inputs)
+        if num_classes is not None:
+          encoded_outputs = t.argmax(encoded_outputs, dim=-1)
+          encoded_outputs[:, 0] = 0 # to make sure that the bos token return redundant information
+
+        inputs[start:end] = encoded_inputs.cpu().numpy()
+        targets[start:end] = encoded_outputs.cpu().numpy()
+
+    inputs.flush()
+    targets.flush()
+    del inputs, targets
+
+    TracrMemmapEncodedDataset.finalize(dirname, num_classes)
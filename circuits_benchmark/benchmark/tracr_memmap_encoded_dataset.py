@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import copy
+import json
+import math
+import os
+import shutil
+import warnings
+import weakref
+from typing import List, Tuple
+
+import numpy as np
+import torch as t
+from torch import Tensor
+from torch.utils.data import DataLoader
+
+from circuits_benchmark.benchmark.tracr_encoded_dataset import TracrEncodedDataset
+
+
+class TracrMemmapEncodedDataset(TracrEncodedDataset):
+  """Same as TracrEncodedDataset, but the inputs and targets are memory-mapped from files in a directory.
+  For categorical cases, targets are stored as class indices and expanded to one-hot vectors only when they are
+  requested, so the files (and the resident memory) are d_vocab_out times smaller than the one-hot targets."""
+
+  def __init__(self, dirname: str):
+    with open(os.path.join(dirname, "meta.json"), "r") as f:
+      meta = json.load(f)
+
+    self.dirname = dirname
+    self.num_classes: int | None = meta["num_classes"]
+
+    # Copy-on-write mapping, so that in-place modifications of the tensors never reach the files.
+    with warnings.catch_warnings():
+      warnings.simplefilter("ignore")
+      inputs = t.from_numpy(np.load(os.path.join(dirname, "inputs.npy"), mmap_mode="c"))
+      targets = t.from_numpy(np.load(os.path.join(dirname, "targets.npy"), mmap_mode="c"))
+
+    super().__init__(inputs, targets)
+
+  def remove_files_when_unused(self) -> None:
+    """Removes the directory of the dataset once the dataset (and every split of it) is garbage collected, or at exit.
+    Meant for datasets stored in temporary directories."""
+    weakref.finalize(self, shutil.rmtree, self.dirname, ignore_errors=True)
+
+  def split(self, test_size: float) -> Tuple[TracrMemmapEncodedDataset, TracrMemmapEncodedDataset]:
+    """Splits the dataset into a train and a test dataset by index ranges, as views of the same memory-mapped files.
+    Unlike iit's train_test_split, this does not index (and thus load) every sample. Samples are already shuffled when
+    the dataset is generated, so the last ceil(test_size * len(self)) samples are used for testing."""
+    n_train = len(self) - int(math.ceil(test_size * len(self)))
+    return self.get_range(0, n_train), self.get_range(n_train, len(self))
+
+  def get_range(self, start: int, end: int) -> TracrMemmapEncodedDataset:
+    """Returns a view with the samples between start and end, which keeps this dataset alive."""
+    subset = copy.copy(self)
+    subset.inputs = self.inputs[start:end]
+    subset.targets = self.targets[start:end]
+    subset.source_dataset = self
+    return subset
+
+  @staticmethod
+  def exists(dirname: str) -> bool:
+    return os.path.exists(os.path.join(dirname, "meta.json"))
+
+  @staticmethod
+  def create(dirname: str,
+             n_samples: int,
+             seq_len: int,
+             num_classes: int | None,
+             d_vocab_out: int = 1) -> (np.memmap, np.memmap):
+    """Creates the files for a new dataset and returns writable memory maps for the inputs and targets.
+    If num_classes is None, targets are stored as they are (i.e., numerical outputs of shape seq_len x d_vocab_out).
+    The dataset can only be loaded after calling `finalize` on the same directory."""
+    os.makedirs(dirname, exist_ok=True)
+    inputs = np.lib.format.open_memmap(os.path.join(dirname, "inputs.npy"), mode="w+", dtype=np.int64,
+                                       shape=(n_samples, seq_len))
+    if num_classes is not None:
+      targets = np.lib.format.open_memmap(os.path.join(dirname, "targets.npy"), mode="w+", dtype=np.int64,
+                                          shape=(n_samples, seq_len))
+    else:
+      targets = np.lib.format.open_memmap(os.path.join(dirname, "targets.npy"), mode="w+", dtype=np.float32,
+                                          shape=(n_samples, seq_len, d_vocab_out))
+    return inputs, targets
+
+  @staticmethod
+  def finalize(dirname: str, num_classes: int | None) -> None:
+    """Writes the metadata of a dataset created with `create`, which marks it as complete."""
+    with open(os.path.join(dirname, "meta.json"), "w") as f:
+      json.dump({"num_classes": num_classes}, f)
+
+  def expand_targets(self, targets: Tensor) -> Tensor:
+    """Maps stored targets to the format of TracrEncodedDataset (i.e., one-hot vectors for categorical cases).
+    Targets that are already expanded are returned as they are."""
+    if self.num_classes is None or targets.is_floating_point():
+      return targets
+    return t.nn.functional.one_hot(targets, num_classes=self.num_classes).float()
+
+  def __getitem__(self, idx):
+    return self.inputs[idx], self.expand_targets(self.targets[idx])
+
+  def __getitems__(self, indices: List[int]):
+    # Used by DataLoader to fetch a whole batch at once, which is then expanded in collate_fn.
+    return self.inputs[indices], self.targets[indices]
+
+  def get_targets(self):
+    """Returns all targets in the format of TracrEncodedDataset. Note that this materializes the one-hot targets for
+    the whole dataset, prefer `make_loader` for large datasets."""
+    return self.expand_targets(self.targets)
+
+  def collate_fn(self, batch, device: t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu")):
+    inputs, targets = batch
+    return inputs.to(device=device), self.expand_targets(targets.to(device=device))
+
+  def make_loader(
+      self,
+      batch_size: int | None = None,
+      shuffle: bool | None = False,
+      device: str | t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu"),
+      num_workers: int = 0,
+  ) -> DataLoader:
+    return DataLoader(
+      self,
+      batch_size=batch_size,
+      shuffle=shuffle,
+      num_workers=num_workers,
+      collate_fn=lambda x: self.collate_fn(x, device=device),
+    )
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import math
+import random
+from typing import Optional, Iterator, Tuple
+
+import numpy as np
+import torch as t
+from torch import Tensor
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+from circuits_benchmark.benchmark.tracr_dataset import TracrDataset
+from circuits_benchmark.benchmark.tracr_encoded_dataset import TracrEncodedDataset
+
+
+class TracrStreamingDataset(IterableDataset):
+  """Encoded data for a Tracr case that is sampled, labelled and encoded on the fly, one chunk at a time.
+
+  The inputs of each chunk are generated as in the case's `sample_data`, with Python and NumPy random generators seeded
+  from (seed, epoch, chunk index), and labelled once by the HL model when they are encoded. The labelling_mode is only
+  used for cases that override `sample_data`, whose inputs may depend on their outputs. A given seed always produces
+  the same stream regardless of how many chunks have been generated before. When iterated from several DataLoader
+  workers, each worker generates a disjoint subset of the chunks, and the order of the stream is deterministic for a
+  given seed and number of workers.
+  """
+
+  def __init__(self,
+               case: "TracrBenchmarkCase",
+               seed: int = 42,
+               samples_per_epoch: Optional[int] = None,
+               chunk_size: int = 1024,
+               variable_length_seqs: bool = False,
+               labelling_mode: "DataLabellingMode" = "hl_model",
+               device: str | t.device = t.device("cpu")):
+    """samples_per_epoch=None produces an unbounded stream."""
+    self.case = case
+    self.seed = seed
+    self.samples_per_epoch = samples_per_epoch
+    self.chunk_size = chunk_size
+    self.labelling_mode = labelling_mode
+    self.device = device
+    self.epoch = 0
+    self.hl_model = None
+
+    self.max_seq_len = case.get_max_seq_len()
+    self.min_seq_len = case.get_min_seq_len() if variable_length_seqs else self.max_seq_len
+
+  def __len__(self):
+    if self.samples_per_epoch is None:
+      raise TypeError("Unbounded streaming datasets have no length")
+    return self.samples_per_epoch
+
+  def __iter__(self) -> Iterator[Tuple[Tensor, Tensor]]:
+    worker_info = get_worker_info()
+    worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+    epoch = self.epoch
+    self.epoch += 1
+
+    if self.samples_per_epoch is None:
+      chunk_indices = range(worker_id, np.iinfo(np.int64).max, num_workers)
+    else:
+      n_chunks = math.ceil(self.samples_per_epoch / self.chunk_size)
+      chunk_indices = range(worker_id, n_chunks, num_workers)
+
+    for chunk_idx in chunk_indices:
+      chunk = self.gen_chunk(epoch, chunk_idx)
+      for i in range(len(chunk)):
+        yield chunk[i]
+
+  def gen_chunk(self, epoch: int, chunk_idx: int) -> TracrEncodedDataset:
+    """Generates the encoded data for a chunk of the stream."""
+    from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
+
+    n_samples = self.chunk_size
+    if self.samples_per_epoch is not None:
+      n_samples = min(self.chunk_size, self.samples_per_epoch - chunk_idx * self.chunk_size)
+
+    py_seed, np_seed = np.random.SeedSequence([self.seed, epoch, chunk_idx]).generate_state(2).tolist()
+
+    # sample_data uses the global random generators, so we restore them afterwards to avoid interfering with the
+    # rest of the process (e.g., the training loop when there are no workers).
+    random_state, np_random_state = random.getstate(), np.random.get_state()
+    try:
+      random.seed(py_seed)
+      np.random.seed(np_seed)
+      if type(self.case).sample_data is TracrBenchmarkCase.sample_data:
+        # the encoded targets are produced by the HL model below, so the inputs are not labelled here
+        input_data = self.case.sample_inputs(n_samples, self.min_seq_len, self.max_seq_len)
+      else:
+        # cases with their own sample_data may generate inputs and outputs together
+        input_data, _ = self.case.sample_data(n_samples, self.min_seq_len, self.max_seq_len,
+                                              labelling_mode=self.labelling_mode)
+    finally:
+      random.setstate(random_state)
+      np.random.set_state(np_random_state)
+
+    if self.hl_model is None:
+      # built lazily, so that each worker process builds its own copy
+      self.hl_model = self.case.get_hl_model(device=self.device)
+    return TracrDataset.encode_inputs(input_data, self.hl_model)
+
+  def make_loader(
+      self,
+      batch_size: int | None = None,
+      device: str | t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu"),
+      num_workers: int = 0,
+  ) -> DataLoader:
+    return DataLoader(
+      self,
+      batch_size=batch_size,
+      num_workers=num_workers,
+      # keep the workers (and their epoch counters) alive between epochs, so that each epoch sees new data
+      persistent_workers=num_workers > 0,
+      collate_fn=lambda x: TracrEncodedDataset.collate_fn(x, device=device),
+    )
@@ -4,7 +4,7 @@ import random
 import shutil
 from argparse import Namespace
 from copy import deepcopy
-from typing import Tuple, Literal
+from typing import Dict, List, Literal, Tuple
 
 import numpy as np
 import torch as t
@@ -13,13 +13,15 @@ from auto_circuit.data import PromptDataset, PromptDataLoader
 from auto_circuit.prune_algos.ACDC import acdc_prune_scores
 from auto_circuit.types import PruneScores, OutputSlice
 from auto_circuit.utils.graph_utils import patchable_model
+from auto_circuit.utils.patchable_model import PatchableModel
 
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
-from circuits_benchmark.commands.algorithms.legacy_acdc import ACDCConfig, LegacyACDCRunner
+from circuits_benchmark.commands.algorithms.legacy_acdc import ACDCConfig
 from circuits_benchmark.commands.common_args import add_common_args, add_evaluation_common_ags
-from circuits_benchmark.utils.auto_circuit_utils import build_circuit
+from circuits_benchmark.utils.auto_circuit_utils import build_circuit, get_edge_scores
 from circuits_benchmark.utils.circuit.circuit import Circuit
 from circuits_benchmark.utils.circuit.circuit_eval import evaluate_hypothesis_circuit, CircuitEvalResult
+from circuits_benchmark.utils.circuit.circuit_roc import evaluate_hypothesis_roc, CircuitROCResult
 from circuits_benchmark.utils.ll_model_loader.ll_model_loader import LLModelLoader
 
 
@@ -47,12 +49,76 @@ class ACDCRunner:
       random.seed(self.config.seed)
       np.random.seed(self.config.seed)
 
+    def get_thresholds(self) -> List[float]:
+      """Returns the thresholds to run ACDC with, in increasing order."""
+      if self.config.thresholds:
+        return sorted(set(self.config.thresholds))
+      return [self.config.threshold]
+
     def run_using_model_loader(self, ll_model_loader: LLModelLoader) -> Tuple[Circuit, CircuitEvalResult]:
-      clean_dirname = self.prepare_output_dir(ll_model_loader)
+      return self.run_thresholds_using_model_loader(ll_model_loader, [self.config.threshold])[self.config.threshold]
+
+    def run_thresholds_using_model_loader(
+        self,
+        ll_model_loader: LLModelLoader,
+        thresholds: List[float] | None = None,
+    ) -> Dict[float, Tuple[Circuit, CircuitEvalResult]]:
+      """Runs ACDC for all the thresholds (by default, the ones in the config), reusing the model and data. The circuit
+      and result of each threshold are stored in its own output directory."""
+      if thresholds is None:
+        thresholds = self.get_thresholds()
 
       print(f"Running ACDC evaluation for case {self.case.get_name()} ({str(ll_model_loader)})")
-      print(f"Output directory: {clean_dirname}")
 
+      hl_ll_corr, ll_model, data = self.load_ll_model_and_data(ll_model_loader)
+      acdc_circuits = self.run_thresholds(ll_model, *data, thresholds)
+
+      print("hl_ll_corr:", hl_ll_corr)
+
+      gt_circuit = None
+      if str(ll_model_loader) == "ground_truth":
+        gt_circuit = self.case.get_hl_gt_circuit(granularity="acdc_hooks")
+
+      results = {}
+      for threshold, acdc_circuit in acdc_circuits.items():
+        clean_dirname = self.prepare_output_dir(ll_model_loader, threshold)
+        print(f"Output directory: {clean_dirname}")
+
+        print("Done running acdc: ")
+        print(list(acdc_circuit.nodes), list(acdc_circuit.edges))
+        acdc_circuit.save(f"{clean_dirname}/final_circuit.pkl")
+        hl_ll_corr.save(f"{clean_dirname}/hl_ll_corr.pkl")
+
+        print("Calculating FPR and TPR for threshold", threshold)
+        result = evaluate_hypothesis_circuit(
+          acdc_circuit,
+          ll_model,
+          hl_ll_corr,
+          self.case,
+          gt_circuit=gt_circuit,
+        )
+
+        # save the result
+        with open(f"{clean_dirname}/result.txt", "w") as f:
+          f.write(str(result))
+        pickle.dump(result, open(f"{clean_dirname}/result.pkl", "wb"))
+        print(f"Saved result to {clean_dirname}/result.txt and {clean_dirname}/result.pkl")
+
+        if self.config.using_wandb:
+          wandb.init(
+            project=f"circuit_discovery{'_same_size' if self.config.same_size else ''}",
+            group=f"acdc_{self.case.get_name()}_{str(ll_model_loader.get_output_suffix())}",
+            name=f"{threshold}",
+          )
+          wandb.save(f"{clean_dirname}/*", base_path=self.config.output_dir)
+          wandb.finish()
+
+        results[threshold] = (acdc_circuit, result)
+
+      return results
+
+    def load_ll_model_and_data(self, ll_model_loader: LLModelLoader):
+      """Returns the correspondence, the LL model and the arguments of run_thresholds (other than the thresholds)."""
       hl_ll_corr, ll_model = ll_model_loader.load_ll_model_and_correspondence(
         device=self.config.device,
         output_dir=self.config.output_dir,
@@ -86,50 +152,65 @@ class ACDCRunner:
 
       faithfulness_metric: Literal["kl_div", "mse"] = "mse" if not hl_model.is_categorical() else "kl_div"
 
-      acdc_circuit = self.run(
-        ll_model,
-        clean_dataset.get_inputs(),
-        clean_outputs,
-        corrupted_dataset.get_inputs(),
-        corrupted_outputs,
-        faithfulness_metric,
-      )
+      data = (clean_dataset.get_inputs(), clean_outputs, corrupted_dataset.get_inputs(), corrupted_outputs,
+              faithfulness_metric)
+      return hl_ll_corr, ll_model, data
+
+    def run_roc_using_model_loader(
+        self,
+        ll_model_loader: LLModelLoader,
+        thresholds: List[float] | None = None,
+    ) -> CircuitROCResult:
+      """Evaluates the ROC curve of ACDC over the thresholds (by default, the ones in the config). As in auto_circuit,
+      all the thresholds are run in a single acdc_prune_scores call and each edge gets the smallest threshold that
+      pruned it as score. So the circuit of a threshold in the curve is the intersection of the circuits of the
+      thresholds up to it, which may differ from running ACDC with only that threshold (see run_thresholds)."""
+      if thresholds is None:
+        thresholds = self.get_thresholds()
+
+      clean_dirname = self.prepare_output_dir(ll_model_loader, output_name="roc")
+      print(f"Running ACDC ROC evaluation for case {self.case.get_name()} ({str(ll_model_loader)})")
+      print(f"Output directory: {clean_dirname}")
 
-      print("Done running acdc: ")
-      print(list(acdc_circuit.nodes), list(acdc_circuit.edges))
+      hl_ll_corr, ll_model, data = self.load_ll_model_and_data(ll_model_loader)
+      *inputs_and_outputs, faithfulness_metric = data
+      auto_circuit_model, train_loader = self.prepare_auto_circuit(ll_model, *inputs_and_outputs)
+      attribution_scores: PruneScores = acdc_prune_scores(
+        model=auto_circuit_model,
+        dataloader=train_loader,
+        official_edges=None,
+        tao_exps=[0],  # i.e., threshold * (10**0) = threshold
+        tao_bases=sorted(set(thresholds)),  # type: ignore
+        faithfulness_target=faithfulness_metric,
+      )
+      edges, scores = get_edge_scores(auto_circuit_model, attribution_scores)
 
       print("hl_ll_corr:", hl_ll_corr)
       hl_ll_corr.save(f"{clean_dirname}/hl_ll_corr.pkl")
 
-      print("Calculating FPR and TPR for threshold", self.config.threshold)
       gt_circuit = None
       if str(ll_model_loader) == "ground_truth":
         gt_circuit = self.case.get_hl_gt_circuit(granularity="acdc_hooks")
 
-      result = evaluate_hypothesis_circuit(
-        acdc_circuit,
-        ll_model,
-        hl_ll_corr,
-        self.case,
-        gt_circuit=gt_circuit,
-      )
+      print("Calculating ROC curve")
+      result = evaluate_hypothesis_roc(edges, scores, ll_model, hl_ll_corr, self.case, gt_circuit=gt_circuit)
+      print(f"Nodes AUC: {result.nodes_auc}, Edges AUC: {result.edges_auc} ({len(result)} thresholds)")
 
       # save the result
-      with open(f"{clean_dirname}/result.txt", "w") as f:
-        f.write(str(result))
-      pickle.dump(result, open(f"{clean_dirname}/result.pkl", "wb"))
-      print(f"Saved result to {clean_dirname}/result.txt and {clean_dirname}/result.pkl")
+      result.save_csv(f"{clean_dirname}/roc.csv")
+      pickle.dump(result, open(f"{clean_dirname}/roc.pkl", "wb"))
+      print(f"Saved ROC curve to {clean_dirname}/roc.csv and {clean_dirname}/roc.pkl")
 
       if self.config.using_wandb:
         wandb.init(
           project=f"circuit_discovery{'_same_size' if self.config.same_size else ''}",
           group=f"acdc_{self.case.get_name()}_{str(ll_model_loader.get_output_suffix())}",
-          name=f"{self.config.threshold}",
+          name="roc",
         )
         wandb.save(f"{clean_dirname}/*", base_path=self.config.output_dir)
         wandb.finish()
 
-      return acdc_circuit, result
+      return result
 
     def run(
         self,
@@ -140,6 +221,62 @@ class ACDCRunner:
         corrupted_outputs: t.Tensor,
         faithfulness_metric: Literal["kl_div", "mse"],
     ) -> Circuit:
+      acdc_circuit = self.run_thresholds(
+        tl_model,
+        clean_inputs,
+        clean_outputs,
+        corrupted_inputs,
+        corrupted_outputs,
+        faithfulness_metric,
+        [self.config.threshold],
+      )[self.config.threshold]
+      acdc_circuit.save(f"{self.config.output_dir}/final_circuit.pkl")
+
+      return acdc_circuit
+
+    def run_thresholds(
+        self,
+        tl_model: t.nn.Module,
+        clean_inputs: t.Tensor,
+        clean_outputs: t.Tensor,
+        corrupted_inputs: t.Tensor,
+        corrupted_outputs: t.Tensor,
+        faithfulness_metric: Literal["kl_div", "mse"],
+        thresholds: List[float],
+    ) -> Dict[float, Circuit]:
+      """Returns the ACDC circuit of each threshold. The model is wrapped and the data is cached once, and then ACDC's
+      greedy pruning pass runs once per threshold, since the edges it prunes depend on the edges pruned before. Each
+      circuit is the same as running ACDC with only that threshold."""
+      auto_circuit_model, train_loader = self.prepare_auto_circuit(tl_model,
+                                                                   clean_inputs,
+                                                                   clean_outputs,
+                                                                   corrupted_inputs,
+                                                                   corrupted_outputs)
+
+      circuits = {}
+      for threshold in thresholds:
+        # edges pruned with this threshold get it as score, and the rest keep an infinite score
+        attribution_scores: PruneScores = acdc_prune_scores(
+          model=auto_circuit_model,
+          dataloader=train_loader,
+          official_edges=None,
+          tao_exps=[0],  # i.e., threshold * (10**0) = threshold
+          tao_bases=[threshold],  # type: ignore
+          faithfulness_target=faithfulness_metric,
+        )
+        circuits[threshold] = build_circuit(auto_circuit_model, attribution_scores, threshold)
+
+      return circuits
+
+    def prepare_auto_circuit(
+        self,
+        tl_model: t.nn.Module,
+        clean_inputs: t.Tensor,
+        clean_outputs: t.Tensor,
+        corrupted_inputs: t.Tensor,
+        corrupted_outputs: t.Tensor,
+    ) -> Tuple[PatchableModel, PromptDataLoader]:
+      """Wraps the model in a patchable model and puts the data in a single batch loader, as acdc_prune_scores needs."""
       slice_output: OutputSlice = "not_first_seq"  # This drops the first token from the output (e.g., BOS)
       if "ioi" in self.case.get_name():
         slice_output = "last_seq"  # Consider the last token as the output
@@ -159,24 +296,13 @@ class ACDCRunner:
         clean_outputs,
         corrupted_outputs,
       )
+      # auto_circuit's ACDC only uses the first batch of the loader, so all the data goes in a single batch
       train_loader = PromptDataLoader(dataset,
                                       seq_len=self.case.get_max_seq_len(),
                                       diverge_idx=0,
                                       batch_size=len(dataset))
 
-      attribution_scores: PruneScores = acdc_prune_scores(
-        model=auto_circuit_model,
-        dataloader=train_loader,
-        official_edges=None,
-        tao_exps=[0],  # i.e., threshold * (10**0) = threshold
-        tao_bases=[self.config.threshold],  # type: ignore
-        faithfulness_target=faithfulness_metric,
-      )
-
-      acdc_circuit = build_circuit(auto_circuit_model, attribution_scores, self.config.threshold)
-      acdc_circuit.save(f"{self.config.output_dir}/final_circuit.pkl")
-
-      return acdc_circuit
+      return auto_circuit_model, train_loader
 
     @staticmethod
     def add_args_to_parser(parser):
@@ -190,12 +316,28 @@ class ACDCRunner:
           default=0.025,
           help="ACDC's threshold for pruning edges",
       )
+      parser.add_argument(
+          "--thresholds",
+          type=float,
+          nargs="+",
+          default=None,
+          help="Run ACDC for several thresholds, reusing the model and data. Each threshold runs its own pruning "
+               "pass and gives the same circuit as --threshold. Overrides --threshold.",
+      )
+      parser.add_argument(
+          "--roc",
+          action="store_true",
+          help="Evaluate the ROC curve over the thresholds instead of a circuit per threshold. All the thresholds "
+               "run in a single acdc_prune_scores call, and each edge is scored with the smallest threshold that "
+               "pruned it.",
+      )
       parser.add_argument(
         "--data-size",
         type=int,
         required=False,
         default=1000,
-        help="How many samples to use"
+        help="How many samples to use. ACDC runs on a single batch with all of them, so this also bounds its memory "
+             "usage."
       )
       parser.add_argument(
           "--include-mlp", type=int, help="Evaluate group 'with_mlp'", default=1
@@ -253,13 +395,15 @@ class ACDCRunner:
     @staticmethod
     def setup_subparser(subparsers):
       parser = subparsers.add_parser("acdc")
-      LegacyACDCRunner.add_args_to_parser(parser)
+      ACDCRunner.add_args_to_parser(parser)
 
-    def prepare_output_dir(self, ll_model_loader):
-      output_suffix = f"{ll_model_loader.get_output_suffix()}/threshold_{self.config.threshold}"
+    def prepare_output_dir(self, ll_model_loader, threshold: float | None = None, output_name: str | None = None):
+      if output_name is None:
+        output_name = f"threshold_{self.config.threshold if threshold is None else threshold}"
+      output_suffix = f"{ll_model_loader.get_output_suffix()}/{output_name}"
       clean_dirname = f"{self.config.output_dir}/acdc/{self.case.get_name()}/{output_suffix}"
 
-      # remove everything in the directory
+      # remove everything in this directory (directories of other thresholds are kept)
       if os.path.exists(clean_dirname):
         shutil.rmtree(clean_dirname)
 
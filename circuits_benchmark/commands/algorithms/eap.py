@@ -4,20 +4,26 @@ import shutil
 from argparse import Namespace
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import Tuple, Optional, List
+from typing import Dict, Tuple, Optional, List
 
+import numpy as np
 import torch as t
 from auto_circuit.data import PromptDataLoader, PromptDataset, PromptPairBatch
 from auto_circuit.prune_algos.mask_gradient import mask_gradient_prune_scores
 from auto_circuit.types import PruneScores, OutputSlice
 from auto_circuit.utils.graph_utils import patchable_model
-from auto_circuit.utils.tensor_ops import prune_scores_threshold
+from auto_circuit.utils.patchable_model import PatchableModel
 
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
-from circuits_benchmark.commands.common_args import add_common_args, add_evaluation_common_ags
-from circuits_benchmark.utils.auto_circuit_utils import build_circuit, build_normalized_scores
+from circuits_benchmark.commands.common_args import add_common_args, add_evaluation_common_ags, add_batching_args
+from circuits_benchmark.utils.auto_circuit_utils import build_circuit, build_normalized_scores, get_edge_scores, \
+  build_circuit_from_edge_scores, get_edge_count_threshold, normalize_edge_scores, save_edge_scores, \
+  load_edge_scores, get_batch_size, get_prune_scores_threshold, batched_integrated_gradients_prune_scores, \
+  get_integrated_grad_steps_per_pass
 from circuits_benchmark.utils.circuit.circuit import Circuit
+from circuits_benchmark.utils.circuit.compact_circuit import CircuitEdge
 from circuits_benchmark.utils.circuit.circuit_eval import evaluate_hypothesis_circuit, CircuitEvalResult
+from circuits_benchmark.utils.circuit.circuit_roc import evaluate_hypothesis_roc, CircuitROCResult
 from circuits_benchmark.utils.ll_model_loader.ll_model_loader import LLModelLoader
 from circuits_benchmark.utils.project_paths import get_default_output_dir
 
@@ -40,6 +46,13 @@ class EAPConfig:
   use_pos_embed: Optional[bool] = False
   weights: Optional[str] = None
   abs_value_threshold: Optional[bool] = False
+  roc: Optional[bool] = False
+  edge_counts: Optional[List[int]] = None
+  thresholds: Optional[List[float]] = None
+  from_scores: Optional[bool] = False
+  batch_size: Optional[int] = None
+  max_memory: Optional[float] = None
+  batch_integrated_grad_steps: Optional[bool] = False
 
   @staticmethod
   def from_args(args: Namespace) -> "EAPConfig":
@@ -58,7 +71,14 @@ class EAPConfig:
       same_size=args.same_size,
       include_mlp=args.include_mlp,
       use_pos_embed=args.use_pos_embed,
-      abs_value_threshold=args.abs_val_threshold
+      abs_value_threshold=args.abs_val_threshold,
+      roc=args.roc,
+      edge_counts=args.edge_counts,
+      thresholds=args.thresholds,
+      from_scores=args.from_scores,
+      batch_size=args.batch_size,
+      max_memory=args.max_memory,
+      batch_integrated_grad_steps=args.batch_integrated_grad_steps,
     )
 
 class EAPRunner:
@@ -83,16 +103,148 @@ class EAPRunner:
     self.classification_loss_fn = self.config.classification_loss_fn
     self.normalize_scores = self.config.normalize_scores
 
-    assert (self.edge_count is not None) ^ (self.threshold is not None), \
-      "Either edge_count or threshold must be provided, but not both"
+    if not self.config.roc and not self.config.edge_counts and not self.config.thresholds:
+      assert (self.edge_count is not None) ^ (self.threshold is not None), \
+        "Either edge_count or threshold must be provided, but not both"
 
   def run_using_model_loader(self, ll_model_loader: LLModelLoader) -> Tuple[Circuit, CircuitEvalResult]:
+    circuits = self.run_circuits_using_model_loader(ll_model_loader)
+    assert len(circuits) == 1, "Use run_circuits_using_model_loader for several edge counts or thresholds"
+    return next(iter(circuits.values()))
+
+  def run_circuits_using_model_loader(self,
+                                      ll_model_loader: LLModelLoader) -> Dict[str, Tuple[Circuit, CircuitEvalResult]]:
+    """Builds and evaluates the circuit of each edge count and threshold in the config, from a single computation of
+    the attribution scores (or from the stored ones, with from_scores). Returns the circuits and results by output
+    directory name, e.g., "edge_count_10"."""
+    print(f"Running EAP evaluation for case {self.case.get_name()} ({str(ll_model_loader)})")
+
+    hl_ll_corr, ll_model = self.load_ll_model_and_correspondence(ll_model_loader)
+    edges, scores = self.get_edge_scores(ll_model, ll_model_loader)
+    print("hl_ll_corr:", hl_ll_corr)
+
+    results = {}
+    for output_name, run_name, threshold in self.get_circuit_thresholds(scores):
+      clean_dirname = self.prepare_output_dir(ll_model_loader, output_name)
+      print(f"Output directory: {clean_dirname}")
+
+      eap_circuit = build_circuit_from_edge_scores(edges, scores, threshold, self.config.abs_value_threshold)
+      eap_circuit.save(f"{clean_dirname}/final_circuit.pkl")
+      hl_ll_corr.save(f"{clean_dirname}/hl_ll_corr.pkl")
+
+      print("Calculating FPR and TPR")
+      result = evaluate_hypothesis_circuit(
+        eap_circuit,
+        ll_model,
+        hl_ll_corr,
+        self.case,
+        use_embeddings=False,
+      )
+
+      # save the result
+      with open(f"{clean_dirname}/result.txt", "w") as f:
+        f.write(str(result))
+
+      pickle.dump(result, open(f"{clean_dirname}/result.pkl", "wb"))
+      print(f"Saved result to {clean_dirname}/result.txt and {clean_dirname}/result.pkl")
+      self.save_to_wandb(ll_model_loader, clean_dirname, run_name)
+
+      results[output_name] = (eap_circuit, result)
+
+    return results
+
+  def get_circuit_thresholds(self, scores: np.ndarray) -> List[Tuple[str, str, float]]:
+    """Returns the output directory name, wandb run name and score threshold of each circuit to build."""
+    edge_counts = list(self.config.edge_counts or [])
+    if self.edge_count is not None and self.edge_count not in edge_counts:
+      edge_counts.append(self.edge_count)
+    thresholds = list(self.config.thresholds or [])
+    if self.threshold is not None and self.threshold not in thresholds:
+      thresholds.append(self.threshold)
+
+    circuit_thresholds = []
+    for edge_count in edge_counts:
+      # find the threshold for the top-k edges
+      threshold = get_edge_count_threshold(scores, edge_count)
+      print(f"Threshold for top-{edge_count} edges: {threshold}")
+      circuit_thresholds.append((f"edge_count_{edge_count}", f"ec_{edge_count}", threshold))
+    for threshold in thresholds:
+      circuit_thresholds.append((f"threshold_{threshold}", f"{threshold}", threshold))
+
+    return circuit_thresholds
+
+  def get_edge_scores(self,
+                      ll_model: t.nn.Module,
+                      ll_model_loader: LLModelLoader) -> Tuple[List[CircuitEdge], np.ndarray]:
+    """Returns the edges of the model and their attribution scores. Scores are computed and stored, or loaded from
+    the stored ones if from_scores is set."""
+    scores_path = self.get_scores_path(ll_model_loader)
+    if self.config.from_scores:
+      edge_scores = load_edge_scores(scores_path)
+      if edge_scores is None:
+        raise FileNotFoundError(f"No EAP scores stored in {scores_path}. Run EAP without --from-scores first.")
+      print(f"Loaded EAP scores from {scores_path}")
+      edges, scores = edge_scores
+    else:
+      auto_circuit_model, attribution_scores = self.compute_attribution_scores(ll_model, *self.prepare_data())
+      edges, scores = get_edge_scores(auto_circuit_model, attribution_scores)
+      save_edge_scores(scores_path, edges, scores)
+      print(f"Saved EAP scores to {scores_path}")
+
+    if self.normalize_scores:
+      scores = normalize_edge_scores(scores)
+
+    return edges, scores
+
+  def get_scores_path(self, ll_model_loader: LLModelLoader) -> str:
+    """Returns the file with the attribution scores for the case, model and EAP settings that affect them."""
+    loss_fn = self.classification_loss_fn if self.case.is_categorical() else self.regression_loss_fn
+    scores_name = (f"data_size_{self.data_size}"
+                   f"_ig_steps_{self.integrated_grad_steps}"
+                   f"_loss_{loss_fn}"
+                   f"_seed_{self.config.seed}"
+                   f"_mlp_{int(bool(self.config.include_mlp))}"
+                   f"_pos_embed_{int(bool(self.config.use_pos_embed))}")
+    return (f"{self.config.output_dir}/eap_scores/{self.case.get_name()}/{ll_model_loader.get_output_suffix()}/"
+            f"{scores_name}.pt")
+
+  def run_roc_using_model_loader(self, ll_model_loader: LLModelLoader) -> CircuitROCResult:
+    """Computes the attribution scores once and evaluates the circuits of all the thresholds over them, instead of
+    running EAP once per threshold or edge count."""
     clean_dirname = self.prepare_output_dir(ll_model_loader)
 
-    print(f"Running EAP evaluation for case {self.case.get_name()} ({str(ll_model_loader)})")
+    print(f"Running EAP ROC evaluation for case {self.case.get_name()} ({str(ll_model_loader)})")
     print(f"Output directory: {clean_dirname}")
 
-    hl_ll_corr, ll_model = ll_model_loader.load_ll_model_and_correspondence(
+    hl_ll_corr, ll_model = self.load_ll_model_and_correspondence(ll_model_loader)
+    edges, scores = self.get_edge_scores(ll_model, ll_model_loader)
+    if self.config.abs_value_threshold:
+      scores = np.abs(scores)
+
+    print("hl_ll_corr:", hl_ll_corr)
+    hl_ll_corr.save(f"{clean_dirname}/hl_ll_corr.pkl")
+
+    print("Calculating ROC curve")
+    result = evaluate_hypothesis_roc(
+      edges,
+      scores,
+      ll_model,
+      hl_ll_corr,
+      self.case,
+      use_embeddings=False,
+    )
+    print(f"Nodes AUC: {result.nodes_auc}, Edges AUC: {result.edges_auc} ({len(result)} thresholds)")
+
+    # save the result
+    result.save_csv(f"{clean_dirname}/roc.csv")
+    pickle.dump(result, open(f"{clean_dirname}/roc.pkl", "wb"))
+    print(f"Saved ROC curve to {clean_dirname}/roc.csv and {clean_dirname}/roc.pkl")
+    self.save_to_wandb(ll_model_loader, clean_dirname, "roc")
+
+    return result
+
+  def load_ll_model_and_correspondence(self, ll_model_loader: LLModelLoader):
+    return ll_model_loader.load_ll_model_and_correspondence(
       device=self.config.device,
       output_dir=self.config.output_dir,
       same_size=self.config.same_size,
@@ -102,6 +254,8 @@ class EAPRunner:
       use_pos_embed=self.config.use_pos_embed
     )
 
+  def prepare_data(self):
+    """Returns the clean inputs and outputs, and the corrupted inputs and outputs to run EAP on."""
     clean_dataset = self.case.get_clean_data(max_samples=self.config.data_size)
     corrupted_dataset = self.case.get_corrupted_data(max_samples=self.config.data_size)
 
@@ -117,44 +271,19 @@ class EAPRunner:
       else:
         raise ValueError(f"Unknown output type: {type(clean_outputs)}")
 
-    eap_circuit = self.run(
-      ll_model,
-      clean_dataset.get_inputs(),
-      clean_outputs,
-      corrupted_dataset.get_inputs(),
-      corrupted_outputs,
-    )
-
-    print("hl_ll_corr:", hl_ll_corr)
-    hl_ll_corr.save(f"{clean_dirname}/hl_ll_corr.pkl")
-
-    print("Calculating FPR and TPR")
-    result = evaluate_hypothesis_circuit(
-      eap_circuit,
-      ll_model,
-      hl_ll_corr,
-      self.case,
-      use_embeddings=False,
-    )
-
-    # save the result
-    with open(f"{clean_dirname}/result.txt", "w") as f:
-      f.write(str(result))
+    return clean_dataset.get_inputs(), clean_outputs, corrupted_dataset.get_inputs(), corrupted_outputs
 
-    pickle.dump(result, open(f"{clean_dirname}/result.pkl", "wb"))
-    print(f"Saved result to {clean_dirname}/result.txt and {clean_dirname}/result.pkl")
+  def save_to_wandb(self, ll_model_loader: LLModelLoader, clean_dirname: str, name: str):
     if self.config.using_wandb:
       import wandb
-      algo_str = "eap" if self.integrated_grad_steps is None else f"integrated_grad_{self.integrated_grad_steps}" 
+      algo_str = "eap" if self.integrated_grad_steps is None else f"integrated_grad_{self.integrated_grad_steps}"
       wandb.init(
         project="circuit_discovery",
         group=f"{algo_str}_{self.case.get_name()}_{ll_model_loader.get_output_suffix()}",
-        name=f"{self.config.threshold}" if self.config.threshold is not None else f"ec_{self.config.edge_count}",
+        name=name,
       )
       wandb.save(f"{clean_dirname}/*", base_path=self.config.output_dir)
 
-    return eap_circuit, result
-
   def run(
       self,
       tl_model: t.nn.Module,
@@ -163,6 +292,32 @@ class EAPRunner:
       corrupted_inputs: t.Tensor,
       corrupted_outputs: List[t.Tensor]
   ):
+    auto_circuit_model, attribution_scores = self.compute_attribution_scores(
+      tl_model, clean_inputs, clean_outputs, corrupted_inputs, corrupted_outputs
+    )
+    if self.normalize_scores:
+      attribution_scores = build_normalized_scores(attribution_scores)
+
+    if self.edge_count is not None:
+      # find the threshold for the top-k edges
+      threshold = get_prune_scores_threshold(attribution_scores, self.edge_count)
+      print(f"Threshold for top-{self.edge_count} edges: {threshold}")
+    else:
+      threshold = self.threshold
+
+    eap_circuit = build_circuit(auto_circuit_model, attribution_scores, threshold, self.config.abs_value_threshold)
+    eap_circuit.save(f"{self.config.output_dir}/final_circuit.pkl")
+
+    return eap_circuit
+
+  def compute_attribution_scores(
+      self,
+      tl_model: t.nn.Module,
+      clean_inputs: t.Tensor,
+      clean_outputs: List[t.Tensor],
+      corrupted_inputs: t.Tensor,
+      corrupted_outputs: List[t.Tensor]
+  ) -> Tuple[PatchableModel, PruneScores]:
     slice_output: OutputSlice = "not_first_seq"  # This drops the first token from the output (e.g., BOS)
     if "ioi" in self.case.get_name():
       slice_output = "last_seq"  # Consider the last token as the output
@@ -185,17 +340,8 @@ class EAPRunner:
     corrupted_outputs = [co.unsqueeze(dim=0)[auto_circuit_model.out_slice].squeeze(dim=0).to(self.config.device)
                          for co in corrupted_outputs]
 
-    dataset = PromptDataset(
-      clean_inputs,
-      corrupted_inputs,
-      clean_outputs,
-      corrupted_outputs,
-    )
-    train_loader = PromptDataLoader(dataset, seq_len=self.case.get_max_seq_len(), diverge_idx=0, batch_size=len(dataset))
-
     eap_args = {
       "model": auto_circuit_model,
-      "dataloader": train_loader,
       "official_edges": None,
       "grad_function": "logit",
       "mask_val": None,
@@ -209,21 +355,59 @@ class EAPRunner:
 
     eap_args["answer_function"] = self.get_answer_function_for_case(tl_model)
 
-    attribution_scores: PruneScores = mask_gradient_prune_scores(**eap_args)
-    if self.normalize_scores:
-      attribution_scores = build_normalized_scores(attribution_scores)
-
-    if self.edge_count is not None:
-      # find the threshold for the top-k edges
-      threshold = prune_scores_threshold(attribution_scores, self.edge_count).item()
-      print(f"Threshold for top-{self.edge_count} edges: {threshold}")
-    else:
-      threshold = self.threshold
+    data_size = len(clean_inputs)
+    batch_size = get_batch_size(tl_model.cfg,
+                                self.case.get_max_seq_len(),
+                                data_size,
+                                batch_size=self.config.batch_size,
+                                max_memory=self.config.max_memory)
+    if batch_size < data_size:
+      print(f"Running EAP on batches of {batch_size} samples")
+
+    steps_per_pass = None
+    if self.integrated_grad_steps is not None and self.config.batch_integrated_grad_steps:
+      steps_per_pass = get_integrated_grad_steps_per_pass(tl_model.cfg,
+                                                          self.case.get_max_seq_len(),
+                                                          batch_size,
+                                                          self.integrated_grad_steps,
+                                                          max_memory=self.config.max_memory)
+      print(f"Running {steps_per_pass} integrated grad steps per forward and backward pass")
+
+    # The loss functions are averages over the samples of a batch, and the scores are linear in the loss. So the scores
+    # of the whole dataset are the average of the scores of each batch, weighted by the batch size.
+    attribution_scores: PruneScores | None = None
+    for start in range(0, data_size, batch_size):
+      end = min(start + batch_size, data_size)
+      dataset = PromptDataset(
+        clean_inputs[start:end],
+        corrupted_inputs[start:end],
+        clean_outputs[start:end],
+        corrupted_outputs[start:end],
+      )
+      train_loader = PromptDataLoader(dataset,
+                                      seq_len=self.case.get_max_seq_len(),
+                                      diverge_idx=0,
+                                      batch_size=len(dataset))
+      if steps_per_pass is not None:
+        batch_scores: PruneScores = batched_integrated_gradients_prune_scores(
+          auto_circuit_model,
+          train_loader,
+          eap_args["answer_function"],
+          self.integrated_grad_steps,
+          steps_per_pass=steps_per_pass,
+        )
+      else:
+        batch_scores: PruneScores = mask_gradient_prune_scores(dataloader=train_loader, **eap_args)
 
-    eap_circuit = build_circuit(auto_circuit_model, attribution_scores, threshold, self.config.abs_value_threshold)
-    eap_circuit.save(f"{self.config.output_dir}/final_circuit.pkl")
+      if batch_size >= data_size:
+        attribution_scores = batch_scores
+      elif attribution_scores is None:
+        attribution_scores = {name: scores * (len(dataset) / data_size) for name, scores in batch_scores.items()}
+      else:
+        for name, scores in batch_scores.items():
+          attribution_scores[name] += scores * (len(dataset) / data_size)
 
-    return eap_circuit
+    return auto_circuit_model, attribution_scores
 
   def get_answer_function_for_case(self, tl_model: t.nn.Module):
     if self.case.is_categorical():
@@ -286,13 +470,32 @@ class EAPRunner:
                         help="Normalize the scores so that they all lie between 0 and 1.")
     parser.add_argument("--abs-val-threshold", action="store_true",
                         help="Use the absolute value of scores for thresholding.")
-
-  def prepare_output_dir(self, ll_model_loader):
-    if self.edge_count is not None:
-      output_suffix = f"{ll_model_loader.get_output_suffix()}/edge_count_{self.edge_count}"
-    else:
-      output_suffix = f"{ll_model_loader.get_output_suffix()}/threshold_{self.threshold}"
-      algorithm = "eap" if self.integrated_grad_steps is None else "integrated_grad"
+    parser.add_argument("--roc", action="store_true",
+                        help="Evaluate the circuits of all the thresholds over the attribution scores, and save their "
+                             "ROC curve instead of a single circuit. --threshold and --edge-count are ignored.")
+    parser.add_argument("--edge-counts", type=int, nargs="+", default=None,
+                        help="Build and evaluate a circuit for each of these edge counts, from the same scores.")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=None,
+                        help="Build and evaluate a circuit for each of these thresholds, from the same scores.")
+    parser.add_argument("--from-scores", action="store_true",
+                        help="Load the attribution scores stored by a previous run with the same case, model, data "
+                             "size, integrated grad steps, loss function and seed, instead of computing them.")
+    add_batching_args(parser)
+    parser.add_argument("--batch-integrated-grad-steps", action="store_true",
+                        help="Stack the interpolation steps of integrated grad along the batch dimension, so that "
+                             "several steps run in a single forward and backward pass. The number of steps per pass "
+                             "is limited by --max-memory, if given.")
+
+  def prepare_output_dir(self, ll_model_loader, output_name: str | None = None):
+    if output_name is None:
+      if self.config.roc:
+        output_name = "roc"
+      elif self.edge_count is not None:
+        output_name = f"edge_count_{self.edge_count}"
+      else:
+        output_name = f"threshold_{self.threshold}"
+    output_suffix = f"{ll_model_loader.get_output_suffix()}/{output_name}"
+    algorithm = "eap" if self.integrated_grad_steps is None else "integrated_grad"
     clean_dirname = f"{self.config.output_dir}/{algorithm}/{self.case.get_name()}/{output_suffix}"
 
     # remove everything in the directory
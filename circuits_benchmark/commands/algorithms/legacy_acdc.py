@@ -6,7 +6,7 @@ import shutil
 from argparse import Namespace
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import Callable, Tuple, Optional, Literal
+from typing import Callable, Tuple, Optional, Literal, List
 
 import numpy as np
 import torch
@@ -27,7 +27,9 @@ from circuits_benchmark.utils.project_paths import get_default_output_dir
 @dataclass
 class ACDCConfig:
     threshold: Optional[float] = 0.025
+    thresholds: Optional[List[float]] = None  # only supported by ACDCRunner, overrides threshold
     data_size: Optional[int] = 1000
+    roc: Optional[bool] = False  # only supported by ACDCRunner
     include_mlp: Optional[bool] = False
     next_token: Optional[bool] = False
     use_pos_embed: Optional[bool] = False
@@ -57,8 +59,10 @@ class ACDCConfig:
     def from_args(args: Namespace) -> "ACDCConfig":
         config = ACDCConfig(
             threshold=args.threshold,
+            thresholds=args.thresholds if "thresholds" in args else None,
             seed=int(args.seed),
             data_size=args.data_size,
+            roc=args.roc if "roc" in args else False,
             include_mlp=args.include_mlp,
             next_token=args.next_token,
             use_pos_embed=args.use_pos_embed,
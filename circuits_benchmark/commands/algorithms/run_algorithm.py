@@ -1,23 +1,24 @@
 import traceback
 
-from circuits_benchmark.commands.algorithms import acdc, legacy_acdc, eap, sp
-from circuits_benchmark.utils.get_cases import get_cases
-from circuits_benchmark.utils.ll_model_loader.ll_model_loader_factory import get_ll_model_loader_from_args
+from circuits_benchmark.commands.lazy_parser import add_lazy_subparsers
 
 
 def setup_args_parser(subparsers):
   run_parser = subparsers.add_parser("run")
-  run_subparsers = run_parser.add_subparsers(dest="algorithm")
-  run_subparsers.required = True
 
-  # Setup arguments for each algorithm
-  legacy_acdc.LegacyACDCRunner.setup_subparser(run_subparsers)
-  acdc.ACDCRunner.setup_subparser(run_subparsers)
-  sp.SPRunner.setup_subparser(run_subparsers)
-  eap.EAPRunner.setup_subparser(run_subparsers)
+  # Setup arguments for each algorithm. The modules of the algorithms are only imported when they are used.
+  add_lazy_subparsers(run_parser, "algorithm", {
+    "legacy_acdc": "circuits_benchmark.commands.algorithms.legacy_acdc:LegacyACDCRunner.add_args_to_parser",
+    "acdc": "circuits_benchmark.commands.algorithms.acdc:ACDCRunner.add_args_to_parser",
+    "sp": "circuits_benchmark.commands.algorithms.sp:SPRunner.add_args_to_parser",
+    "eap": "circuits_benchmark.commands.algorithms.eap:EAPRunner.add_args_to_parser",
+  })
 
 
 def run(args):
+  from circuits_benchmark.utils.get_cases import get_cases
+  from circuits_benchmark.utils.ll_model_loader.ll_model_loader_factory import get_ll_model_loader_from_args
+
   for case in get_cases(args):
     print(f"\nRunning {args.algorithm} on {case}")
 
@@ -25,13 +26,25 @@ def run(args):
 
     try:
       if args.algorithm == "legacy_acdc":
+        from circuits_benchmark.commands.algorithms import legacy_acdc
         legacy_acdc.LegacyACDCRunner(case, args=args).run_using_model_loader(ll_model_loader)
       if args.algorithm == "acdc":
-        acdc.ACDCRunner(case, args=args).run_using_model_loader(ll_model_loader)
+        from circuits_benchmark.commands.algorithms import acdc
+        acdc_runner = acdc.ACDCRunner(case, args=args)
+        if args.roc:
+          acdc_runner.run_roc_using_model_loader(ll_model_loader)
+        else:
+          acdc_runner.run_thresholds_using_model_loader(ll_model_loader)
       if args.algorithm == "sp":
+        from circuits_benchmark.commands.algorithms import sp
         sp.SPRunner(case, args=args).run_using_model_loader(ll_model_loader)
       if args.algorithm == "eap":
-        eap.EAPRunner(case, args=args).run_using_model_loader(ll_model_loader)
+        from circuits_benchmark.commands.algorithms import eap
+        eap_runner = eap.EAPRunner(case, args=args)
+        if args.roc:
+          eap_runner.run_roc_using_model_loader(ll_model_loader)
+        else:
+          eap_runner.run_circuits_using_model_loader(ll_model_loader)
     except Exception as e:
       print(f" >>> Failed to run {args.algorithm} on {case}:")
       traceback.print_exc()
@@ -1,6 +1,7 @@
 import argparse
 
 from circuits_benchmark.commands.algorithms import run_algorithm
+from circuits_benchmark.commands.common_args import resolve_default_device
 from circuits_benchmark.commands.evaluation import evaluation
 from circuits_benchmark.commands.train import train
 
@@ -25,10 +26,12 @@ class ArgumentParserWithOriginals(argparse.ArgumentParser):
     original_args = list(args[0])
     parsed_args = super().parse_args(*args, **kwargs)
     parsed_args.original_args = original_args
+    resolve_default_device(parsed_args)
     return parsed_args
 
   def parse_known_args(self, *args, **kwargs):
     original_args = list(args[0])
     parsed_args, unknown_args = super().parse_known_args(*args, **kwargs)
     parsed_args.original_args = original_args
+    resolve_default_device(parsed_args)
     return parsed_args, unknown_args
@@ -1,4 +1,4 @@
-import torch as t
+from argparse import Namespace
 
 from circuits_benchmark.utils.project_paths import get_default_output_dir
 
@@ -9,12 +9,20 @@ def add_common_args(parser):
                            "If not specified, all cases will be run.")
   parser.add_argument("-o", "--output-dir", type=str, default=get_default_output_dir(),
                       help="The directory to save the results to.")
-  parser.add_argument("-d", "--device", type=str, default="cuda" if t.cuda.is_available() else "cpu",
-                      help="The device to use for experiments.")
+  parser.add_argument("-d", "--device", type=str, default=None,
+                      help="The device to use for experiments. Defaults to cuda if available, otherwise cpu.")
   parser.add_argument('--seed', type=int, default=1234,
                       help='The seed to use for experiments.')
 
 
+def resolve_default_device(args: Namespace):
+  """Sets the default device on parsed args. This is done after parsing, so that building the parser (e.g., for --help)
+  does not need to import torch."""
+  if "device" in args and args.device is None:
+    import torch as t
+    args.device = "cuda" if t.cuda.is_available() else "cpu"
+
+
 def add_evaluation_common_ags(parser):
   parser.add_argument(
     "-w",
@@ -49,4 +57,12 @@ def add_evaluation_common_ags(parser):
     "--same-size",
     action="store_true",
     help="Use for ll model the same size/architecture as ground truth model."
-  )
\ No newline at end of file
+  )
+
+def add_batching_args(parser):
+  parser.add_argument("--batch-size", type=int, default=None,
+                      help="Number of samples per batch. Defaults to a single batch with all the samples, unless "
+                           "--max-memory is given.")
+  parser.add_argument("--max-memory", type=float, default=None,
+                      help="Memory budget (in GB) for the activations of a batch. If --batch-size is not given, the "
+                           "largest batch that is estimated to fit in this budget is used.")
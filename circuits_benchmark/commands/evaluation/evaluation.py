@@ -1,25 +1,25 @@
 import random
 
 import numpy as np
-import torch as t
 
-from circuits_benchmark.commands.evaluation.iit import iit_eval
-from circuits_benchmark.commands.evaluation.realism import node_wise_ablation, gt_circuit_node_wise_ablation
-from circuits_benchmark.utils.get_cases import get_cases
+from circuits_benchmark.commands.lazy_parser import add_lazy_subparsers
 
 
 def setup_args_parser(subparsers):
   run_parser = subparsers.add_parser("eval")
-  run_subparsers = run_parser.add_subparsers(dest="type")
-  run_subparsers.required = True
 
-  # Setup arguments for each evaluation type
-  iit_eval.setup_args_parser(run_subparsers)
-  node_wise_ablation.setup_args_parser(run_subparsers)
-  gt_circuit_node_wise_ablation.setup_args_parser(run_subparsers)
+  # Setup arguments for each evaluation type. The modules of the evaluations are only imported when they are used.
+  add_lazy_subparsers(run_parser, "type", {
+    "iit": "circuits_benchmark.commands.evaluation.iit.iit_eval:add_args_to_parser",
+    "node_realism": "circuits_benchmark.commands.evaluation.realism.node_wise_ablation:add_args_to_parser",
+    "gt_node_realism": "circuits_benchmark.commands.evaluation.realism.gt_circuit_node_wise_ablation:add_args_to_parser",
+  })
 
 
 def run(args):
+  import torch as t
+  from circuits_benchmark.utils.get_cases import get_cases
+
   evaluation_type = args.type
   for case in get_cases(args):
     print(f"\nRunning evaluation {evaluation_type} on {case}")
@@ -32,10 +32,13 @@ def run(args):
     random.seed(seed)
 
     if evaluation_type == "iit":
+      from circuits_benchmark.commands.evaluation.iit import iit_eval
       iit_eval.run_iit_eval(case, args)
     elif evaluation_type == "node_realism":
+      from circuits_benchmark.commands.evaluation.realism import node_wise_ablation
       node_wise_ablation.run_nodewise_ablation(case, args)
     elif evaluation_type == "gt_node_realism":
+      from circuits_benchmark.commands.evaluation.realism import gt_circuit_node_wise_ablation
       gt_circuit_node_wise_ablation.run_nodewise_ablation(case, args)
     else:
       raise ValueError(f"Unknown evaluation: {evaluation_type}")
@@ -5,10 +5,8 @@ import numpy as np
 import torch as t
 
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
+from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
 from circuits_benchmark.commands.common_args import add_common_args, add_evaluation_common_ags
-from circuits_benchmark.transformers.hooked_tracr_transformer import (
-    HookedTracrTransformer,
-)
 from circuits_benchmark.utils.iit.iit_hl_model import IITHLModel
 from iit.model_pairs.base_model_pair import BaseModelPair
 from iit.utils import IITDataset
@@ -22,8 +20,7 @@ from iit.utils.eval_ablations import (
 from circuits_benchmark.utils.ll_model_loader.ll_model_loader_factory import get_ll_model_loader_from_args
 
 
-def setup_args_parser(subparsers):
-    parser = subparsers.add_parser("iit")
+def add_args_to_parser(parser):
     add_common_args(parser)
     add_evaluation_common_ags(parser)
 
@@ -115,9 +112,10 @@ def run_iit_eval(case: BenchmarkCase, args: Namespace):
     output_dir = args.output_dir
     use_mean_cache = args.mean
 
-    hl_model = case.get_hl_model()
-    if isinstance(hl_model, HookedTracrTransformer):
-        hl_model = IITHLModel(hl_model, eval_mode=True)
+    if isinstance(case, TracrBenchmarkCase):
+        hl_model = IITHLModel(case.get_hl_model(compact=True), eval_mode=True)
+    else:
+        hl_model = case.get_hl_model()
 
     ll_model_loader = get_ll_model_loader_from_args(case, args)
     hl_ll_corr, ll_model = ll_model_loader.load_ll_model_and_correspondence(args.device, output_dir=output_dir, same_size=args.same_size)
@@ -5,10 +5,9 @@ import torch
 import wandb
 from transformer_lens import HookedTransformer
 
-from acdc.TLACDCCorrespondence import TLACDCCorrespondence
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
 from circuits_benchmark.commands.common_args import add_common_args, add_evaluation_common_ags
-from circuits_benchmark.utils.circuit.circuit_eval import build_from_acdc_correspondence
+from circuits_benchmark.utils.circuit.circuit_eval import get_full_circuit_from_model
 from circuits_benchmark.utils.circuit.circuit import Circuit
 from circuits_benchmark.utils.circuit.circuit_node import CircuitNode
 from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformer
@@ -21,8 +20,7 @@ from iit.utils.eval_ablations import get_mean_cache, get_circuit_score
 from circuits_benchmark.utils.ll_model_loader.ll_model_loader_factory import LLModelLoader, get_ll_model_loader_from_args
 
 
-def setup_args_parser(subparsers):
-    parser = subparsers.add_parser("gt_node_realism")
+def add_args_to_parser(parser):
     add_common_args(parser)
     add_evaluation_common_ags(parser)
 
@@ -59,10 +57,7 @@ def make_everything_for_task(case: BenchmarkCase, args: Namespace) -> tuple[Hook
 
     ll_model_loader = get_ll_model_loader_from_args(case, args)
     hl_ll_corr, ll_model = ll_model_loader.load_ll_model_and_correspondence(args.device, output_dir=output_dir, same_size=True)
-    full_corr = TLACDCCorrespondence.setup_from_model(
-            ll_model, use_pos_embed=True
-        )
-    full_circuit = build_from_acdc_correspondence(corr=full_corr)
+    full_circuit = get_full_circuit_from_model(ll_model, use_pos_embed=True)
     gt_circuit = get_gt_circuit(hl_ll_corr, full_circuit, ll_model.cfg.n_heads, case)
 
     return hl_model, gt_circuit, ll_model, ll_model_loader
@@ -19,8 +19,7 @@ from iit.utils import IITDataset, index
 from iit.utils.eval_ablations import get_circuit_score, get_mean_cache
 
 
-def setup_args_parser(subparsers):
-    parser = subparsers.add_parser("node_realism")
+def add_args_to_parser(parser):
     add_common_args(parser)
     add_evaluation_common_ags(parser)
 
@@ -0,0 +1,42 @@
+import argparse
+import importlib
+
+
+class LazyArgumentParser(argparse.ArgumentParser):
+  """ArgumentParser for a subcommand whose arguments are added by a function in another module, given as
+  "module:function" (e.g., "circuits_benchmark.commands.algorithms.eap:EAPRunner.add_args_to_parser").
+  The module is only imported when the subcommand is parsed or its help is shown, so that running one subcommand does
+  not import the dependencies of all the others."""
+  def __init__(self, *args, add_args_fn: str | None = None, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.add_args_fn = add_args_fn
+
+  def add_lazy_args(self):
+    if self.add_args_fn is None:
+      return
+
+    module_name, fn_name = self.add_args_fn.split(":")
+    self.add_args_fn = None
+
+    add_args = importlib.import_module(module_name)
+    for attr in fn_name.split("."):
+      add_args = getattr(add_args, attr)
+    add_args(self)
+
+  def parse_known_args(self, *args, **kwargs):
+    self.add_lazy_args()
+    return super().parse_known_args(*args, **kwargs)
+
+  def format_help(self):
+    self.add_lazy_args()
+    return super().format_help()
+
+
+def add_lazy_subparsers(parser: argparse.ArgumentParser, dest: str, add_args_fns: dict[str, str]):
+  """Adds a required subcommand to a parser for each entry in add_args_fns, which maps the subcommand name to the
+  function that adds its arguments (see LazyArgumentParser)."""
+  subparsers = parser.add_subparsers(dest=dest, parser_class=LazyArgumentParser)
+  subparsers.required = True
+
+  for name, add_args_fn in add_args_fns.items():
+    subparsers.add_parser(name, add_args_fn=add_args_fn)
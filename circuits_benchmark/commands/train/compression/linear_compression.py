@@ -15,8 +15,7 @@ from circuits_benchmark.training.training_args import TrainingArgs
 from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformer
 
 
-def setup_args_parser(subparsers):
-  parser = subparsers.add_parser("linear-compression")
+def add_args_to_parser(parser):
   add_common_args(parser)
 
   parser.add_argument("--d-model", type=int, default=None,
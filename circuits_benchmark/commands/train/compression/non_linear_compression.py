@@ -19,8 +19,7 @@ from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracr
 from circuits_benchmark.utils.init_functions import wang_init_method
 
 
-def setup_args_parser(subparsers):
-  parser = subparsers.add_parser("non-linear-compression")
+def add_args_to_parser(parser):
   add_common_args(parser)
 
   parser.add_argument("--d-model", type=int, default=None,
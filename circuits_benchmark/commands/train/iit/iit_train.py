@@ -10,14 +10,17 @@ import torch as t
 import wandb
 
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
+from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
+from circuits_benchmark.benchmark.tracr_memmap_encoded_dataset import TracrMemmapEncodedDataset
 from circuits_benchmark.commands.common_args import add_common_args
-from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformer
+from circuits_benchmark.utils.iit.hl_lookup_table import DEFAULT_HL_LOOKUP_TABLE_MAX_INPUTS, \
+    make_lookup_table_iit_hl_model
 from circuits_benchmark.utils.iit.iit_hl_model import IITHLModel
+from circuits_benchmark.utils.iit.streaming_iit_dataset import StreamingIITDataset
 from iit.utils.iit_dataset import train_test_split, IITDataset
 
 
-def setup_args_parser(subparsers):
-    parser = subparsers.add_parser("iit")
+def add_args_to_parser(parser):
     add_common_args(parser)
 
     # IIT training args
@@ -55,6 +58,28 @@ def setup_args_parser(subparsers):
     parser.add_argument(
         "--num-samples", type=int, default=12000, help="Number of samples"
     )
+    parser.add_argument(
+        "--labelling-mode", choices=["rasp", "hl_model"], default="rasp",
+        help="How to compute the ground truth outputs of Tracr cases: running the RASP program on each sample "
+             "(default), or a batched forward pass of the compiled HL model, which is spot-checked against the RASP "
+             "program",
+    )
+    parser.add_argument(
+        "--memmap-dataset", action="store_true",
+        help="Keep the training data of Tracr cases in memory-mapped files instead of in memory",
+    )
+    parser.add_argument(
+        "--streaming-data", action="store_true",
+        help="Sample the training data of Tracr cases on the fly instead of generating it before training",
+    )
+    parser.add_argument(
+        "--hl-lookup-table", action="store_true",
+        help="Serve the HL model of Tracr cases from a table with its outputs and activations for every possible input",
+    )
+    parser.add_argument(
+        "--hl-lookup-table-max-inputs", type=int, default=DEFAULT_HL_LOOKUP_TABLE_MAX_INPUTS,
+        help="Cases with more possible inputs than this use the HL model instead of a lookup table",
+    )
 
     parser.add_argument(
         "--use-wandb", action="store_true", help="Use wandb"
@@ -121,6 +146,11 @@ def run_iit_train(case: BenchmarkCase, args: Namespace):
             **wandb.config,
             "wandb_suffix": args.wandb_suffix,
             "device": "cpu" if args.device == "cpu" else "cuda",
+            "labelling_mode": args.labelling_mode,
+            "memmap_dataset": args.memmap_dataset,
+            "streaming_data": args.streaming_data,
+            "hl_lookup_table": args.hl_lookup_table,
+            "hl_lookup_table_max_inputs": args.hl_lookup_table_max_inputs,
         }
         train_model(case, config, use_wandb=True)
 
@@ -173,6 +203,11 @@ def run_iit_train(case: BenchmarkCase, args: Namespace):
             "batch_size": args.batch_size,
             "include_mlp": args.include_mlp,
             "detach_while_caching": not args.backprop_on_cache,
+            "labelling_mode": args.labelling_mode,
+            "memmap_dataset": args.memmap_dataset,
+            "streaming_data": args.streaming_data,
+            "hl_lookup_table": args.hl_lookup_table,
+            "hl_lookup_table_max_inputs": args.hl_lookup_table_max_inputs,
         }
 
         args = argparse.Namespace(**config)
@@ -248,13 +283,21 @@ def train_model(
 
     ll_model = case.get_ll_model(same_size=args.same_size)
 
-    hl_model = case.get_hl_model()
-    if isinstance(hl_model, HookedTracrTransformer):
-        hl_model = IITHLModel(hl_model, eval_mode=False)
-        hl_model.to(args.device)
-
     hl_ll_corr = case.get_correspondence(include_mlp=args.include_mlp, same_size=args.same_size)
 
+    if isinstance(case, TracrBenchmarkCase):
+        # the compact HL model has a narrower residual stream, so each training step is cheaper. Its outputs match the
+        # full model up to floating-point error, and the dataset targets still come from the full model
+        hl_model = case.get_hl_model(device=args.device, compact=True)
+        if args.hl_lookup_table:
+            hook_names = sorted({hl_node.name for hl_node in hl_ll_corr.keys()})
+            hl_model = make_lookup_table_iit_hl_model(case, hl_model, hook_names,
+                                                      max_inputs=args.hl_lookup_table_max_inputs)
+        else:
+            hl_model = IITHLModel(hl_model, eval_mode=False)
+    else:
+        hl_model = case.get_hl_model(device=args.device)
+
     model_pair = case.build_model_pair(
         training_args=training_args,
         ll_model=ll_model,
@@ -263,12 +306,33 @@ def train_model(
     )
 
     # prepare iit datasets for training and testing
-    dataset = case.get_clean_data(min_samples=20000, max_samples=120_000, seed=args.seed)
-    train_dataset, test_dataset = train_test_split(
-        dataset, test_size=0.2, random_state=42
-    )
-    train_dataset = IITDataset(train_dataset, train_dataset, seed=args.seed)
-    test_dataset = IITDataset(test_dataset, test_dataset, seed=args.seed)
+    if args.streaming_data and isinstance(case, TracrBenchmarkCase):
+        # training data is sampled on the fly, with the same number of samples per epoch as the regular split below
+        train_dataset = StreamingIITDataset(
+            case.get_streaming_clean_data(seed=args.seed, samples_per_epoch=96_000,
+                                          labelling_mode=args.labelling_mode),
+            case.get_streaming_clean_data(seed=args.seed + 1, samples_per_epoch=96_000,
+                                          labelling_mode=args.labelling_mode),
+            device=args.device,
+        )
+        test_dataset = case.get_clean_data(max_samples=24_000, seed=args.seed + 2,
+                                           labelling_mode=args.labelling_mode)
+        test_dataset = IITDataset(test_dataset, test_dataset, seed=args.seed)
+    else:
+        data_kwargs = {}
+        if isinstance(case, TracrBenchmarkCase):
+            data_kwargs["labelling_mode"] = args.labelling_mode
+            data_kwargs["memmap_dataset"] = args.memmap_dataset
+        dataset = case.get_clean_data(min_samples=20000, max_samples=120_000, seed=args.seed, **data_kwargs)
+        if isinstance(dataset, TracrMemmapEncodedDataset):
+            # split by index ranges, so that the data stays in the memory-mapped files
+            train_dataset, test_dataset = dataset.split(test_size=0.2)
+        else:
+            train_dataset, test_dataset = train_test_split(
+                dataset, test_size=0.2, random_state=42
+            )
+        train_dataset = IITDataset(train_dataset, train_dataset, seed=args.seed)
+        test_dataset = IITDataset(test_dataset, test_dataset, seed=args.seed)
 
     # train model
     print("Starting IIT training")
@@ -1,28 +1,25 @@
 import random
 
 import numpy as np
-import torch as t
 
-from circuits_benchmark.commands.train.compression import linear_compression, \
-  non_linear_compression
-from circuits_benchmark.commands.train.compression.linear_compression import train_linear_compression
-from circuits_benchmark.commands.train.compression.non_linear_compression import train_non_linear_compression
-from circuits_benchmark.commands.train.iit import iit_train
-from circuits_benchmark.utils.get_cases import get_cases
+from circuits_benchmark.commands.lazy_parser import add_lazy_subparsers
 
 
 def setup_args_parser(subparsers):
   run_parser = subparsers.add_parser("train")
-  run_subparsers = run_parser.add_subparsers(dest="type")
-  run_subparsers.required = True
 
-  # Setup arguments for each algorithm
-  linear_compression.setup_args_parser(run_subparsers)
-  non_linear_compression.setup_args_parser(run_subparsers)
-  iit_train.setup_args_parser(run_subparsers)
+  # Setup arguments for each algorithm. The modules of the algorithms are only imported when they are used.
+  add_lazy_subparsers(run_parser, "type", {
+    "linear-compression": "circuits_benchmark.commands.train.compression.linear_compression:add_args_to_parser",
+    "non-linear-compression": "circuits_benchmark.commands.train.compression.non_linear_compression:add_args_to_parser",
+    "iit": "circuits_benchmark.commands.train.iit.iit_train:add_args_to_parser",
+  })
 
 
 def run(args):
+  import torch as t
+  from circuits_benchmark.utils.get_cases import get_cases
+
   training_type = args.type
 
   cases = get_cases(args)
@@ -39,10 +36,13 @@ def run(args):
     random.seed(seed)
 
     if training_type == "linear-compression":
+      from circuits_benchmark.commands.train.compression.linear_compression import train_linear_compression
       train_linear_compression(case, args)
     elif training_type == "non-linear-compression":
+      from circuits_benchmark.commands.train.compression.non_linear_compression import train_non_linear_compression
       train_non_linear_compression(case, args)
     elif training_type == "iit":
+      from circuits_benchmark.commands.train.iit import iit_train
       iit_train.run_iit_train(case, args)
     else:
       raise ValueError(f"Unknown training: {training_type}")
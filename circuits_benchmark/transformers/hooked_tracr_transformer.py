@@ -1,22 +1,26 @@
 from __future__ import annotations
 
-from typing import List, Literal, Any, Union, Callable, Optional, Dict
+import itertools
+import warnings
+from typing import List, Literal, Any, Union, Callable, Optional, Dict, TYPE_CHECKING
 
-import einops
-import jax.numpy as jnp
 import numpy as np
 import torch as t
 from jaxtyping import Float
 from torch import Tensor
 from transformer_lens import HookedTransformerConfig, HookedTransformer
 
-from tracr.compiler.assemble import AssembledTransformerModel
-from tracr.craft import vectorspace_fns
 from tracr.craft.bases import BasisDirection, VectorSpaceWithBasis
 from tracr.transformer.encoder import CategoricalEncoder, Encoder
 
 from circuits_benchmark.benchmark.tracr_dataset import TracrBatchInput
 
+if TYPE_CHECKING:
+  # Only needed for type hints, so that models loaded from a TracrBuildArtifact don't import JAX.
+  import jax.numpy as jnp
+  from tracr.compiler.assemble import AssembledTransformerModel
+  from circuits_benchmark.benchmark.tracr_build_cache import TracrBuildArtifact
+
 HookedTracrTransformerBatchInput = TracrBatchInput | np.ndarray
 HookedTracrTransformerReturnType = Literal["logits", "decoded"]
 
@@ -38,6 +42,7 @@ class HookedTracrTransformer(HookedTransformer):
     self.tracr_output_encoder = tracr_output_encoder
     self.residual_stream_labels = residual_stream_labels
     self.normalize_output = False
+    self.build_tracr_io_tables()
 
     if "use_hook_mlp_in" in self.cfg.to_dict():  # Tracr models always include MLPs
       self.set_use_hook_mlp_in(True)
@@ -67,6 +72,27 @@ class HookedTracrTransformer(HookedTransformer):
 
     return tl_model
 
+  @classmethod
+  def from_tracr_build_artifact(
+      cls,
+      artifact: TracrBuildArtifact,
+      device: t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu"),
+      *args, **kwargs
+  ) -> HookedTracrTransformer:
+    """
+    Initialize a HookedTracrTransformer from a cached Tracr build, without the Tracr model.
+    """
+    cfg = HookedTransformerConfig.from_dict(artifact.cfg_dict)
+    cfg.device = device
+    tl_model = cls(cfg,
+                   artifact.input_encoder,
+                   artifact.output_encoder,
+                   artifact.residual_labels,
+                   *args, **kwargs)
+    tl_model.load_tracr_state_dict(artifact.state_dict)
+
+    return tl_model
+
   @classmethod
   def from_hooked_tracr_transformer(cls,
                                     tl_model,
@@ -95,6 +121,50 @@ class HookedTracrTransformer(HookedTransformer):
 
     return instance
 
+  def compact(self) -> HookedTracrTransformer:
+    """Returns a model whose residual stream only keeps the dimensions that are both written (by the embeddings,
+    attention outputs or MLP outputs) and read (by the attention inputs, MLP inputs or unembed).
+    Tracr residual streams are wide and sparse, so this usually makes the model several times narrower. The other
+    dimensions can not affect the output: they are either always zero or never read. The kept dimensions may be summed
+    in a different order, so the logits (and the decoded outputs of numerical models) match the original model up to
+    floating-point error, within an absolute tolerance of 1e-5. Decoded categorical outputs are the same unless two
+    logits are within that tolerance of each other.
+    Only models without layer norm can be compacted, since dropping dimensions changes the norm of the residual."""
+    if self.cfg.normalization_type is not None:
+      raise ValueError("Only models without layer norm can be compacted.")
+
+    # residual axis of each weight that writes to or reads from the residual stream
+    writer_axes = {"embed.W_E": 1, "pos_embed.W_pos": 1}
+    reader_axes = {"unembed.W_U": 0}
+    for l in range(self.cfg.n_layers):
+      writer_axes.update({f"blocks.{l}.attn.W_O": 2, f"blocks.{l}.attn.b_O": 0,
+                          f"blocks.{l}.mlp.W_out": 1, f"blocks.{l}.mlp.b_out": 0})
+      reader_axes.update({f"blocks.{l}.attn.W_Q": 1, f"blocks.{l}.attn.W_K": 1, f"blocks.{l}.attn.W_V": 1,
+                          f"blocks.{l}.mlp.W_in": 0})
+
+    sd = self.state_dict()
+
+    def used_dims(axes: Dict[str, int]) -> Tensor:
+      used = t.zeros(self.cfg.d_model, dtype=t.bool, device=self.cfg.device)
+      for k, axis in axes.items():
+        used |= (sd[k] != 0).movedim(axis, 0).reshape(self.cfg.d_model, -1).any(dim=1)
+      return used
+
+    kept_dims = t.nonzero(used_dims(writer_axes) & used_dims(reader_axes)).flatten()
+
+    cfg_dict = self.cfg.to_dict().copy()
+    cfg_dict["d_model"] = len(kept_dims)
+    instance = self.__class__(HookedTransformerConfig.from_dict(cfg_dict),
+                              self.tracr_input_encoder,
+                              self.tracr_output_encoder,
+                              [self.residual_stream_labels[i] for i in kept_dims.tolist()])
+
+    residual_axes = {**writer_axes, **reader_axes}
+    instance.load_state_dict({k: v.index_select(residual_axes[k], kept_dims) if k in residual_axes else v
+                              for k, v in sd.items()})
+
+    return instance
+
   def load_weights_from_file(self, path: str):
     """Loads the transformer weights from file."""
     self.load_state_dict(t.load(path, map_location=self.device))
@@ -140,10 +210,44 @@ class HookedTracrTransformer(HookedTransformer):
     else:
       return self.map_tl_output_to_tracr_output(logits)
 
+  def build_tracr_io_tables(self) -> None:
+    """Builds the lookup tables used to encode tracr inputs and decode tracr outputs for whole batches at once:
+    a token -> id dict for the inputs and, for categorical outputs, an id -> value array for the outputs."""
+    self.tracr_input_encoding_map: Dict[Any, int] = dict(self.tracr_input_encoder.encoding_map)
+    self.tracr_input_bos_id = self.tracr_input_encoding_map[self.tracr_input_encoder.bos_token]
+
+    self.tracr_output_decoding_table: np.ndarray | None = None
+    if self.is_categorical():
+      encoding_map = self.tracr_output_encoder.encoding_map
+      self.tracr_output_decoding_table = np.empty(len(encoding_map), dtype=object)
+      for value, idx in encoding_map.items():
+        self.tracr_output_decoding_table[idx] = value
+
   def map_tracr_input_to_tl_input(self, batch_input: HookedTracrTransformerBatchInput) -> t.Tensor:
-    """Maps a tracr input to a transformer_lens input."""
-    encoding = [self.tracr_input_encoder.encode(input) for input in batch_input]
-    return t.tensor(encoding)
+    """Maps a tracr input to a transformer_lens input.
+    Inputs that are already integer arrays or tensors are taken as token ids and only converted to a tensor."""
+    if isinstance(batch_input, t.Tensor):
+      return batch_input.long()
+    if isinstance(batch_input, np.ndarray) and np.issubdtype(batch_input.dtype, np.integer):
+      return t.from_numpy(batch_input.astype(np.int64, copy=False))
+
+    seq_lens = set(len(input) for input in batch_input)
+    if len(seq_lens) != 1:
+      # ragged batches can not be stacked, let the tracr encoder produce the error (or the encoding) for each input
+      return t.tensor([self.tracr_input_encoder.encode(input) for input in batch_input])
+
+    # A single lookup pass over the flattened batch, instead of one encoder call per input
+    try:
+      ids = np.fromiter(map(self.tracr_input_encoding_map.__getitem__, itertools.chain.from_iterable(batch_input)),
+                        dtype=np.int64)
+    except KeyError as e:
+      raise ValueError(f"Input token {e.args[0]!r} is not in the vocabulary of the model.") from e
+
+    ids = ids.reshape(len(batch_input), seq_lens.pop())
+    if not (ids[:, 0] == self.tracr_input_bos_id).all():
+      raise ValueError(f"First input token must be BOS ({self.tracr_input_encoder.bos_token}).")
+
+    return t.from_numpy(ids)
 
   def map_tl_output_to_tracr_output(self, logits: t.Tensor) -> HookedTracrTransformerBatchInput:
     """Maps a transformer_lens output to a tracr output."""
@@ -152,27 +256,54 @@ class HookedTracrTransformer(HookedTransformer):
     else:
       logits = logits.squeeze(dim=-1)
 
-    # The output has unspecified behavior for the BOS token, so we remove it and add it back in after decoding.
-    bos_token = self.tracr_input_encoder.bos_token
-    logits = logits[:, 1:]
-    decoded_output_with_bos = [[bos_token] + self.tracr_output_encoder.decode(output)
-                               for output in logits.tolist()]
+    # The output has unspecified behavior for the BOS token, so we replace it with BOS after decoding.
+    values = logits[:, 1:].detach().cpu().numpy()
+    if self.tracr_output_decoding_table is not None:
+      values = self.tracr_output_decoding_table[values]
+
+    decoded_output_with_bos = np.empty((values.shape[0], values.shape[1] + 1), dtype=object)
+    decoded_output_with_bos[:, 0] = self.tracr_input_encoder.bos_token
+    decoded_output_with_bos[:, 1:] = values
 
-    return decoded_output_with_bos
+    return decoded_output_with_bos.tolist()
 
   def load_weights_from_tracr_model(self, tracr_model: AssembledTransformerModel) -> None:
     """Loads the weights from a tracr model into the transformer_lens model."""
     self.load_tracr_state_dict(self.extract_tracr_state_dict(tracr_model))
 
-  def load_tracr_state_dict(self, sd: dict[str, np.ndarray | jnp.ndarray]) -> None:
-    """Creates a transformer_lens model from a config and state dict."""
+  def load_tracr_state_dict(self, sd: dict[str, np.ndarray | jnp.ndarray | Tensor]) -> None:
+    """Loads a state dict with Tracr weights into the transformer_lens model.
+    Each weight is copied once, straight into the already allocated parameter (converting dtype and device on the way).
+    Keys that are not in the model are ignored, and weights whose shape differs from the parameter raise a ValueError
+    (copy_ would otherwise broadcast them)."""
+    params = self.state_dict()
+    with t.no_grad():
+      for k, v in sd.items():
+        if k in params:
+          tensor = self.tracr_param_to_tensor(v)
+          if tensor.shape != params[k].shape:
+            raise ValueError(f"Size mismatch for {k}: copying a param with shape {tuple(tensor.shape)}, the shape in "
+                             f"the current model is {tuple(params[k].shape)}.")
+          params[k].copy_(tensor)
 
-    # Convert weights to tensors and load into the tl_model
-    for k, v in sd.items():
-      # Map Jax array to numpy array
-      sd[k] = t.tensor(np.array(v)).to(self.device)
-
-    self.load_state_dict(sd, strict=False)
+  @staticmethod
+  def tracr_param_to_tensor(param: np.ndarray | jnp.ndarray | Tensor) -> Tensor:
+    """Returns a tensor that shares memory with a Tracr parameter (a NumPy or JAX array) whenever the array allows it.
+    The tensor is only meant to be read: read-only arrays are wrapped without copying them."""
+    if isinstance(param, Tensor):
+      return param
+
+    if not isinstance(param, np.ndarray) and hasattr(param, "__dlpack__"):
+      try:
+        return t.from_dlpack(param)
+      except (BufferError, RuntimeError, TypeError):
+        pass
+
+    param = np.asarray(param)
+    with warnings.catch_warnings():
+      # arrays coming from JAX are read-only
+      warnings.simplefilter("ignore")
+      return t.from_numpy(param)
 
   @classmethod
   def extract_tracr_config(cls, model: AssembledTransformerModel) -> HookedTransformerConfig:
@@ -214,68 +345,57 @@ class HookedTracrTransformer(HookedTransformer):
       # device=device,
     )
 
-  def extract_tracr_state_dict(self, model: AssembledTransformerModel) -> dict[str, np.ndarray | jnp.ndarray]:
-    """Extracts the state dict of a tracr model into a dict."""
+  def extract_tracr_state_dict(self, model: AssembledTransformerModel) -> dict[str, Tensor]:
+    """Extracts the state dict of a tracr model into a dict.
+    The weights are views of the Tracr parameters rearranged to the transformer_lens layout on the torch side, so no
+    copies are made until they are loaded into a model."""
+    def param(name: str, key: str) -> Tensor:
+      return self.tracr_param_to_tensor(model.params[name][key])
+
+    n_heads, d_head = self.cfg.n_heads, self.cfg.d_head
+
     sd = {}
-    sd["pos_embed.W_pos"] = model.params["pos_embed"]['embeddings']
-    sd["embed.W_E"] = model.params["token_embed"]['embeddings']
+    sd["pos_embed.W_pos"] = param("pos_embed", "embeddings")
+    sd["embed.W_E"] = param("token_embed", "embeddings")
+    sd["unembed.W_U"] = self.build_tracr_unembed_matrix(model)
+
+    for l in range(self.cfg.n_layers):
+      for tracr_name, tl_name in [("key", "K"), ("query", "Q"), ("value", "V")]:
+        # d_model (n_heads d_head) -> n_heads d_model d_head
+        w = param(f"transformer/layer_{l}/attn/{tracr_name}", "w")
+        sd[f"blocks.{l}.attn.W_{tl_name}"] = w.view(w.shape[0], n_heads, d_head).permute(1, 0, 2)
+        # (n_heads d_head) -> n_heads d_head
+        b = param(f"transformer/layer_{l}/attn/{tracr_name}", "b")
+        sd[f"blocks.{l}.attn.b_{tl_name}"] = b.view(n_heads, d_head)
+
+      # (n_heads d_head) d_model -> n_heads d_head d_model
+      w_o = param(f"transformer/layer_{l}/attn/linear", "w")
+      sd[f"blocks.{l}.attn.W_O"] = w_o.view(n_heads, d_head, w_o.shape[1])
+      sd[f"blocks.{l}.attn.b_O"] = param(f"transformer/layer_{l}/attn/linear", "b")
+
+      sd[f"blocks.{l}.mlp.W_in"] = param(f"transformer/layer_{l}/mlp/linear_1", "w")
+      sd[f"blocks.{l}.mlp.b_in"] = param(f"transformer/layer_{l}/mlp/linear_1", "b")
+      sd[f"blocks.{l}.mlp.W_out"] = param(f"transformer/layer_{l}/mlp/linear_2", "w")
+      sd[f"blocks.{l}.mlp.b_out"] = param(f"transformer/layer_{l}/mlp/linear_2", "b")
+
+    return sd
 
-    # fetch output space and project residual space onto it to get the unembed matrix
+  def build_tracr_unembed_matrix(self, model: AssembledTransformerModel) -> Tensor:
+    """Returns the unembed matrix, which projects the residual space onto the output space. This is the same matrix as
+    `vectorspace_fns.project(residual_space, output_space).matrix`, built by indexing instead of basis by basis."""
     residual_space = self.get_tracr_model_residual_space(model)
     output_space = self.get_tracr_model_output_space(model)
-    sd["unembed.W_U"] = vectorspace_fns.project(residual_space, output_space).matrix
+    residual_index = {direction: i for i, direction in enumerate(residual_space.basis)}
 
-    for l in range(self.cfg.n_layers):
-      sd[f"blocks.{l}.attn.W_K"] = einops.rearrange(
-        model.params[f"transformer/layer_{l}/attn/key"]["w"],
-        "d_model (n_heads d_head) -> n_heads d_model d_head",
-        d_head=self.cfg.d_head,
-        n_heads=self.cfg.n_heads
-      )
-      sd[f"blocks.{l}.attn.b_K"] = einops.rearrange(
-        model.params[f"transformer/layer_{l}/attn/key"]["b"],
-        "(n_heads d_head) -> n_heads d_head",
-        d_head=self.cfg.d_head,
-        n_heads=self.cfg.n_heads
-      )
-      sd[f"blocks.{l}.attn.W_Q"] = einops.rearrange(
-        model.params[f"transformer/layer_{l}/attn/query"]["w"],
-        "d_model (n_heads d_head) -> n_heads d_model d_head",
-        d_head=self.cfg.d_head,
-        n_heads=self.cfg.n_heads
-      )
-      sd[f"blocks.{l}.attn.b_Q"] = einops.rearrange(
-        model.params[f"transformer/layer_{l}/attn/query"]["b"],
-        "(n_heads d_head) -> n_heads d_head",
-        d_head=self.cfg.d_head,
-        n_heads=self.cfg.n_heads
-      )
-      sd[f"blocks.{l}.attn.W_V"] = einops.rearrange(
-        model.params[f"transformer/layer_{l}/attn/value"]["w"],
-        "d_model (n_heads d_head) -> n_heads d_model d_head",
-        d_head=self.cfg.d_head,
-        n_heads=self.cfg.n_heads
-      )
-      sd[f"blocks.{l}.attn.b_V"] = einops.rearrange(
-        model.params[f"transformer/layer_{l}/attn/value"]["b"],
-        "(n_heads d_head) -> n_heads d_head",
-        d_head=self.cfg.d_head,
-        n_heads=self.cfg.n_heads
-      )
-      sd[f"blocks.{l}.attn.W_O"] = einops.rearrange(
-        model.params[f"transformer/layer_{l}/attn/linear"]["w"],
-        "(n_heads d_head) d_model -> n_heads d_head d_model",
-        d_head=self.cfg.d_head,
-        n_heads=self.cfg.n_heads
-      )
-      sd[f"blocks.{l}.attn.b_O"] = model.params[f"transformer/layer_{l}/attn/linear"]["b"]
-
-      sd[f"blocks.{l}.mlp.W_in"] = model.params[f"transformer/layer_{l}/mlp/linear_1"]["w"]
-      sd[f"blocks.{l}.mlp.b_in"] = model.params[f"transformer/layer_{l}/mlp/linear_1"]["b"]
-      sd[f"blocks.{l}.mlp.W_out"] = model.params[f"transformer/layer_{l}/mlp/linear_2"]["w"]
-      sd[f"blocks.{l}.mlp.b_out"] = model.params[f"transformer/layer_{l}/mlp/linear_2"]["b"]
+    rows, cols = [], []
+    for col, direction in enumerate(output_space.basis):
+      if direction in residual_index:
+        rows.append(residual_index[direction])
+        cols.append(col)
 
-    return sd
+    w_u = t.zeros((residual_space.num_dims, output_space.num_dims))
+    w_u[rows, cols] = 1
+    return w_u
 
   def get_tracr_model_residual_space(self, model: AssembledTransformerModel) -> VectorSpaceWithBasis:
     residual_space = []
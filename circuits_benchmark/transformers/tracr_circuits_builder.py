@@ -13,6 +13,10 @@ from tracr.craft.bases import VectorSpaceWithBasis
 from tracr.craft.transformers import SeriesWithResiduals, MultiAttentionHead, AttentionHead, MLP
 from tracr.rasp.rasp import Aggregate, Selector
 
+# Node attribute of simplified Tracr graphs with the label of the Aggregate expression that uses a Selector. This is
+# the only information about the RASP expressions that we need to build the circuits.
+SELECTOR_AGGREGATE_LABEL = "SELECTOR_AGGREGATE_LABEL"
+
 @dataclass
 class TracrCircuits:
   tracr_variables_circuit: Circuit
@@ -91,34 +95,30 @@ def build_tracr_circuits(tracr_graph: DiGraph,
       for ll_node in alignment.get_ll_nodes(label):
         assert ll_node in tracr_transformer_circuit.nodes, f"Node {ll_node} not found in circuit"
     else:
-      # This is a label for which we don't have a component
-      expr = label_data[nodes.EXPR]
-      if isinstance(expr, Selector):
-        # Selectors are computed in Q-K matrices. Let's find the Aggregate expression that uses this selector, and
-        # then find the component implementing the Aggregate expression.
-        for other_label, other_label_data in nodes_with_data:
-          other_expr = other_label_data[nodes.EXPR]
-          if isinstance(other_expr, Aggregate) and other_expr.selector == expr:
-            ll_nodes = alignment.get_ll_nodes(other_label, remove_predecessors_by_ll_circuit=tracr_transformer_circuit)
-            assert len(ll_nodes) > 0, f"No nodes found for label {other_label}"
-            for ll_node in ll_nodes:
-              if granularity == "component":
-                # the same output node is the one that implements both the selector and the aggregate
-                assert ll_node in tracr_transformer_circuit.nodes, f"Node {ll_node} not found in circuit"
-                alignment.map_hl_to_ll(label, ll_node)
-              elif granularity == "matrix":
-                # the selector is implemented by the nodes that are input for the aggregate
-                for pred_node in tracr_transformer_circuit.predecessors(ll_node):
-                  if "W_Q" in pred_node.name or "W_K" in pred_node.name:
-                    alignment.map_hl_to_ll(label, pred_node)
-              elif granularity == "acdc_hooks" or granularity == "sp_hooks":
-                # the selector is implemented by the nodes that are input for the aggregate
-                for pred_node in tracr_transformer_circuit.predecessors(ll_node):
-                  if "hook_q" in pred_node.name or "hook_k" in pred_node.name:
-                    alignment.map_hl_to_ll(label, pred_node)
-              else:
-                raise ValueError(f"Granularity {granularity} not supported for Select expressions")
-            break
+      # This is a label for which we don't have a component.
+      # Selectors are computed in Q-K matrices. Let's find the Aggregate expression that uses this selector, and
+      # then find the component implementing the Aggregate expression.
+      aggregate_label = get_selector_aggregate_label(label_data, nodes_with_data)
+      if aggregate_label is not None:
+        ll_nodes = alignment.get_ll_nodes(aggregate_label, remove_predecessors_by_ll_circuit=tracr_transformer_circuit)
+        assert len(ll_nodes) > 0, f"No nodes found for label {aggregate_label}"
+        for ll_node in ll_nodes:
+          if granularity == "component":
+            # the same output node is the one that implements both the selector and the aggregate
+            assert ll_node in tracr_transformer_circuit.nodes, f"Node {ll_node} not found in circuit"
+            alignment.map_hl_to_ll(label, ll_node)
+          elif granularity == "matrix":
+            # the selector is implemented by the nodes that are input for the aggregate
+            for pred_node in tracr_transformer_circuit.predecessors(ll_node):
+              if "W_Q" in pred_node.name or "W_K" in pred_node.name:
+                alignment.map_hl_to_ll(label, pred_node)
+          elif granularity == "acdc_hooks" or granularity == "sp_hooks":
+            # the selector is implemented by the nodes that are input for the aggregate
+            for pred_node in tracr_transformer_circuit.predecessors(ll_node):
+              if "hook_q" in pred_node.name or "hook_k" in pred_node.name:
+                alignment.map_hl_to_ll(label, pred_node)
+          else:
+            raise ValueError(f"Granularity {granularity} not supported for Select expressions")
 
   return TracrCircuits(tracr_variables_circuit, tracr_transformer_circuit, alignment)
 
@@ -273,6 +273,38 @@ def get_hl_labels_from_input_spaces(input_spaces: list[VectorSpaceWithBasis]) ->
   return list(hl_labels)
 
 
+def get_selector_aggregate_label(label_data: dict, nodes_with_data: list) -> str | None:
+  """Returns the label of the first Aggregate expression that uses the Selector of a node, or None if the node is not
+  a Selector (or no Aggregate uses it). Works for both full and simplified Tracr graphs."""
+  if SELECTOR_AGGREGATE_LABEL in label_data:
+    return label_data[SELECTOR_AGGREGATE_LABEL]
+
+  expr = label_data.get(nodes.EXPR)
+  if isinstance(expr, Selector):
+    for other_label, other_label_data in nodes_with_data:
+      other_expr = other_label_data.get(nodes.EXPR)
+      if isinstance(other_expr, Aggregate) and other_expr.selector == expr:
+        return other_label
+
+  return None
+
+
+def simplify_tracr_graph(tracr_graph: DiGraph) -> DiGraph:
+  """Returns a copy of a Tracr graph with only the node information used by build_tracr_circuits. Unlike the original
+  graph, the copy does not hold RASP expressions, so it can be pickled."""
+  nodes_with_data = list(tracr_graph.nodes(data=True))
+
+  simplified_graph = DiGraph()
+  for label, label_data in nodes_with_data:
+    simplified_label_data = {SELECTOR_AGGREGATE_LABEL: get_selector_aggregate_label(label_data, nodes_with_data)}
+    if nodes.MODEL_BLOCK in label_data:
+      simplified_label_data[nodes.MODEL_BLOCK] = label_data[nodes.MODEL_BLOCK]
+    simplified_graph.add_node(label, **simplified_label_data)
+
+  simplified_graph.add_edges_from(tracr_graph.edges)
+  return simplified_graph
+
+
 def build_tracr_variables_circuit(tracr_graph: DiGraph) -> Circuit:
   hl_circuit = Circuit()
 
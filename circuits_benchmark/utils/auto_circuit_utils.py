@@ -1,8 +1,93 @@
-from auto_circuit.types import PruneScores
+import os
+import weakref
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch as t
+from auto_circuit.data import PromptDataLoader, PromptPairBatch
+from auto_circuit.types import AblationType, PruneScores
+from auto_circuit.utils.ablation_activations import batch_src_ablations
+from auto_circuit.utils.graph_utils import patch_mode, set_mask_batch_size, train_mask_mode
 from auto_circuit.utils.patchable_model import PatchableModel
+from auto_circuit.utils.tensor_ops import batch_avg_answer_diff
+from transformer_lens import HookedTransformerConfig
 
 from circuits_benchmark.utils.circuit.circuit import Circuit
 from circuits_benchmark.utils.circuit.circuit_node import CircuitNode
+from circuits_benchmark.utils.circuit.compact_circuit import CircuitEdge
+
+# Rough number of copies of each activation that auto_circuit keeps per sample: clean and corrupted activations, and the
+# activations and gradients of the forward and backward passes.
+ACTIVATION_COPIES_PER_SAMPLE = 4
+
+
+class PatchableModelEdgeTable:
+  """The edges of a patchable model (in the order of model.edges), as CircuitEdges, and the position of the score of
+  each edge in the flattened prune scores (see flatten_prune_scores). Tables are built once per model, so that the
+  scores of all the edges can be read with a single indexing operation instead of a Python loop over the edges."""
+
+  def __init__(self, model: PatchableModel):
+    mask_shapes = {wrapper.module_name: tuple(wrapper.patch_mask.shape) for wrapper in model.dest_wrappers}
+    self.module_names: Tuple[str, ...] = tuple(sorted(mask_shapes.keys()))
+    self.mask_shapes: Tuple[Tuple[int, ...], ...] = tuple(mask_shapes[name] for name in self.module_names)
+
+    offsets = {}
+    offset = 0
+    for name, shape in zip(self.module_names, self.mask_shapes):
+      offsets[name] = offset
+      offset += int(np.prod(shape, dtype=np.int64))
+
+    self.edges: List[CircuitEdge] = []
+    flat_indices = []
+    for edge in model.edges:
+      self.edges.append((CircuitNode(edge.src.module_name, edge.src.head_idx),
+                         CircuitNode(edge.dest.module_name, edge.dest.head_idx)))
+      flat_indices.append(offsets[edge.dest.module_name] +
+                          int(np.ravel_multi_index(edge.patch_idx, mask_shapes[edge.dest.module_name])))
+    self.flat_indices = t.tensor(flat_indices, dtype=t.long)
+
+  @classmethod
+  def for_model(cls, model: PatchableModel) -> "PatchableModelEdgeTable":
+    table = _edge_tables.get(model)
+    if table is None:
+      table = cls(model)
+      _edge_tables[model] = table
+    return table
+
+  def flatten(self, attribution_scores: PruneScores) -> t.Tensor:
+    """Returns the scores of all the modules of the model, flattened and concatenated in the order of the table."""
+    return flatten_prune_scores(attribution_scores, self.module_names)
+
+  def get_scores(self, attribution_scores: PruneScores) -> t.Tensor:
+    """Returns the score of each edge of the table."""
+    for name, shape in zip(self.module_names, self.mask_shapes):
+      if tuple(attribution_scores[name].shape) != shape:
+        raise ValueError(f"Expected scores of shape {shape} for {name}, got {tuple(attribution_scores[name].shape)}.")
+
+    flat_scores = self.flatten(attribution_scores)
+    return flat_scores[self.flat_indices.to(flat_scores.device)]
+
+  def get_edge_mask(self,
+                    attribution_scores: PruneScores,
+                    threshold: float,
+                    abs_val_threshold: bool = False) -> np.ndarray:
+    """Returns a boolean mask over the edges of the table with the ones whose score is greater than the threshold."""
+    scores = self.get_scores(attribution_scores)
+    if abs_val_threshold:
+      scores = scores.abs()
+    return (scores > threshold).cpu().numpy()
+
+
+# edge tables of patchable models, which are removed when the model is garbage collected
+_edge_tables: "weakref.WeakKeyDictionary[PatchableModel, PatchableModelEdgeTable]" = weakref.WeakKeyDictionary()
+
+
+def flatten_prune_scores(attribution_scores: PruneScores, module_names: Optional[Sequence[str]] = None) -> t.Tensor:
+  """Flattens the scores of the given modules (all of them, in the order of the dict, by default) into a single 1D
+  tensor."""
+  if module_names is None:
+    module_names = list(attribution_scores.keys())
+  return t.cat([attribution_scores[name].flatten() for name in module_names])
 
 
 def build_circuit(model: PatchableModel,
@@ -10,28 +95,186 @@ def build_circuit(model: PatchableModel,
                   threshold: float,
                   abs_val_threshold: bool = False) -> Circuit:
   """Build a circuit out of the auto_circuit output."""
+  table = PatchableModelEdgeTable.for_model(model)
+  edge_mask = table.get_edge_mask(attribution_scores, threshold, abs_val_threshold)
+
   circuit = Circuit()
+  circuit.add_edges_from([table.edges[i] for i in np.flatnonzero(edge_mask)])
+  return circuit
 
-  for edge in model.edges:
-    src_node = edge.src
-    dst_node = edge.dest
-    score = attribution_scores[dst_node.module_name][edge.patch_idx]
-    if abs_val_threshold:
-      score = abs(score)
-    if score > threshold:
-      from_node = CircuitNode(src_node.module_name, src_node.head_idx)
-      to_node = CircuitNode(dst_node.module_name, dst_node.head_idx)
-      circuit.add_edge(from_node, to_node)
+def get_edge_scores(model: PatchableModel,
+                    attribution_scores: PruneScores,
+                    abs_val_threshold: bool = False) -> Tuple[List[CircuitEdge], np.ndarray]:
+  """Returns the edges of the model (as in build_circuit) and their scores, e.g., for calculate_roc."""
+  table = PatchableModelEdgeTable.for_model(model)
+  scores = table.get_scores(attribution_scores).detach().cpu().numpy().astype(np.float64)
+  if abs_val_threshold:
+    scores = np.abs(scores)
+
+  return list(table.edges), scores
 
-  return circuit
 
 def build_normalized_scores(attribution_scores: PruneScores) -> PruneScores:
   """Normalize the scores so that they all lie between 0 and 1."""
-  max_score = max(scores.max() for scores in attribution_scores.values())
-  min_score = min(scores.min() for scores in attribution_scores.values())
+  flat_scores = flatten_prune_scores(attribution_scores)
+  max_score = flat_scores.max()
+  min_score = flat_scores.min()
+
+  return {module_name: (scores - min_score) / (max_score - min_score)
+          for module_name, scores in attribution_scores.items()}
+
+
+def get_prune_scores_threshold(attribution_scores: PruneScores, edge_count: int) -> float:
+  """Same as auto_circuit's prune_scores_threshold, over the flattened scores."""
+  return get_edge_count_threshold(flatten_prune_scores(attribution_scores).detach().cpu().numpy(), edge_count)
+
+
+def build_circuit_from_edge_scores(edges: List[CircuitEdge],
+                                   scores: np.ndarray,
+                                   threshold: float,
+                                   abs_val_threshold: bool = False) -> Circuit:
+  """Same as build_circuit, for the edges and scores returned by get_edge_scores."""
+  if abs_val_threshold:
+    scores = np.abs(scores)
+
+  circuit = Circuit()
+  circuit.add_edges_from([edges[i] for i in np.flatnonzero(scores > threshold)])
+  return circuit
+
+
+def get_edge_count_threshold(scores: np.ndarray, edge_count: int) -> float:
+  """Same as auto_circuit's prune_scores_threshold: the smallest absolute score of the top edge_count edges."""
+  if edge_count == 0:
+    return float("inf")
+  return float(np.sort(np.abs(scores))[-edge_count])
+
+
+def normalize_edge_scores(scores: np.ndarray) -> np.ndarray:
+  """Same as build_normalized_scores, for the scores returned by get_edge_scores."""
+  return (scores - scores.min()) / (scores.max() - scores.min())
+
+
+def save_edge_scores(path: str, edges: List[CircuitEdge], scores: np.ndarray):
+  """Stores the edges and scores returned by get_edge_scores, so that circuits can be built from them later without
+  running the algorithm again. Edges are stored as tuples of node names and indices, and scores as a float32 tensor
+  (the dtype of auto_circuit's scores)."""
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  data = {
+    "edges": [(from_node.name, from_node.index, to_node.name, to_node.index) for from_node, to_node in edges],
+    "scores": t.from_numpy(scores.astype(np.float32)),
+  }
+
+  # write under a temporary name and rename, so that other processes never load a partially written file
+  tmp_path = f"{path}.tmp-{os.getpid()}"
+  t.save(data, tmp_path)
+  os.replace(tmp_path, path)
+
+
+def load_edge_scores(path: str) -> Optional[Tuple[List[CircuitEdge], np.ndarray]]:
+  """Loads the edges and scores stored with save_edge_scores, or returns None if they are not there."""
+  if not os.path.exists(path):
+    return None
+
+  data = t.load(path)
+  edges = [(CircuitNode(from_name, from_index), CircuitNode(to_name, to_index))
+           for from_name, from_index, to_name, to_index in data["edges"]]
+  return edges, data["scores"].numpy().astype(np.float64)
+
+
+def estimate_memory_per_sample(cfg: HookedTransformerConfig, seq_len: int) -> int:
+  """Estimates the memory (in bytes) that auto_circuit needs per sample to run a factorized patchable model with
+  separate qkv inputs. Each source (embedding, head and mlp outputs) and destination (q, k and v inputs of each head,
+  mlp inputs and the output) has an activation of shape [seq_len, d_model], and each head has an attention pattern of
+  shape [seq_len, seq_len]."""
+  n_sources = 1 + cfg.n_layers * (cfg.n_heads + 1)
+  n_destinations = 1 + cfg.n_layers * (3 * cfg.n_heads + 1)
+  activation_size = (n_sources + n_destinations) * seq_len * cfg.d_model + cfg.n_layers * cfg.n_heads * seq_len ** 2
+  bytes_per_value = 8 if cfg.dtype == t.float64 else 4
+  return ACTIVATION_COPIES_PER_SAMPLE * activation_size * bytes_per_value
+
+
+def get_batch_size(cfg: HookedTransformerConfig,
+                   seq_len: int,
+                   data_size: int,
+                   batch_size: Optional[int] = None,
+                   max_memory: Optional[float] = None) -> int:
+  """Returns the batch size to run auto_circuit algorithms with: batch_size if it is given, the largest batch whose
+  estimated memory fits in max_memory (in GB) if that is given, or the whole dataset otherwise."""
+  if batch_size is not None:
+    return max(1, min(batch_size, data_size))
+
+  if max_memory is not None:
+    max_batch_size = int(max_memory * 1024 ** 3 // estimate_memory_per_sample(cfg, seq_len))
+    return max(1, min(max_batch_size, data_size))
+
+  return data_size
+
+
+def get_integrated_grad_steps_per_pass(cfg: HookedTransformerConfig,
+                                       seq_len: int,
+                                       batch_size: int,
+                                       integrated_grad_steps: int,
+                                       max_memory: Optional[float] = None) -> int:
+  """Returns how many interpolation steps of integrated gradients to stack in a single forward and backward pass over a
+  batch: as many as fit in max_memory (in GB), at least one, or all of them if there is no memory budget."""
+  total_steps = integrated_grad_steps + 1
+  if max_memory is None:
+    return total_steps
+
+  max_samples_per_pass = get_batch_size(cfg, seq_len, batch_size * total_steps, max_memory=max_memory)
+  return max(1, min(max_samples_per_pass // batch_size, total_steps))
+
+
+def batched_integrated_gradients_prune_scores(
+    model: PatchableModel,
+    dataloader: PromptDataLoader,
+    answer_function: str | Callable[[t.Tensor, PromptPairBatch], t.Tensor],
+    integrated_grad_samples: int,
+    steps_per_pass: Optional[int] = None,
+) -> PruneScores:
+  """Same scores as auto_circuit's mask_gradient_prune_scores with grad_function="logit" and integrated_grad_samples,
+  but the mask values of the interpolation steps are stacked along the batch dimension: each forward and backward pass
+  runs steps_per_pass steps (all of them if None) over copies of the batch, each copy with the mask value of its step.
+  answer_function is either "avg_diff" or a loss function of the logits and the batch, averaged over the batch."""
+  mask_values = [step / integrated_grad_samples for step in range(integrated_grad_samples + 1)]
+  if steps_per_pass is None:
+    steps_per_pass = len(mask_values)
+
+  src_outs = batch_src_ablations(model, dataloader, ablation_type=AblationType.RESAMPLE, clean_corrupt="corrupt")
+  prune_scores: PruneScores = {wrapper.module_name: t.zeros_like(wrapper.patch_mask) for wrapper in model.dest_wrappers}
+
+  with train_mask_mode(model):
+    for batch in dataloader:
+      batch_size = batch.clean.size(0)
+
+      for start in range(0, len(mask_values), steps_per_pass):
+        step_values = t.tensor(mask_values[start:start + steps_per_pass], device=batch.clean.device)
+        n_steps = len(step_values)
+
+        with set_mask_batch_size(model, n_steps * batch_size):
+          # copy i of the batch (i.e., rows i * batch_size to (i + 1) * batch_size) uses the mask value of step i
+          sample_mask_values = step_values.repeat_interleave(batch_size)
+          for wrapper in model.dest_wrappers:
+            mask_shape = (-1,) + (1,) * (wrapper.patch_mask.ndim - 1)
+            wrapper.patch_mask.data[:] = sample_mask_values.view(mask_shape)
+
+          patch_src_outs = src_outs[batch.key].clone().detach()
+          patch_src_outs = patch_src_outs.repeat(1, n_steps, *((1,) * (patch_src_outs.ndim - 2)))
+          with patch_mode(model, patch_src_outs):
+            logits = model(batch.clean.repeat(n_steps, *((1,) * (batch.clean.ndim - 1))))[model.out_slice]
+
+            # the loss of each step is an average over the batch, as in the unbatched version, and they are summed up
+            loss = t.zeros((), device=logits.device)
+            for step_logits in logits.split(batch_size):
+              if answer_function == "avg_diff":
+                loss = loss - batch_avg_answer_diff(step_logits, batch)
+              elif callable(answer_function):
+                loss = loss + answer_function(step_logits, batch)
+              else:
+                raise ValueError(f"Unknown answer_function: {answer_function}")
+            loss.backward()
 
-  normalized_scores = attribution_scores.copy()
-  for module_name, scores in normalized_scores.items():
-    normalized_scores[module_name] = (normalized_scores[module_name] - min_score) / (max_score - min_score)
+          for wrapper in model.dest_wrappers:
+            prune_scores[wrapper.module_name] += wrapper.patch_mask.grad.detach().sum(dim=0)
 
-  return normalized_scores
+  return prune_scores
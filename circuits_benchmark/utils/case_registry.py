@@ -0,0 +1,193 @@
+import ast
+import hashlib
+import importlib
+import json
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from circuits_benchmark.utils.project_paths import detect_project_root, get_default_output_dir
+
+CASES_PACKAGE = "circuits_benchmark.benchmark.cases"
+default_case_registry_path = os.path.join(get_default_output_dir(), "case_registry.json")
+
+# Bump when the format of the registry changes, so that old registries are rebuilt.
+CASE_REGISTRY_VERSION = 2
+
+# Base classes of the cases that are defined outside the cases package. Classes in the package are cases if they
+# subclass one of these, directly or through other classes of the package.
+CASE_BASE_CLASS_NAMES = {"BenchmarkCase", "TracrBenchmarkCase"}
+
+
+def get_cases_dir() -> str:
+  return os.path.join(detect_project_root(), *CASES_PACKAGE.split("."))
+
+
+def get_case_registry_path(path: Optional[str] = None) -> str:
+  """Returns the path of the registry file. It defaults to default_case_registry_path, read at call time so that it can
+  be redirected (e.g., by the tests)."""
+  return path if path is not None else default_case_registry_path
+
+
+def get_case_registry(path: Optional[str] = None) -> Dict:
+  """Returns the registry of benchmark cases, which maps each file in the cases package to the classes it defines and
+  their base classes (found by parsing the file, not importing it) and the metadata computed so far for the cases.
+  Entries are rebuilt when the mtime or size of a file changes and its contents hash is different."""
+  registry = load_case_registry(path)
+  if update_case_registry(registry):
+    save_case_registry(registry, path)
+  return registry
+
+
+def load_case_registry(path: Optional[str] = None) -> Dict:
+  path = get_case_registry_path(path)
+  try:
+    with open(path, "r") as f:
+      registry = json.load(f)
+    if registry.get("version") == CASE_REGISTRY_VERSION:
+      return registry
+  except (OSError, ValueError):
+    pass
+
+  return {"version": CASE_REGISTRY_VERSION, "files": {}}
+
+
+def save_case_registry(registry: Dict, path: Optional[str] = None) -> None:
+  """Stores the registry, writing under a temporary name and then renaming. The registry is only a cache, so failing to
+  write it is not an error."""
+  path = get_case_registry_path(path)
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+      json.dump(registry, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+  except OSError:
+    pass
+
+
+def update_case_registry(registry: Dict) -> bool:
+  """Brings the registry up to date with the files in the cases package. Returns whether anything changed."""
+  cases_dir = get_cases_dir()
+  files = registry["files"]
+  changed = False
+
+  file_names = sorted(name for name in os.listdir(cases_dir) if name.endswith(".py") and name != "__init__.py")
+  for file_name in set(files.keys()) - set(file_names):
+    del files[file_name]
+    changed = True
+
+  for file_name in file_names:
+    file_path = os.path.join(cases_dir, file_name)
+    stat = os.stat(file_path)
+    entry = files.get(file_name)
+    if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+      continue
+
+    with open(file_path, "rb") as f:
+      source = f.read()
+    sha256 = hashlib.sha256(source).hexdigest()
+
+    if entry is None or entry["sha256"] != sha256:
+      entry = {
+        "module": f"{CASES_PACKAGE}.{file_name[:-3]}",
+        "sha256": sha256,
+        "classes": find_class_bases(source),
+        "metadata": {},
+      }
+    entry["mtime"] = stat.st_mtime
+    entry["size"] = stat.st_size
+    files[file_name] = entry
+    changed = True
+
+  return changed
+
+
+def find_class_bases(source: bytes) -> Dict[str, List[str]]:
+  """Returns a map from the names of the top-level classes in a module's source to the names of their base classes."""
+  class_bases = {}
+  for node in ast.parse(source).body:
+    if isinstance(node, ast.ClassDef):
+      class_bases[node.name] = [base.id if isinstance(base, ast.Name) else base.attr
+                                for base in node.bases if isinstance(base, (ast.Name, ast.Attribute))]
+  return class_bases
+
+
+def get_case_class_names(registry: Dict) -> Set[str]:
+  """Returns the names of the classes in the registry that subclass a case base class and start with "Case"."""
+  class_bases = {class_name: bases for entry in registry["files"].values() for class_name, bases in
+                 entry["classes"].items()}
+
+  subclass_names = set()
+  pending = set(class_bases.keys())
+  while pending:
+    # classes are added once one of their bases is known to be a case base class, until nothing changes
+    new_subclass_names = {class_name for class_name in pending
+                          if any(base in CASE_BASE_CLASS_NAMES or base in subclass_names
+                                 for base in class_bases[class_name])}
+    if not new_subclass_names:
+      break
+    subclass_names |= new_subclass_names
+    pending -= new_subclass_names
+
+  return {class_name for class_name in subclass_names if class_name.startswith("Case")}
+
+
+def get_case_class_locations(registry: Dict) -> Dict[str, Tuple[str, str]]:
+  """Returns a map from case name (e.g., "3" or "ioi") to the module and name of its class."""
+  case_class_names = get_case_class_names(registry)
+  return {class_name[4:].lower(): (entry["module"], class_name)
+          for entry in registry["files"].values()
+          for class_name in entry["classes"]
+          if class_name in case_class_names}
+
+
+def get_case_classes(indices: List[str] | None = None, path: Optional[str] = None) -> List[type]:
+  """Returns the case classes with the given names (or all of them), importing only the modules that define them."""
+  locations = get_case_class_locations(get_case_registry(path))
+  if indices is not None:
+    locations = {name: location for name, location in locations.items() if name in indices}
+
+  classes = [getattr(importlib.import_module(module), class_name) for module, class_name in locations.values()]
+
+  # sort classes. if id is a number, numerically, otherwise alphabetically
+  classes.sort(key=lambda cls:
+    cls.__name__[4:] if cls.__name__[4:].isnumeric() else cls.__name__[4:]
+  )
+
+  return classes
+
+
+def get_case_metadata(name: str, path: Optional[str] = None) -> Dict:
+  """Returns static metadata for a case (vocab size, sequence lengths, total data length and whether it is
+  categorical). The metadata is computed the first time it is requested for a version of the case file, and read from
+  the registry afterwards."""
+  registry = get_case_registry(path)
+  case_class_names = get_case_class_names(registry)
+  for file_name, entry in registry["files"].items():
+    for class_name in entry["classes"]:
+      if class_name not in case_class_names or class_name[4:].lower() != name:
+        continue
+
+      if class_name not in entry["metadata"]:
+        case = getattr(importlib.import_module(entry["module"]), class_name)()
+        entry["metadata"][class_name] = compute_case_metadata(case)
+        save_case_registry(registry, path)
+
+      return entry["metadata"][class_name]
+
+  raise ValueError(f"Unknown case {name}")
+
+
+def compute_case_metadata(case) -> Dict:
+  from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
+
+  if not isinstance(case, TracrBenchmarkCase):
+    return {}
+
+  return {
+    "vocab_size": len(case.get_vocab()),
+    "min_seq_len": case.get_min_seq_len(),
+    "max_seq_len": case.get_max_seq_len(),
+    "total_data_len": case.get_total_data_len(),
+    "is_categorical": case.is_categorical(),
+  }
@@ -1,8 +1,11 @@
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Set
+from functools import cached_property, lru_cache
+from typing import Any, Optional, Set, Tuple, TYPE_CHECKING
+
+import networkx as nx
+import numpy as np
 
-from acdc.TLACDCCorrespondence import TLACDCCorrespondence
-from acdc.TLACDCEdge import EdgeType
 from circuits_benchmark.utils.circuit.prepare_circuit import prepare_circuit_for_evaluation
 from iit.utils.correspondence import Correspondence
 from transformer_lens import HookedTransformer
@@ -10,26 +13,80 @@ from transformer_lens import HookedTransformer
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
 from circuits_benchmark.utils.circuit.circuit import Circuit
 from circuits_benchmark.utils.circuit.circuit_node import CircuitNode
+from circuits_benchmark.utils.circuit.compact_circuit import CircuitTopology, CompactCircuit
 from circuits_benchmark.utils.iit._acdc_utils import get_gt_circuit
 
+if TYPE_CHECKING:
+    # ACDC is only needed to build circuits from its correspondences, so algorithms like EAP do not import it
+    from acdc.TLACDCCorrespondence import TLACDCCorrespondence
 
-@dataclass
-class CircuitEvalNodesResult:
-  true_positive: Set[CircuitNode]
-  false_positive: Set[CircuitNode]
-  false_negative: Set[CircuitNode]
-  true_negative: Set[CircuitNode]
-  tpr: float
-  fpr: float
+# full circuits built from TLACDCCorrespondence, by model architecture (see get_full_circuit_from_model)
+FULL_CIRCUITS_FROM_MODEL_CACHE_SIZE = 32
+_full_circuits_from_model: "OrderedDict[tuple, Circuit]" = OrderedDict()
+
+# ground truth circuits, by case, correspondence and full circuit (see get_gt_circuit_for_evaluation)
+GT_CIRCUITS_CACHE_SIZE = 8
+_gt_circuits: "OrderedDict[tuple, Tuple[Correspondence, Circuit, Circuit]]" = OrderedDict()
+
+
+@dataclass(repr=False)
+class CircuitEvalElementsResult:
+  """Confusion sets of the nodes or edges of a hypothesis circuit, stored as masks over the node or edge table of the
+  full circuit. The sets of elements are built from the masks on first access."""
+  elements: Tuple[Any, ...]
+  true_positive_mask: np.ndarray
+  false_positive_mask: np.ndarray
+  false_negative_mask: np.ndarray
+  true_negative_mask: np.ndarray
+  tpr: float | str
+  fpr: float | str
+
+  def get_elements(self, mask: np.ndarray) -> Set:
+    return {self.elements[i] for i in np.flatnonzero(mask)}
+
+  @cached_property
+  def true_positive(self) -> Set:
+    return self.get_elements(self.true_positive_mask)
+
+  @cached_property
+  def false_positive(self) -> Set:
+    return self.get_elements(self.false_positive_mask)
+
+  @cached_property
+  def false_negative(self) -> Set:
+    return self.get_elements(self.false_negative_mask)
+
+  @cached_property
+  def true_negative(self) -> Set:
+    return self.get_elements(self.true_negative_mask)
+
+  def __repr__(self):
+    return (f"{type(self).__name__}(true_positive={self.true_positive}, false_positive={self.false_positive}, "
+            f"false_negative={self.false_negative}, true_negative={self.true_negative}, tpr={self.tpr}, "
+            f"fpr={self.fpr})")
+
+  @classmethod
+  def from_masks(cls, elements: Tuple[Any, ...], hypothesis_mask: np.ndarray, true_mask: np.ndarray):
+    true_positive_mask = hypothesis_mask & true_mask
+    false_positive_mask = hypothesis_mask & ~true_mask
+    false_negative_mask = true_mask & ~hypothesis_mask
+    true_negative_mask = ~(hypothesis_mask | true_mask)
+
+    positives = int(true_mask.sum())
+    negatives = len(true_mask) - positives
+    tpr = int(true_positive_mask.sum()) / positives if positives > 0 else "N/A"
+    fpr = int(false_positive_mask.sum()) / negatives if negatives > 0 else "N/A"
+
+    return cls(elements, true_positive_mask, false_positive_mask, false_negative_mask, true_negative_mask, tpr, fpr)
+
+
+class CircuitEvalNodesResult(CircuitEvalElementsResult):
+  """Confusion sets of CircuitNodes."""
+
+
+class CircuitEvalEdgesResult(CircuitEvalElementsResult):
+  """Confusion sets of edges, i.e., (from_node, to_node) tuples."""
 
-@dataclass
-class CircuitEvalEdgesResult:
-  true_positive: Set[CircuitNode]
-  false_positive: Set[CircuitNode]
-  false_negative: Set[CircuitNode]
-  true_negative: Set[CircuitNode]
-  tpr: float
-  fpr: float
 
 @dataclass
 class CircuitEvalResult:
@@ -49,108 +106,55 @@ def calculate_fpr_and_tpr(
   processed_hypothesis_circuit = prepare_circuit_for_evaluation(hypothesis_circuit, promote_to_heads)
   processed_full_circuit = prepare_circuit_for_evaluation(full_circuit, promote_to_heads)
 
-  all_nodes = set(processed_full_circuit.nodes)
-  true_nodes = set(processed_true_circuit.nodes)
-  hypothesis_nodes = set(processed_hypothesis_circuit.nodes)
+  # The processed circuits are compared as masks over the nodes and edges of the processed full circuit, which raises
+  # a ValueError if the hypothesis or the true circuit have nodes or edges that are not in it.
+  topology = CircuitTopology.for_circuit(processed_full_circuit)
+  true = topology.compact(processed_true_circuit)
+  hypothesis = topology.compact(processed_hypothesis_circuit)
 
+  return calculate_fpr_and_tpr_for_compact_circuits(hypothesis, true, verbose=verbose, print_summary=print_summary)
 
-  # calculate nodes false positives and false negatives
 
-  assert hypothesis_nodes.issubset(
-    all_nodes), f"hypothesis nodes contain the following nodes that are not in the full circuit: {hypothesis_nodes - all_nodes}"
-  assert true_nodes.issubset(
-    all_nodes), f"true nodes contain the following nodes that are not in the full circuit: {true_nodes - all_nodes}"
+def calculate_fpr_and_tpr_for_compact_circuits(
+    hypothesis: CompactCircuit,
+    true: CompactCircuit,
+    verbose: bool = False,
+    print_summary: bool = True,
+) -> CircuitEvalResult:
+  """Same as calculate_fpr_and_tpr, for circuits that are already processed and compacted with the same topology."""
+  if hypothesis.topology is not true.topology:
+    raise ValueError("The hypothesis and true circuits must have the same topology.")
+  topology = true.topology
 
-  false_positive_nodes = hypothesis_nodes - true_nodes
-  false_negative_nodes = true_nodes - hypothesis_nodes
-  true_positive_nodes = hypothesis_nodes & true_nodes
-  true_negative_nodes = all_nodes - (hypothesis_nodes | true_nodes)
+  nodes_result = CircuitEvalNodesResult.from_masks(topology.nodes, hypothesis.node_mask, true.node_mask)
+  edges_result = CircuitEvalEdgesResult.from_masks(topology.edges, hypothesis.edge_mask, true.edge_mask)
 
   if verbose:
     print("\nNodes analysis:")
-    print(f" - False Positives: {sorted(false_positive_nodes)}")
-    print(f" - False Negatives: {sorted(false_negative_nodes)}")
-    print(f" - True Positives: {sorted(true_positive_nodes)}")
-    print(f" - True Negatives: {sorted(true_negative_nodes)}")
-
-  # calculate edges false positives and false negatives
-  hypothesis_edges = set(processed_hypothesis_circuit.edges)
-  true_edges = set(processed_true_circuit.edges)
-  all_edges = set(processed_full_circuit.edges)
-
+    print(f" - False Positives: {sorted(nodes_result.false_positive)}")
+    print(f" - False Negatives: {sorted(nodes_result.false_negative)}")
+    print(f" - True Positives: {sorted(nodes_result.true_positive)}")
+    print(f" - True Negatives: {sorted(nodes_result.true_negative)}")
 
-  assert hypothesis_edges.issubset(
-    all_edges), f"hypothesis edges contain the following edges that are not in the full circuit: {hypothesis_edges - all_edges}, hypothesis edges: {hypothesis_edges}, all edges: {all_edges}"
-  assert true_edges.issubset(
-    all_edges), f"true edges contain the following edges that are not in the full circuit: {true_edges - all_edges}"
-
-  false_positive_edges = (hypothesis_edges - true_edges) & all_edges
-  false_negative_edges = true_edges - hypothesis_edges
-  true_positive_edges = hypothesis_edges & true_edges
-  true_negative_edges = all_edges - (
-        hypothesis_edges | true_edges)  # == (all_edges - hypothesis_edges) & (all_edges - true_edges)
-
-  if verbose:
     print("\nEdges analysis:")
-    print(f" - False Positives: {sorted(false_positive_edges)}")
-    print(f" - False Negatives: {sorted(false_negative_edges)}")
-    print(f" - True Positives: {sorted(true_positive_edges)}")
-    print(f" - True Negatives: {sorted(true_negative_edges)}")
+    print(f" - False Positives: {sorted(edges_result.false_positive)}")
+    print(f" - False Negatives: {sorted(edges_result.false_negative)}")
+    print(f" - True Positives: {sorted(edges_result.true_positive)}")
+    print(f" - True Negatives: {sorted(edges_result.true_negative)}")
 
   # print FP and TP rates for nodes and edges as summary
   make_summary = lambda *args, **kwargs: print(*args, **kwargs) if print_summary else None
   if verbose:
-    make_summary("\n\n-------------------\n\nhypothesis_edges", hypothesis_edges, "\n-----------\n")
-    make_summary("true_edges", true_edges, "\n-----------\n")
-    make_summary("all_edges", all_edges, "\n\n-------------------\n\n")
+    make_summary("\n\n-------------------\n\nhypothesis_edges", set(hypothesis.get_edges()), "\n-----------\n")
+    make_summary("true_edges", set(true.get_edges()), "\n-----------\n")
+    make_summary("all_edges", set(topology.edges), "\n\n-------------------\n\n")
   make_summary(f"\nSummary:")
+  make_summary(f" - Nodes TP rate: {nodes_result.tpr}")
+  make_summary(f" - Nodes FP rate: {nodes_result.fpr}")
+  make_summary(f" - Edges TP rate: {edges_result.tpr}")
+  make_summary(f" - Edges FP rate: {edges_result.fpr}")
 
-  if len(true_positive_nodes | false_negative_nodes) == 0:
-    nodes_tpr = "N/A"
-    make_summary(f" - Nodes TP rate: N/A")
-  else:
-    nodes_tpr = len(true_positive_nodes) / len(true_positive_nodes | false_negative_nodes)
-    make_summary(f" - Nodes TP rate: {nodes_tpr}")
-
-  if len(false_positive_nodes | true_negative_nodes) == 0:
-    nodes_fpr = "N/A"
-    make_summary(f" - Nodes FP rate: N/A")
-  else:
-    nodes_fpr = len(false_positive_nodes) / len(false_positive_nodes | true_negative_nodes)
-    make_summary(f" - Nodes FP rate: {nodes_fpr}")
-
-  if len(true_positive_edges | false_negative_edges) == 0:
-    edges_tpr = "N/A"
-    make_summary(f" - Edges TP rate: N/A")
-  else:
-    edges_tpr = len(true_positive_edges) / len(true_positive_edges | false_negative_edges)
-    make_summary(f" - Edges TP rate: {edges_tpr}")
-
-  if len(false_positive_edges | true_negative_edges) == 0:
-    edges_fpr = "N/A"
-    make_summary(f" - Edges FP rate: N/A")
-  else:
-    edges_fpr = len(false_positive_edges) / len(false_positive_edges | true_negative_edges)
-    make_summary(f" - Edges FP rate: {edges_fpr}")
-
-  return CircuitEvalResult(
-    nodes=CircuitEvalNodesResult(
-      true_positive=true_positive_nodes,
-      false_positive=false_positive_nodes,
-      false_negative=false_negative_nodes,
-      true_negative=true_negative_nodes,
-      tpr=nodes_tpr,
-      fpr=nodes_fpr,
-    ),
-    edges=CircuitEvalEdgesResult(
-      true_positive=true_positive_edges,
-      false_positive=false_positive_edges,
-      false_negative=false_negative_edges,
-      true_negative=true_negative_edges,
-      tpr=edges_tpr,
-      fpr=edges_fpr,
-    ),
-  )
+  return CircuitEvalResult(nodes=nodes_result, edges=edges_result)
 
 def evaluate_hypothesis_circuit(
     hypothesis_circuit: Circuit,
@@ -161,24 +165,48 @@ def evaluate_hypothesis_circuit(
     use_embeddings: bool = True,
     print_summary: bool = True,
 ) -> CircuitEvalResult:
-  full_corr = TLACDCCorrespondence.setup_from_model(
-    ll_model, use_pos_embed=use_embeddings
-  )
-  full_circuit = build_from_acdc_correspondence(full_corr)
+  full_circuit = get_full_circuit_from_model(ll_model, use_pos_embed=use_embeddings)
 
   if gt_circuit is None:
-    if "ioi" in case.get_name():
-      gt_circuit = case.get_ll_gt_circuit(corr=hl_ll_corr)
-    else:
-      gt_circuit = get_gt_circuit(hl_ll_corr, full_circuit, ll_model.cfg.n_heads, case)
+    gt_circuit = get_gt_circuit_for_evaluation(case, hl_ll_corr, full_circuit, ll_model.cfg.n_heads)
 
   return calculate_fpr_and_tpr(
     hypothesis_circuit, gt_circuit, full_circuit, print_summary=print_summary
   )
 
 
-def build_from_acdc_correspondence(corr: TLACDCCorrespondence) -> Circuit:
+def get_gt_circuit_for_evaluation(
+    case: BenchmarkCase,
+    hl_ll_corr: Correspondence,
+    full_circuit: Circuit,
+    n_heads: int,
+) -> Circuit:
+  """Returns the ground truth circuit used by evaluate_hypothesis_circuit. It is built once per case, correspondence
+  and full circuit (e.g., SP evaluates a circuit every epoch) and frozen, so that its prepared version is cached too."""
+  key = (case.get_name(), id(hl_ll_corr), id(full_circuit))
+  cached = _gt_circuits.get(key)
+  if cached is not None and cached[0] is hl_ll_corr and cached[1] is full_circuit:
+    _gt_circuits.move_to_end(key)
+    return cached[2]
+
+  if "ioi" in case.get_name():
+    gt_circuit = case.get_ll_gt_circuit(corr=hl_ll_corr)
+  else:
+    gt_circuit = get_gt_circuit(hl_ll_corr, full_circuit, n_heads, case)
+  gt_circuit = nx.freeze(gt_circuit)
+
+  # the correspondence and full circuit are kept alive, so that their ids are not reused while they are in the cache
+  _gt_circuits[key] = (hl_ll_corr, full_circuit, gt_circuit)
+  if len(_gt_circuits) > GT_CIRCUITS_CACHE_SIZE:
+    _gt_circuits.popitem(last=False)
+
+  return gt_circuit
+
+
+def build_from_acdc_correspondence(corr: "TLACDCCorrespondence") -> Circuit:
     """Return a Circuit object (ACDC level granularity) from a TLACDCCorrespondence object."""
+    from acdc.TLACDCEdge import EdgeType
+
     circuit = Circuit()
 
     for (child_name, child_index, parent_name, parent_index), edge in corr.edge_dict().items():
@@ -206,21 +234,31 @@ def build_from_acdc_correspondence(corr: TLACDCCorrespondence) -> Circuit:
     return circuit
 
 
-def get_full_circuit(n_layers: int, n_heads: int) -> Circuit:
-    """Return a full circuit (ACDC level granularity) with n_layers and n_heads."""
+def get_full_circuit(n_layers: int, n_heads: int, use_pos_embed: bool = True) -> Circuit:
+    """Return a full circuit (ACDC level granularity) with n_layers and n_heads.
+    Circuits are built once per set of arguments and shared, so they are frozen. Callers that need to modify the
+    circuit should make a copy."""
+    return _build_full_circuit(n_layers, n_heads, use_pos_embed)
+
+
+@lru_cache(maxsize=32)
+def _build_full_circuit(n_layers: int, n_heads: int, use_pos_embed: bool) -> Circuit:
     circuit = Circuit()
 
-    circuit.add_node(CircuitNode("hook_embed"))
-    circuit.add_node(CircuitNode("hook_pos_embed"))
+    embed_nodes = [CircuitNode("hook_embed")]
+    if use_pos_embed:
+        embed_nodes.append(CircuitNode("hook_pos_embed"))
+    circuit.add_nodes_from(embed_nodes)
 
-    # nodes that write to residual stream match at least one of the following
-    resid_writers_filter = ["hook_embed", "hook_pos_embed", "attn.hook_result", "hook_mlp_out"]
+    # nodes that write to the residual stream, in the order in which they are computed
+    resid_writers = list(embed_nodes)
 
     for layer in range(n_layers):
-        upstream_nodes = list(circuit.nodes)
-
-        # attention heads
+        # attention heads read the output of all previous layers
+        attn_resid_writers = list(resid_writers)
+        attn_result_nodes = []
         for head in range(n_heads):
+            attn_result_node = CircuitNode(f"blocks.{layer}.attn.hook_result", head)
             for letter in "qkv":
                 input_node = CircuitNode(f"blocks.{layer}.hook_{letter}_input", head)
                 matrix_node = CircuitNode(f"blocks.{layer}.attn.hook_{letter}", head)
@@ -228,43 +266,50 @@ def get_full_circuit(n_layers: int, n_heads: int) -> Circuit:
                 circuit.add_node(matrix_node)
                 circuit.add_edge(input_node, matrix_node)
 
-            attn_result_node = CircuitNode(f"blocks.{layer}.attn.hook_result", head)
             circuit.add_node(attn_result_node)
             for letter in "qkv":
-                matrix_node = CircuitNode(f"blocks.{layer}.attn.hook_{letter}", head)
-                circuit.add_edge(matrix_node, attn_result_node)
-
-            nodes_that_receive_resid_directly = [
-                f"blocks.{layer}.hook_q_input",
-                f"blocks.{layer}.hook_k_input",
-                f"blocks.{layer}.hook_v_input",
-            ]
-            for from_node in upstream_nodes:
-                if any([from_node.name.endswith(resid_writer) for resid_writer in resid_writers_filter]):
-                    if f"blocks.{layer}" not in from_node.name:  # discard nodes from current layer
-                        for to_node_name in nodes_that_receive_resid_directly:
-                            circuit.add_edge(from_node, CircuitNode(to_node_name, head))
-
-        upstream_nodes = list(circuit.nodes)
-
-        # mlp
+                circuit.add_edge(CircuitNode(f"blocks.{layer}.attn.hook_{letter}", head), attn_result_node)
+
+            for letter in "qkv":
+                input_node = CircuitNode(f"blocks.{layer}.hook_{letter}_input", head)
+                circuit.add_edges_from((from_node, input_node) for from_node in attn_resid_writers)
+
+            attn_result_nodes.append(attn_result_node)
+        resid_writers.extend(attn_result_nodes)
+
+        # the mlp also reads the output of the attention heads in the same layer
         mlp_in_node = CircuitNode(f"blocks.{layer}.hook_mlp_in")
         mlp_out_node = CircuitNode(f"blocks.{layer}.hook_mlp_out")
         circuit.add_node(mlp_in_node)
         circuit.add_node(mlp_out_node)
         circuit.add_edge(mlp_in_node, mlp_out_node)
-
-        nodes_that_receive_resid_directly = [mlp_in_node]
-        for from_node in upstream_nodes:
-            if any([from_node.name.endswith(resid_writer) for resid_writer in resid_writers_filter]):
-                if (f"blocks.{layer}" not in from_node.name) or ("attn.hook_result" in from_node.name):
-                    for to_node in nodes_that_receive_resid_directly:
-                        circuit.add_edge(from_node, to_node)
+        circuit.add_edges_from((from_node, mlp_in_node) for from_node in resid_writers)
+        resid_writers.append(mlp_out_node)
 
     last_resid_post_node = CircuitNode(f"blocks.{n_layers - 1}.hook_resid_post")
     circuit.add_node(last_resid_post_node)
-    for from_node in list(circuit.nodes):
-        if any([from_node.name.endswith(resid_writer) for resid_writer in resid_writers_filter]):
-            circuit.add_edge(from_node, last_resid_post_node)
+    circuit.add_edges_from((from_node, last_resid_post_node) for from_node in resid_writers)
+
+    return nx.freeze(circuit)
+
+
+def get_full_circuit_from_model(model: HookedTransformer, use_pos_embed: bool = True) -> Circuit:
+    """Return the full circuit (ACDC level granularity) of a model, as built from
+    `TLACDCCorrespondence.setup_from_model`. The circuit only depends on the architecture of the model, so it is built
+    once per architecture and shared like the circuits of get_full_circuit."""
+    cfg = model.cfg
+    key = (cfg.n_layers, cfg.n_heads, cfg.attn_only, use_pos_embed)
+    if key in _full_circuits_from_model:
+        _full_circuits_from_model.move_to_end(key)
+        return _full_circuits_from_model[key]
+
+    from acdc.TLACDCCorrespondence import TLACDCCorrespondence
+    full_corr = TLACDCCorrespondence.setup_from_model(model, use_pos_embed=use_pos_embed)
+    circuit = nx.freeze(build_from_acdc_correspondence(full_corr))
+
+    _full_circuits_from_model[key] = circuit
+    if len(_full_circuits_from_model) > FULL_CIRCUITS_FROM_MODEL_CACHE_SIZE:
+        _full_circuits_from_model.popitem(last=False)
+
+    return circuit
 
-    return circuit
\ No newline at end of file
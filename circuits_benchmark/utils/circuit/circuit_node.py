@@ -1,7 +1,46 @@
+from typing import Dict, Tuple
+
+
 class CircuitNode(object):
-  def __init__(self, name: str, index: int | None = None):
-    self.name = name
-    self.index = index
+  """A node in a circuit, identified by its name and (optional) head index.
+  Nodes are interned: creating a node returns the canonical instance for its name and index, so equal nodes are
+  usually the same object and comparing them is an identity check. Nodes are immutable, and their hash and sort key
+  are computed once."""
+  __slots__ = ("name", "index", "_hash", "_sort_key")
+
+  _interned: Dict[Tuple[str, int | None], "CircuitNode"] = {}
+
+  def __new__(cls, name: str | None = None, index: int | None = None):
+    if name is None:
+      # unpickling a node stored before nodes were interned, its state is set by __setstate__
+      return object.__new__(cls)
+
+    key = (name, index)
+    node = cls._interned.get(key)
+    if node is None:
+      node = object.__new__(cls)
+      node._set_fields(name, index)
+      node = cls._interned.setdefault(key, node)
+    return node
+
+  def _set_fields(self, name: str, index: int | None):
+    object.__setattr__(self, "name", name)
+    object.__setattr__(self, "index", index)
+    object.__setattr__(self, "_hash", hash((name, index)))
+    # nodes without index go after the nodes with the same name and an index
+    object.__setattr__(self, "_sort_key", (name, index is None, index if index is not None else 0))
+
+  def __setattr__(self, key, value):
+    raise AttributeError("CircuitNode is immutable")
+
+  def __reduce__(self):
+    return CircuitNode, (self.name, self.index)
+
+  def __setstate__(self, state):
+    # state of nodes pickled before they had __slots__
+    if isinstance(state, tuple):
+      state = {**(state[0] or {}), **(state[1] or {})}
+    self._set_fields(state["name"], state["index"])
 
   def __str__(self):
     return f"{self.name}[{self.index}]" if self.index is not None else self.name
@@ -10,9 +49,11 @@ class CircuitNode(object):
     return str(self)
 
   def __hash__(self):
-    return hash(str(self))
+    return self._hash
 
   def __eq__(self, other):
+    if self is other:
+      return True
     if not isinstance(other, CircuitNode):
       return False
 
@@ -22,11 +63,4 @@ class CircuitNode(object):
     if not isinstance(other, CircuitNode):
       raise ValueError(f"Expected a CircuitNode, got {type(other)}")
 
-    if self.name != other.name:
-      return self.name < other.name
-    elif self.index is None:
-      return False
-    elif other.index is None:
-      return True
-    else:
-      return self.index < other.index
+    return self._sort_key < other._sort_key
@@ -8,6 +8,6 @@ class CircuitNodeView(NodeView):
     if isinstance(item, str):
       return any([item == node.name for node in self._nodes])
     elif isinstance(item, CircuitNode):
-      return any([item == node for node in self._nodes])
+      return item in self._nodes
     else:
       return False
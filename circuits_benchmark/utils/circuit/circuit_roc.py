@@ -0,0 +1,149 @@
+import csv
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import numpy as np
+from iit.utils.correspondence import Correspondence
+from transformer_lens import HookedTransformer
+
+from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
+from circuits_benchmark.utils.circuit.circuit import Circuit
+from circuits_benchmark.utils.circuit.circuit_eval import get_full_circuit_from_model, get_gt_circuit_for_evaluation
+from circuits_benchmark.utils.circuit.compact_circuit import CircuitEdge, CircuitTopology
+from circuits_benchmark.utils.circuit.prepare_circuit import prepare_circuit_for_evaluation, prepare_edge_for_evaluation
+
+
+@dataclass
+class CircuitROCResult:
+  """TPR and FPR of the nodes and edges of the circuits obtained by thresholding a set of edge scores, for every
+  distinct threshold. Thresholds are sorted in decreasing order, and the circuit of each threshold has the scored edges
+  with a score strictly greater than it (as in build_circuit). The first threshold gives the empty circuit and the last
+  one (-inf) the circuit with all scored edges."""
+  thresholds: np.ndarray
+  edge_counts: np.ndarray  # number of scored edges in the circuit of each threshold
+  nodes_tpr: np.ndarray
+  nodes_fpr: np.ndarray
+  edges_tpr: np.ndarray
+  edges_fpr: np.ndarray
+  nodes_auc: float
+  edges_auc: float
+
+  def __len__(self):
+    return len(self.thresholds)
+
+  def save_csv(self, path: str):
+    """Stores one row per threshold, e.g., for plotting the ROC curves."""
+    with open(path, "w", newline="") as f:
+      writer = csv.writer(f)
+      writer.writerow(["threshold", "edge_count", "nodes_tpr", "nodes_fpr", "edges_tpr", "edges_fpr"])
+      writer.writerows(zip(self.thresholds.tolist(),
+                           self.edge_counts.tolist(),
+                           self.nodes_tpr.tolist(),
+                           self.nodes_fpr.tolist(),
+                           self.edges_tpr.tolist(),
+                           self.edges_fpr.tolist()))
+
+
+def count_scores_above(sorted_scores: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+  """Returns, for each threshold, how many of the (ascending) sorted scores are strictly greater than it."""
+  return len(sorted_scores) - np.searchsorted(sorted_scores, thresholds, side="right")
+
+
+def calculate_rates(scores: np.ndarray, true_mask: np.ndarray, thresholds: np.ndarray):
+  """Returns the TPR and FPR of the elements with a score greater than each threshold. Rates are NaN when there are no
+  positive (or negative) elements, where calculate_fpr_and_tpr returns "N/A"."""
+  positive_scores = np.sort(scores[true_mask])
+  negative_scores = np.sort(scores[~true_mask])
+
+  with np.errstate(divide="ignore", invalid="ignore"):
+    tpr = count_scores_above(positive_scores, thresholds) / np.float64(len(positive_scores))
+    fpr = count_scores_above(negative_scores, thresholds) / np.float64(len(negative_scores))
+
+  return tpr, fpr
+
+
+def calculate_auc(tpr: np.ndarray, fpr: np.ndarray) -> float:
+  """Area under the ROC curve with the trapezoidal rule. The curve is closed at (0, 0) and (1, 1)."""
+  if np.isnan(tpr).any() or np.isnan(fpr).any():
+    return float("nan")
+
+  x = np.concatenate([[0.0], fpr, [1.0]])
+  y = np.concatenate([[0.0], tpr, [1.0]])
+  return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2))
+
+
+def calculate_roc(
+    scored_edges: Sequence[CircuitEdge],  # e.g., the edges of a model, with ACDC granularity
+    scores: np.ndarray,  # the score of each edge, e.g., attribution scores of EAP
+    true_circuit: Circuit,  # e.g., the one provided by Tracr (ground truth)
+    full_circuit: Circuit,
+    promote_to_heads: bool = True,
+) -> CircuitROCResult:
+  """Evaluates the circuits of all thresholds over the scores in a single pass, instead of building and evaluating a
+  circuit per threshold with calculate_fpr_and_tpr.
+  An edge or node of the processed full circuit is in the circuit of a threshold iff one of the scored edges that are
+  processed into it (or into an edge of that node) has a greater score than the threshold. So we give it the maximum
+  score of those edges, sort the scores once, and count the true and false positives of every threshold with a binary
+  search."""
+  scores = np.asarray(scores, dtype=np.float64)
+  if scores.shape != (len(scored_edges),):
+    raise ValueError(f"Expected one score per edge, got {scores.shape} scores for {len(scored_edges)} edges.")
+
+  processed_true_circuit = prepare_circuit_for_evaluation(true_circuit, promote_to_heads)
+  processed_full_circuit = prepare_circuit_for_evaluation(full_circuit, promote_to_heads)
+  topology = CircuitTopology.for_circuit(processed_full_circuit)
+  true = topology.compact(processed_true_circuit)
+
+  # map each scored edge to the processed edge it becomes, dropping the ones that are removed by the processing
+  kept_edges = []
+  processed_edges = []
+  for i, (from_node, to_node) in enumerate(scored_edges):
+    processed_edge = prepare_edge_for_evaluation(from_node, to_node, promote_to_heads)
+    if processed_edge is not None:
+      kept_edges.append(i)
+      processed_edges.append(processed_edge)
+
+  missing_edges = [edge for edge in processed_edges if edge not in topology.edge_ids]
+  if missing_edges:
+    raise ValueError(f"The following edges are not in the full circuit: {missing_edges}")
+
+  processed_edge_ids = np.array([topology.edge_ids[edge] for edge in processed_edges], dtype=np.int64)
+  edge_scores = np.full(topology.num_edges, -np.inf)
+  np.maximum.at(edge_scores, processed_edge_ids, scores[np.array(kept_edges, dtype=np.int64)])
+  node_scores = np.full(topology.num_nodes, -np.inf)
+  np.maximum.at(node_scores, topology.edge_sources, edge_scores)
+  np.maximum.at(node_scores, topology.edge_targets, edge_scores)
+
+  thresholds = np.concatenate([np.unique(scores)[::-1], [-np.inf]])
+  edge_counts = count_scores_above(np.sort(scores), thresholds)
+  nodes_tpr, nodes_fpr = calculate_rates(node_scores, true.node_mask, thresholds)
+  edges_tpr, edges_fpr = calculate_rates(edge_scores, true.edge_mask, thresholds)
+
+  return CircuitROCResult(
+    thresholds=thresholds,
+    edge_counts=edge_counts,
+    nodes_tpr=nodes_tpr,
+    nodes_fpr=nodes_fpr,
+    edges_tpr=edges_tpr,
+    edges_fpr=edges_fpr,
+    nodes_auc=calculate_auc(nodes_tpr, nodes_fpr),
+    edges_auc=calculate_auc(edges_tpr, edges_fpr),
+  )
+
+
+def evaluate_hypothesis_roc(
+    scored_edges: Sequence[CircuitEdge],
+    scores: np.ndarray,
+    ll_model: HookedTransformer,
+    hl_ll_corr: Correspondence,
+    case: BenchmarkCase,
+    gt_circuit: Optional[Circuit] = None,
+    use_embeddings: bool = True,
+) -> CircuitROCResult:
+  """Same as evaluate_hypothesis_circuit, for all the circuits obtained by thresholding the scores of some edges."""
+  full_circuit = get_full_circuit_from_model(ll_model, use_pos_embed=use_embeddings)
+
+  if gt_circuit is None:
+    gt_circuit = get_gt_circuit_for_evaluation(case, hl_ll_corr, full_circuit, ll_model.cfg.n_heads)
+
+  return calculate_roc(scored_edges, scores, gt_circuit, full_circuit)
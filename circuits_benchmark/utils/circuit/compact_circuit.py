@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import weakref
+from typing import Dict, Iterable, Tuple
+
+import networkx as nx
+import numpy as np
+
+from circuits_benchmark.utils.circuit.circuit import Circuit
+from circuits_benchmark.utils.circuit.circuit_granularity import CircuitGranularity
+from circuits_benchmark.utils.circuit.circuit_node import CircuitNode
+
+CircuitEdge = Tuple[CircuitNode, CircuitNode]
+
+# topologies of frozen circuits, which are removed when the circuit is garbage collected
+_topologies: "weakref.WeakKeyDictionary[Circuit, CircuitTopology]" = weakref.WeakKeyDictionary()
+
+
+class CircuitTopology:
+  """Frozen tables with the nodes and edges of a full circuit, which give each node and edge an integer id.
+  Circuits that are subgraphs of the full circuit can be stored as CompactCircuits, i.e., boolean masks over these
+  tables, so that comparing them does not need to hash any CircuitNode."""
+
+  def __init__(self, full_circuit: Circuit):
+    self.nodes: Tuple[CircuitNode, ...] = tuple(sorted(full_circuit.nodes))
+    self.node_ids: Dict[CircuitNode, int] = {node: i for i, node in enumerate(self.nodes)}
+
+    self.edges: Tuple[CircuitEdge, ...] = tuple(sorted(full_circuit.edges))
+    self.edge_ids: Dict[CircuitEdge, int] = {edge: i for i, edge in enumerate(self.edges)}
+
+    # node ids of the endpoints of each edge
+    self.edge_sources = np.array([self.node_ids[u] for u, _ in self.edges], dtype=np.int64)
+    self.edge_targets = np.array([self.node_ids[v] for _, v in self.edges], dtype=np.int64)
+
+    self.full_circuit = self.compact(full_circuit)
+
+  @classmethod
+  def for_circuit(cls, full_circuit: Circuit) -> CircuitTopology:
+    """Returns the topology of a full circuit. Topologies of frozen circuits are built once and shared."""
+    if not nx.is_frozen(full_circuit):
+      return cls(full_circuit)
+
+    topology = _topologies.get(full_circuit)
+    if topology is None:
+      topology = cls(full_circuit)
+      _topologies[full_circuit] = topology
+    return topology
+
+  @property
+  def num_nodes(self) -> int:
+    return len(self.nodes)
+
+  @property
+  def num_edges(self) -> int:
+    return len(self.edges)
+
+  def get_node_mask(self, nodes: Iterable[CircuitNode]) -> np.ndarray:
+    """Returns a mask over the node table with the given nodes. Raises a ValueError if a node is not in the table."""
+    nodes = list(nodes)
+    missing_nodes = [node for node in nodes if node not in self.node_ids]
+    if missing_nodes:
+      raise ValueError(f"The following nodes are not in the full circuit: {missing_nodes}")
+
+    mask = np.zeros(self.num_nodes, dtype=bool)
+    mask[[self.node_ids[node] for node in nodes]] = True
+    return mask
+
+  def get_edge_mask(self, edges: Iterable[CircuitEdge]) -> np.ndarray:
+    """Returns a mask over the edge table with the given edges. Raises a ValueError if an edge is not in the table."""
+    edges = list(edges)
+    missing_edges = [edge for edge in edges if edge not in self.edge_ids]
+    if missing_edges:
+      raise ValueError(f"The following edges are not in the full circuit: {missing_edges}")
+
+    mask = np.zeros(self.num_edges, dtype=bool)
+    mask[[self.edge_ids[edge] for edge in edges]] = True
+    return mask
+
+  def compact(self, circuit: Circuit) -> CompactCircuit:
+    """Converts a subgraph of the full circuit to a CompactCircuit."""
+    return CompactCircuit(self,
+                          self.get_node_mask(circuit.nodes),
+                          self.get_edge_mask(circuit.edges),
+                          circuit.granularity)
+
+  def get_nodes(self, node_mask: np.ndarray) -> Tuple[CircuitNode, ...]:
+    return tuple(self.nodes[i] for i in np.flatnonzero(node_mask))
+
+  def get_edges(self, edge_mask: np.ndarray) -> Tuple[CircuitEdge, ...]:
+    return tuple(self.edges[i] for i in np.flatnonzero(edge_mask))
+
+
+class CompactCircuit:
+  """A circuit stored as boolean masks over the node and edge tables of a CircuitTopology.
+  Set operations between circuits of the same topology are element-wise operations on the masks."""
+
+  def __init__(self,
+               topology: CircuitTopology,
+               node_mask: np.ndarray,
+               edge_mask: np.ndarray,
+               granularity: CircuitGranularity | None = None):
+    self.topology = topology
+    self.node_mask = node_mask
+    self.edge_mask = edge_mask
+    self.granularity = granularity
+
+  @classmethod
+  def from_edge_mask(cls,
+                     topology: CircuitTopology,
+                     edge_mask: np.ndarray,
+                     granularity: CircuitGranularity | None = None) -> CompactCircuit:
+    """Builds the circuit with the given edges and the nodes they connect."""
+    node_mask = np.zeros(topology.num_nodes, dtype=bool)
+    node_mask[topology.edge_sources[edge_mask]] = True
+    node_mask[topology.edge_targets[edge_mask]] = True
+    return cls(topology, node_mask, edge_mask, granularity)
+
+  def to_circuit(self) -> Circuit:
+    """Converts back to a Circuit with the same nodes and edges."""
+    circuit = Circuit(granularity=self.granularity)
+    circuit.add_nodes_from(self.get_nodes())
+    circuit.add_edges_from(self.get_edges())
+    return circuit
+
+  def get_nodes(self) -> Tuple[CircuitNode, ...]:
+    return self.topology.get_nodes(self.node_mask)
+
+  def get_edges(self) -> Tuple[CircuitEdge, ...]:
+    return self.topology.get_edges(self.edge_mask)
+
+  @property
+  def num_nodes(self) -> int:
+    return int(self.node_mask.sum())
+
+  @property
+  def num_edges(self) -> int:
+    return int(self.edge_mask.sum())
+
+  def _check_same_topology(self, other: CompactCircuit):
+    if self.topology is not other.topology:
+      raise ValueError("Compact circuits must have the same topology to be combined.")
+
+  def __and__(self, other: CompactCircuit) -> CompactCircuit:
+    self._check_same_topology(other)
+    return CompactCircuit(self.topology, self.node_mask & other.node_mask, self.edge_mask & other.edge_mask,
+                          self.granularity)
+
+  def __or__(self, other: CompactCircuit) -> CompactCircuit:
+    self._check_same_topology(other)
+    return CompactCircuit(self.topology, self.node_mask | other.node_mask, self.edge_mask | other.edge_mask,
+                          self.granularity)
+
+  def __sub__(self, other: CompactCircuit) -> CompactCircuit:
+    self._check_same_topology(other)
+    return CompactCircuit(self.topology, self.node_mask & ~other.node_mask, self.edge_mask & ~other.edge_mask,
+                          self.granularity)
+
+  def __invert__(self) -> CompactCircuit:
+    """Returns the complement of this circuit in the full circuit."""
+    return CompactCircuit(self.topology, ~self.node_mask, ~self.edge_mask, self.granularity)
+
+  def __eq__(self, other):
+    if not isinstance(other, CompactCircuit):
+      return False
+
+    return (self.topology is other.topology
+            and np.array_equal(self.node_mask, other.node_mask)
+            and np.array_equal(self.edge_mask, other.edge_mask))
+
+  def __hash__(self):
+    return hash((id(self.topology), self.node_mask.tobytes(), self.edge_mask.tobytes()))
+
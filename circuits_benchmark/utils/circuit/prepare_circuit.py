@@ -1,3 +1,9 @@
+import weakref
+from functools import lru_cache
+from typing import Optional, Set, Tuple
+
+import networkx as nx
+
 from circuits_benchmark.utils.circuit.circuit import Circuit
 from circuits_benchmark.utils.circuit.circuit_node import CircuitNode
 
@@ -21,41 +27,85 @@ def prepare_circuit_for_evaluation(circuit: Circuit, promote_to_heads: bool = Tr
     if not promote_to_heads:
        raise NotImplementedError("This function is not yet tested for promote_to_heads=False")
 
-    new_circuit = Circuit()
+    # Frozen circuits (e.g., full circuits and cached ground truth circuits) are shared, so we prepare them only once.
+    frozen = nx.is_frozen(circuit)
+    if frozen and circuit in _prepared_circuits:
+        return _prepared_circuits[circuit]
 
-    for from_node, to_node in circuit.edges:
-        to_node_name_prefix = prefix(to_node.name)
-        to_node_name_suffix = suffix(to_node.name)
-        qkv_ins = ["hook_q_input", "hook_k_input", "hook_v_input"]
-        embeds = ["hook_embed", "hook_pos_embed"]
+    leaf_nodes = {node for node, out_degree in circuit.out_degree() if out_degree == 0}
+    parent_nodes = {node for node, in_degree in circuit.in_degree() if in_degree == 0}
 
+    new_circuit = Circuit()
+    for from_node, to_node in circuit.edges:
         if (
-           (is_direct_computation_or_placeholder_edge(from_node, promote_to_heads))
-           or is_ignorable_resid_edge(from_node, to_node, circuit)
+           is_direct_computation_or_placeholder_edge(from_node, promote_to_heads)
+           or is_ignorable_resid_edge(from_node, to_node, circuit, leaf_nodes, parent_nodes)
         ):
             # Ignore:
             # direct computation and placeholder edges
             # and resid edges that are not from the first and last layer
             continue
 
-        if from_node.name in embeds:
-            new_from_node = CircuitNode("blocks.0.hook_resid_pre")
-        else:
-            new_from_node = from_node
-
-        if to_node_name_suffix in qkv_ins:
-            # directly route incoming edges to head's hook_result
-            new_to_node = reroute_qkv_in_to_dest(to_node, promote_to_heads)
-        elif to_node_name_suffix == "hook_mlp_in":
-            # directly route incoming edges to mlp_out
-            new_to_node = CircuitNode(f"{to_node_name_prefix}.hook_mlp_out")
-        else:
-            # all other edges are okay...
-            new_to_node = to_node
-        new_circuit.add_edge(new_from_node, new_to_node)
+        new_circuit.add_edge(get_evaluation_source_node(from_node),
+                             get_evaluation_target_node(to_node, promote_to_heads))
+
+    if frozen:
+        new_circuit = nx.freeze(new_circuit)
+        _prepared_circuits[circuit] = new_circuit
+
     return new_circuit
 
 
+def prepare_edge_for_evaluation(from_node: CircuitNode,
+                                to_node: CircuitNode,
+                                promote_to_heads: bool = True) -> Optional[Tuple[CircuitNode, CircuitNode]]:
+    """
+    Returns the edge that replaces an edge in prepare_circuit_for_evaluation, or None if the edge is removed.
+    The edge is prepared as if its source had no incoming edges and its target had no outgoing edges in the circuit.
+    This holds for the edges of auto_circuit's patchable models, which start at the residual stream of the first layer
+    and end at the residual stream of the last one, so each of their edges can be prepared on its own.
+    """
+    if not promote_to_heads:
+       raise NotImplementedError("This function is not yet tested for promote_to_heads=False")
+
+    if (
+       is_direct_computation_or_placeholder_edge(from_node, promote_to_heads)
+       or is_ignorable_resid_edge(from_node, to_node, None, leaf_nodes={to_node}, parent_nodes={from_node})
+    ):
+        return None
+
+    return get_evaluation_source_node(from_node), get_evaluation_target_node(to_node, promote_to_heads)
+
+
+# Prepared versions of frozen circuits, which are removed when the original circuit is garbage collected.
+_prepared_circuits: "weakref.WeakKeyDictionary[Circuit, Circuit]" = weakref.WeakKeyDictionary()
+
+
+@lru_cache(maxsize=None)
+def get_evaluation_source_node(node: CircuitNode) -> CircuitNode:
+    """Returns the node that replaces a node at the source of an edge: embeddings are mapped to the residual stream
+    before the first layer."""
+    if node.name in ["hook_embed", "hook_pos_embed"]:
+        return CircuitNode("blocks.0.hook_resid_pre")
+    return node
+
+
+@lru_cache(maxsize=None)
+def get_evaluation_target_node(node: CircuitNode, promote_to_heads: bool = True) -> CircuitNode:
+    """Returns the node that replaces a node at the target of an edge: inputs of heads and mlps are routed to their
+    outputs."""
+    node_name_suffix = suffix(node.name)
+    if node_name_suffix in ["hook_q_input", "hook_k_input", "hook_v_input"]:
+        # directly route incoming edges to head's hook_result
+        return reroute_qkv_in_to_dest(node, promote_to_heads)
+    elif node_name_suffix == "hook_mlp_in":
+        # directly route incoming edges to mlp_out
+        return CircuitNode(f"{prefix(node.name)}.hook_mlp_out")
+    else:
+        # all other edges are okay...
+        return node
+
+
 def reroute_qkv_in_to_dest(node: CircuitNode, promote_to_heads: bool) -> CircuitNode:
     to_node_name_prefix = prefix(node.name)
     if promote_to_heads:
@@ -83,11 +133,19 @@ def is_direct_computation_or_placeholder_edge(from_node: CircuitNode, promote_to
         or (from_node_name_suffix == "hook_mlp_in")  # Direct computation: hook_mlp_in -> hook_mlp_out
     )
 
-def is_ignorable_resid_edge(from_node: CircuitNode, to_node: CircuitNode, circuit: Circuit) -> bool:
+def is_ignorable_resid_edge(from_node: CircuitNode,
+                            to_node: CircuitNode,
+                            circuit: Optional[Circuit],
+                            leaf_nodes: Optional[Set[CircuitNode]] = None,
+                            parent_nodes: Optional[Set[CircuitNode]] = None) -> bool:
+    """The leaf and parent nodes of the circuit are computed if they are not given, in which case the circuit is
+    required. Callers that check many edges of the same circuit should compute them once."""
     from_node_name_suffix = suffix(from_node.name)
     to_node_name_suffix = suffix(to_node.name)
-    leaf_nodes = [node for node in circuit.nodes if not list(circuit.successors(node))]
-    parent_nodes = [node for node in circuit.nodes if not list(circuit.predecessors(node))]
+    if leaf_nodes is None:
+        leaf_nodes = {node for node, out_degree in circuit.out_degree() if out_degree == 0}
+    if parent_nodes is None:
+        parent_nodes = {node for node, in_degree in circuit.in_degree() if in_degree == 0}
 
     resids = ["hook_resid_post", "hook_resid_pre"]
     embeds = ["hook_embed", "hook_pos_embed"]
@@ -110,8 +168,10 @@ def is_ignorable_resid_edge(from_node: CircuitNode, to_node: CircuitNode, circui
     # return False when edges are to the last layer
     return (to_node not in leaf_nodes and to_node_in_resid)
 
+@lru_cache(maxsize=None)
 def suffix(node_name: str) -> str:
     return node_name.split(".")[-1]
 
+@lru_cache(maxsize=None)
 def prefix(node_name: str) -> str:
     return ".".join(node_name.split(".")[:-1])
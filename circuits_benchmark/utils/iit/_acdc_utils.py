@@ -113,8 +113,7 @@ def get_gt_circuit(
     if not promote_to_heads:
         raise NotImplementedError("Only promote_to_heads=True is supported")
     
-    circuit = full_circuit.copy()
-    circuit = prepare_circuit_for_evaluation(circuit, promote_to_heads)
+    circuit = prepare_circuit_for_evaluation(full_circuit, promote_to_heads).copy()
     circuit_leaf_node = circuit.get_result_node()
 
     # remove edges that are not a part of the tracr ground truth
@@ -1,17 +1,20 @@
 import pickle
-from typing import Dict, Set, Tuple, Optional, Literal
+from typing import Dict, Set, Tuple, Optional, Literal, TYPE_CHECKING
 
 from iit.utils.nodes import LLNode, HLNode
 from iit.utils import index
 from iit.utils.correspondence import Correspondence
 from iit.utils.index import TorchIndex
-from tracr.compiler.compiling import TracrOutput
 from tracr.craft.bases import BasisDirection, VectorSpaceWithBasis
 from tracr.craft.transformers import SeriesWithResiduals, MLP, MultiAttentionHead
 
 from circuits_benchmark.benchmark.benchmark_case import BenchmarkCase
 from circuits_benchmark.utils.iit.tracr_hl_node import TracrHLNode
 
+if TYPE_CHECKING:
+    # Importing the compiler loads JAX. Any object with a craft_model works (e.g., a TracrBuildArtifact).
+    from tracr.compiler.compiling import TracrOutput
+
 TracrHLNodeMappingInfo = Tuple[int, Literal["attn", "mlp"], Optional[int | TorchIndex]]  # (layer, attn_or_mlp, head_index)
 
 # TODO: We shouldn't define overrides using basis directions as keys, since sometimes Tracr uses multiple HL nodes for
@@ -109,13 +112,13 @@ class TracrCorrespondence(Correspondence):
         return cls(corr_dict)
 
     @classmethod
-    def make_identity_corr(cls, tracr_output: TracrOutput):
+    def make_identity_corr(cls, tracr_output: "TracrOutput"):
         """Creates a Tracr correspondence that maps each basis direction to a single (default) component."""
         return cls._build_corr_combining_info(cls.build_tracr_base_corr(tracr_output),
                                               None)
 
     @classmethod
-    def from_output(cls, case: BenchmarkCase, tracr_output: TracrOutput):
+    def from_output(cls, case: BenchmarkCase, tracr_output: "TracrOutput"):
         """Creates a Tracr correspondence from a Tracr output, using the given case to determine any overrides to the
         default Tracr correspondence info."""
         return cls._build_corr_combining_info(cls.build_tracr_base_corr(tracr_output),
@@ -154,7 +157,7 @@ class TracrCorrespondence(Correspondence):
     @classmethod
     def build_tracr_base_corr(
         cls,
-        tracr_output: TracrOutput
+        tracr_output: "TracrOutput"
     ) -> Dict[BasisDirection, Set[TracrHLNodeMappingInfo]]:
         """Builds the basic Tracr correspondence information from the Tracr output."""
         craft_model: SeriesWithResiduals = tracr_output.craft_model
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import warnings
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch as t
+from torch import Tensor
+from transformer_lens import ActivationCache
+
+from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
+from circuits_benchmark.benchmark.tracr_build_cache import get_tracr_build_cache_key
+from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformer
+from circuits_benchmark.utils.iit.iit_hl_model import IITHLModel
+from circuits_benchmark.utils.project_paths import get_default_output_dir
+
+default_hl_lookup_table_cache_dir = os.path.join(get_default_output_dir(), "hl_lookup_tables")
+
+# Cases with more possible inputs than this use the HL transformer instead of a lookup table.
+DEFAULT_HL_LOOKUP_TABLE_MAX_INPUTS = 2 ** 18
+
+
+class HLLookupTable:
+  """The outputs of an HL model and its activations at some hooks, for every possible input of a Tracr case.
+  Rows are sorted by a key computed from the token ids of each input, so a batch of inputs is mapped to its rows with
+  a binary search."""
+
+  def __init__(self,
+               keys: Tensor,
+               outputs: Tensor,
+               activations: Dict[str, Tensor],
+               radix: int):
+    self.keys = keys
+    self.outputs = outputs
+    self.activations = activations
+    self.radix = radix
+
+  @property
+  def hook_names(self) -> List[str]:
+    return list(self.activations.keys())
+
+  @staticmethod
+  def get_input_keys(inputs: Tensor, radix: int) -> Tensor:
+    """Returns the key of each input, reading its token ids as the digits of a number in base radix."""
+    powers = radix ** t.arange(inputs.shape[1] - 1, -1, -1, device=inputs.device, dtype=t.int64)
+    return (inputs.long() * powers).sum(dim=-1)
+
+  def find_rows(self, inputs: Tensor) -> Tensor | None:
+    """Returns the rows of the table for a batch of token ids, or None if some input is not in the table."""
+    if inputs.ndim != 2 or inputs.shape[1] != self.outputs.shape[1] or inputs.is_floating_point():
+      return None
+
+    keys = self.get_input_keys(inputs.to(self.keys.device), self.radix)
+    rows = t.searchsorted(self.keys, keys).clamp_(max=len(self.keys) - 1)
+    if not bool((self.keys[rows] == keys).all()):
+      return None
+
+    return rows
+
+  @classmethod
+  def build(cls,
+            case: TracrBenchmarkCase,
+            hl_model: HookedTracrTransformer,
+            hook_names: List[str],
+            batch_size: int = 2048) -> "HLLookupTable":
+    """Runs the HL model on every possible input of the case, storing its outputs and its activations at the given
+    hooks."""
+    min_seq_len, max_seq_len = case.get_min_seq_len(), case.get_max_seq_len()
+    input_ids = case.gen_all_input_ids(min_seq_len, max_seq_len)
+
+    # map ids in the case's token table to ids of the HL model
+    token_ids = np.array([hl_model.tracr_input_encoding_map[token] for token in case.get_input_token_table()])
+    inputs = t.from_numpy(token_ids[input_ids])
+
+    radix = hl_model.cfg.d_vocab
+    keys = cls.get_input_keys(inputs, radix)
+    order = t.argsort(keys)
+    keys, inputs = keys[order], inputs[order]
+
+    outputs = None
+    activations: Dict[str, Tensor] = {}
+    with t.no_grad():
+      for start in range(0, len(inputs), batch_size):
+        batch = inputs[start:start + batch_size].to(hl_model.device)
+        batch_outputs, cache = hl_model.run_with_cache(batch, names_filter=lambda name: name in hook_names)
+
+        if outputs is None:
+          outputs = t.empty((len(inputs),) + batch_outputs.shape[1:], dtype=batch_outputs.dtype)
+          for name in hook_names:
+            activations[name] = t.empty((len(inputs),) + cache[name].shape[1:], dtype=cache[name].dtype)
+
+        outputs[start:start + len(batch)] = batch_outputs.cpu()
+        for name in hook_names:
+          activations[name][start:start + len(batch)] = cache[name].cpu()
+
+    return cls(keys, outputs, activations, radix)
+
+  def to(self, device: str | t.device) -> "HLLookupTable":
+    return HLLookupTable(self.keys.to(device),
+                         self.outputs.to(device),
+                         {name: activation.to(device) for name, activation in self.activations.items()},
+                         self.radix)
+
+  def save(self, path: str) -> None:
+    """Stores the table as .npy files in a directory, writing under temporary names and renaming as in
+    save_dataset_to_cache."""
+    os.makedirs(path, exist_ok=True)
+
+    arrays = {"keys": self.keys, "outputs": self.outputs}
+    arrays.update({f"activations.{name}": activation for name, activation in self.activations.items()})
+    for name, tensor in arrays.items():
+      file_path = os.path.join(path, f"{name}.npy")
+      tmp_path = f"{file_path}.tmp-{os.getpid()}"
+      with open(tmp_path, "wb") as f:
+        np.save(f, tensor.detach().cpu().numpy())
+      os.replace(tmp_path, file_path)
+
+    # written last, so that a table is only loaded when all its arrays are there
+    metadata_path = os.path.join(path, "metadata.json")
+    tmp_path = f"{metadata_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+      json.dump({"radix": self.radix, "hook_names": self.hook_names}, f)
+    os.replace(tmp_path, metadata_path)
+
+  @classmethod
+  def load(cls, path: str) -> Optional["HLLookupTable"]:
+    """Loads a table stored with `save`, or returns None if it is not there. The arrays are memory-mapped as in
+    load_cached_dataset."""
+    metadata_path = os.path.join(path, "metadata.json")
+    if not os.path.exists(metadata_path):
+      return None
+
+    with open(metadata_path, "r") as f:
+      metadata = json.load(f)
+
+    def load_array(name: str) -> Tensor:
+      with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return t.from_numpy(np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c"))
+
+    return cls(load_array("keys"),
+               load_array("outputs"),
+               {name: load_array(f"activations.{name}") for name in metadata["hook_names"]},
+               metadata["radix"])
+
+
+def get_hl_lookup_table_cache_key(case: TracrBenchmarkCase, hl_model: HookedTracrTransformer,
+                                  hook_names: List[str]) -> str:
+  """Returns a key that identifies the lookup table of an HL model. It changes whenever the Tracr build of the case,
+  the shape of the HL model (e.g., compacted or not), the hooks or this file change."""
+  hasher = hashlib.sha256()
+  hasher.update(get_tracr_build_cache_key(case).encode())
+  hasher.update(json.dumps({"d_model": hl_model.cfg.d_model, "hook_names": sorted(hook_names)}).encode())
+  with open(__file__, "rb") as f:
+    hasher.update(f.read())
+  return f"{case.get_name()}/{hasher.hexdigest()}"
+
+
+class LookupTableIITHLModel(IITHLModel):
+  """IITHLModel that serves the HL model from an HLLookupTable.
+  Forward passes and caching are a gather from the table. Interventions on a single hook in the table are applied to
+  the stored activations: inputs whose activations are not changed by the intervention get their output from the
+  table, and only the others are run through the HL model. Anything else falls back to the HL model."""
+
+  def __init__(self, hl_model: HookedTracrTransformer, table: HLLookupTable, eval_mode: bool = False):
+    super().__init__(hl_model, eval_mode=eval_mode)
+    self.table = table
+
+  def forward(self, input):
+    rows = self.table.find_rows(self.get_correct_input(input))
+    if rows is None:
+      return super().forward(input)
+
+    return self.create_hl_output(self.table.outputs[rows].to(self.hl_model.device))
+
+  def run_with_cache(self, input):
+    rows = self.table.find_rows(input[0])
+    if rows is None:
+      return super().run_with_cache(input)
+
+    cache = ActivationCache({name: activation[rows].to(self.hl_model.device)
+                             for name, activation in self.table.activations.items()}, self.hl_model)
+    return self.create_hl_output(self.table.outputs[rows].to(self.hl_model.device)), cache
+
+  def run_with_hooks(self, input, *args, **kwargs):
+    fwd_hooks = kwargs.get("fwd_hooks", args[0] if args else [])
+    if len(args) + len(kwargs) != 1 or len(fwd_hooks) != 1:
+      return super().run_with_hooks(input, *args, **kwargs)
+
+    hook_name, hook_fn = fwd_hooks[0]
+    x = self.get_correct_input(input)
+    rows = self.table.find_rows(x)
+    if rows is None or not isinstance(hook_name, str) or hook_name not in self.table.activations:
+      return super().run_with_hooks(input, *args, **kwargs)
+
+    activation = self.table.activations[hook_name][rows].to(self.hl_model.device)
+    patched_activation = activation.clone()
+    result = hook_fn(patched_activation, hook=self.hl_model.hook_dict[hook_name])
+    if result is not None:
+      patched_activation = result
+
+    output = self.table.outputs[rows].to(self.hl_model.device).clone()
+    changed = (patched_activation != activation).flatten(start_dim=1).any(dim=1)
+    if changed.any():
+      changed_activation = patched_activation[changed]
+      output[changed] = self.hl_model.run_with_hooks(
+        x.to(self.hl_model.device)[changed],
+        fwd_hooks=[(hook_name, lambda _, hook: changed_activation)])
+
+    return self.create_hl_output(output)
+
+
+def make_lookup_table_iit_hl_model(case: TracrBenchmarkCase,
+                                   hl_model: HookedTracrTransformer,
+                                   hook_names: List[str],
+                                   eval_mode: bool = False,
+                                   max_inputs: int = DEFAULT_HL_LOOKUP_TABLE_MAX_INPUTS,
+                                   use_cache: bool = True,
+                                   cache_dir: Optional[str] = None) -> IITHLModel:
+  """Wraps the HL model of a Tracr case in a LookupTableIITHLModel. The table stores the activations at the given hooks
+  (usually, the HL nodes of the correspondence) and is stored on disk if use_cache is True, under cache_dir (by default,
+  default_hl_lookup_table_cache_dir, read at call time).
+  If the case has more than max_inputs possible inputs, or they can not be keyed with 64-bit integers, the table is
+  not built and a regular IITHLModel is returned."""
+  total_inputs = case.get_total_input_ids(case.get_min_seq_len(), case.get_max_seq_len())
+  if total_inputs > max_inputs or hl_model.cfg.d_vocab ** case.get_max_seq_len() >= 2 ** 63:
+    return IITHLModel(hl_model, eval_mode=eval_mode)
+
+  table = None
+  if cache_dir is None:
+    cache_dir = default_hl_lookup_table_cache_dir
+  path = os.path.join(cache_dir, get_hl_lookup_table_cache_key(case, hl_model, hook_names))
+  if use_cache:
+    table = HLLookupTable.load(path)
+
+  if table is None:
+    table = HLLookupTable.build(case, hl_model, hook_names)
+    if use_cache:
+      table.save(path)
+
+  return LookupTableIITHLModel(hl_model, table.to(hl_model.device), eval_mode=eval_mode)
@@ -58,13 +58,15 @@ def make_ll_cfg_for_case(
 def make_ll_cfg(
     hl_model, compress_resid: bool, compression_ratio: float, same_size: bool
 ) -> dict:
-    ll_cfg = hl_model.cfg.to_dict().copy()
+    # hl_model can be the HL model or just its config
+    hl_cfg = hl_model.cfg if hasattr(hl_model, "cfg") else hl_model
+    ll_cfg = hl_cfg.to_dict().copy()
     if same_size:
         n_heads = ll_cfg["n_heads"]
     else:
         n_heads = max(4, ll_cfg["n_heads"])
     if compress_resid:
-        d_model = int(hl_model.cfg.d_model // compression_ratio)
+        d_model = int(hl_cfg.d_model // compression_ratio)
         d_model = max(2, d_model)
         d_head = max(1, d_model // n_heads)
         d_mlp = d_model * 4
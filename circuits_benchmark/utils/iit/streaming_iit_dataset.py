@@ -0,0 +1,45 @@
+from typing import Iterator, Tuple
+
+import torch as t
+from torch.utils.data import IterableDataset, DataLoader
+
+from circuits_benchmark.benchmark.tracr_encoded_dataset import TracrEncodedDataset
+from circuits_benchmark.benchmark.tracr_streaming_dataset import TracrStreamingDataset
+from circuits_benchmark.utils.iit.iit_dataset_batch import IITDatasetBatch
+
+
+class StreamingIITDataset(IterableDataset):
+  """Same as IITDataset, but pairs base and ablation samples drawn from two streaming datasets.
+  Both streams should use different seeds, otherwise each base input would be paired with itself."""
+
+  def __init__(self,
+               base_data: TracrStreamingDataset,
+               ablation_data: TracrStreamingDataset,
+               device: str | t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu")):
+    assert base_data.seed != ablation_data.seed, "Base and ablation streams must use different seeds"
+    self.base_data = base_data
+    self.ablation_data = ablation_data
+    self.device = device
+
+  def __len__(self):
+    return len(self.base_data)
+
+  def __iter__(self) -> Iterator[Tuple[Tuple[t.Tensor, t.Tensor], Tuple[t.Tensor, t.Tensor]]]:
+    # Both streams assign the same chunks to each worker, so zipping them inside a worker is safe.
+    return zip(self.base_data, self.ablation_data)
+
+  @staticmethod
+  def collate_fn(batch, device: str | t.device) -> IITDatasetBatch:
+    base_batch, ablation_batch = zip(*batch)
+    return (TracrEncodedDataset.collate_fn(base_batch, device=device),
+            TracrEncodedDataset.collate_fn(ablation_batch, device=device))
+
+  def make_loader(self, batch_size: int, num_workers: int = 0) -> DataLoader:
+    return DataLoader(
+      self,
+      batch_size=batch_size,
+      num_workers=num_workers,
+      # keep the workers (and the epoch counters of the streams) alive between epochs, so that each epoch sees new data
+      persistent_workers=num_workers > 0,
+      collate_fn=lambda x: self.collate_fn(x, self.device),
+    )
@@ -26,6 +26,7 @@ class GroundTruthModelLoader(LLModelLoader):
   ) -> Tuple[Correspondence, HookedTransformer]:
     assert not same_size, "Ground truth models are never same size"
 
-    hl_model = self.case.get_hl_model(device=device)
+    # The model is modified by circuit discovery algorithms, so we don't use the shared instance
+    hl_model = self.case.get_hl_model(device=device, cached=False)
     corr = self.case.get_correspondence(same_size=True) # tracr models are always same size
     return corr, hl_model
@@ -103,6 +103,57 @@ class ACDCTest(unittest.TestCase):
     assert circuit is not None
     assert circuit_eval_result is not None
 
+  def test_acdc_runs_several_thresholds_at_once(self):
+    case = Case3()
+    thresholds = [0.1, 0.001, 0.01]
+    config = ACDCConfig(
+      thresholds=thresholds,
+      data_size=10,
+      max_num_epochs=1,
+      testing=True,
+    )
+    ll_model_loader = get_ll_model_loader(
+      case,
+      natural=False,
+      tracr=True,
+      interp_bench=False,
+      siit_weights=None,
+      load_from_wandb=False
+    )
+    results = ACDCRunner(case, config=config).run_thresholds_using_model_loader(ll_model_loader)
+    assert sorted(results.keys()) == sorted(thresholds)
+
+    # each threshold keeps its own results
+    for threshold in thresholds:
+      output_dir = f"{config.output_dir}/acdc/{case.get_name()}/{ll_model_loader.get_output_suffix()}"
+      assert os.path.exists(f"{output_dir}/threshold_{threshold}/result.pkl")
+
+    # and gives the same circuit as running ACDC with only that threshold
+    for threshold in thresholds:
+      single_config = ACDCConfig(threshold=threshold, data_size=10, max_num_epochs=1, testing=True)
+      circuit, _ = ACDCRunner(case, config=single_config).run_using_model_loader(ll_model_loader)
+      assert set(results[threshold][0].edges) == set(circuit.edges)
+
+  def test_acdc_roc_on_tracr_model_for_case_3(self):
+    case = Case3()
+    thresholds = [0.1, 0.001, 0.01]
+    config = ACDCConfig(thresholds=thresholds, data_size=10, max_num_epochs=1, testing=True, roc=True)
+    ll_model_loader = get_ll_model_loader(
+      case,
+      natural=False,
+      tracr=True,
+      interp_bench=False,
+      siit_weights=None,
+      load_from_wandb=False
+    )
+    result = ACDCRunner(case, config=config).run_roc_using_model_loader(ll_model_loader)
+
+    # one point per distinct score: the thresholds that pruned some edge, the edges never pruned, and all the edges
+    assert 2 <= len(result) <= len(thresholds) + 2
+    assert (result.edge_counts[1:] >= result.edge_counts[:-1]).all()
+    output_dir = f"{config.output_dir}/acdc/{case.get_name()}/{ll_model_loader.get_output_suffix()}"
+    assert os.path.exists(f"{output_dir}/roc/roc.csv")
+
   def test_acdc_works_on_interp_bench_model_for_case_3(self):
     case = Case3()
     config = ACDCConfig(
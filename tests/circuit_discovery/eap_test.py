@@ -1,6 +1,7 @@
 import os
 
 import pytest
+import torch as t
 
 from circuits_benchmark.benchmark.cases.case_3 import Case3
 from circuits_benchmark.benchmark.cases.case_37 import Case37
@@ -8,6 +9,9 @@ from circuits_benchmark.benchmark.cases.case_ioi import CaseIOI
 from circuits_benchmark.commands.algorithms.eap import EAPRunner, EAPConfig
 from circuits_benchmark.commands.build_main_parser import build_main_parser
 from circuits_benchmark.commands.train import train
+from circuits_benchmark.utils.auto_circuit_utils import estimate_memory_per_sample, get_batch_size, \
+  get_integrated_grad_steps_per_pass, build_circuit, get_prune_scores_threshold
+from circuits_benchmark.utils.circuit.circuit_node import CircuitNode
 from circuits_benchmark.utils.ll_model_loader.ll_model_loader_factory import get_ll_model_loader
 from circuits_benchmark.utils.project_paths import get_default_output_dir
 
@@ -99,6 +103,137 @@ class TestEAP:
     assert circuit is not None
     assert circuit_eval_result is not None
 
+  def test_eap_roc_on_tracr_model_for_case_3(self):
+    case = Case3()
+    config = EAPConfig(
+      data_size=10,
+      roc=True,
+    )
+    ll_model_loader = get_ll_model_loader(
+      case,
+      natural=False,
+      tracr=True,
+      interp_bench=False,
+      siit_weights=None,
+      load_from_wandb=False
+    )
+    roc = EAPRunner(case, config=config).run_roc_using_model_loader(ll_model_loader)
+    assert len(roc) > 1
+    assert roc.edge_counts[0] == 0
+    assert 0 <= roc.edges_auc <= 1
+
+  def test_eap_circuits_from_stored_scores_match_computed_ones(self):
+    case = Case3()
+    ll_model_loader = get_ll_model_loader(
+      case,
+      natural=False,
+      tracr=True,
+      interp_bench=False,
+      siit_weights=None,
+      load_from_wandb=False
+    )
+    circuit, _ = EAPRunner(case, config=EAPConfig(edge_count=5, data_size=10)).run_using_model_loader(ll_model_loader)
+
+    # the scores stored by the previous run are used for any number of circuits
+    config = EAPConfig(edge_counts=[5, 10], thresholds=[0.001], data_size=10, from_scores=True)
+    circuits = EAPRunner(case, config=config).run_circuits_using_model_loader(ll_model_loader)
+    assert sorted(circuits.keys()) == ["edge_count_10", "edge_count_5", "threshold_0.001"]
+    assert set(circuits["edge_count_5"][0].edges) == set(circuit.edges)
+    assert set(circuits["edge_count_5"][0].edges).issubset(circuits["edge_count_10"][0].edges)
+
+  @pytest.mark.parametrize("case", [Case3(), Case37()])
+  def test_eap_scores_of_mini_batches_match_single_batch(self, case):
+    ll_model_loader = get_ll_model_loader(
+      case,
+      natural=False,
+      tracr=False,
+      interp_bench=True,
+      siit_weights=None,
+      load_from_wandb=False
+    )
+
+    attribution_scores = {}
+    for batch_size in [None, 3]:
+      runner = EAPRunner(case, config=EAPConfig(edge_count=5, data_size=10, batch_size=batch_size))
+      _, ll_model = runner.load_ll_model_and_correspondence(ll_model_loader)
+      _, attribution_scores[batch_size] = runner.compute_attribution_scores(ll_model, *runner.prepare_data())
+
+    for name, scores in attribution_scores[None].items():
+      t.testing.assert_close(attribution_scores[3][name], scores, rtol=1e-4, atol=1e-6)
+
+  @pytest.mark.parametrize("case", [Case3(), Case37()])
+  def test_batched_integrated_grad_steps_match_one_pass_per_step(self, case):
+    ll_model_loader = get_ll_model_loader(
+      case,
+      natural=False,
+      tracr=False,
+      interp_bench=True,
+      siit_weights=None,
+      load_from_wandb=False
+    )
+    _, ll_model = ll_model_loader.load_ll_model_and_correspondence(device="cpu")
+    memory_per_sample = estimate_memory_per_sample(ll_model.cfg, case.get_max_seq_len())
+
+    attribution_scores = {}
+    # 10 samples and a budget of 20 samples gives 2 steps per pass, i.e., 3 passes for the 5 steps (mask values 0 to 1)
+    for batched, max_memory in [(False, None), (True, None), (True, 20 * memory_per_sample / 1024 ** 3)]:
+      config = EAPConfig(edge_count=5, data_size=10, integrated_grad_steps=4, batch_integrated_grad_steps=batched,
+                         max_memory=max_memory)
+      runner = EAPRunner(case, config=config)
+      _, ll_model = runner.load_ll_model_and_correspondence(ll_model_loader)
+      _, attribution_scores[(batched, max_memory)] = runner.compute_attribution_scores(ll_model,
+                                                                                      *runner.prepare_data())
+
+    unbatched_scores = attribution_scores.pop((False, None))
+    for batched_scores in attribution_scores.values():
+      for name, scores in unbatched_scores.items():
+        t.testing.assert_close(batched_scores[name], scores, rtol=1e-4, atol=1e-6)
+
+  def test_build_circuit_keeps_edges_with_greater_scores(self):
+    case = Case3()
+    ll_model_loader = get_ll_model_loader(
+      case,
+      natural=False,
+      tracr=True,
+      interp_bench=False,
+      siit_weights=None,
+      load_from_wandb=False
+    )
+    runner = EAPRunner(case, config=EAPConfig(edge_count=5, data_size=10))
+    _, ll_model = runner.load_ll_model_and_correspondence(ll_model_loader)
+    auto_circuit_model, attribution_scores = runner.compute_attribution_scores(ll_model, *runner.prepare_data())
+
+    threshold = get_prune_scores_threshold(attribution_scores, 5)
+    circuit = build_circuit(auto_circuit_model, attribution_scores, threshold, abs_val_threshold=True)
+
+    for edge in auto_circuit_model.edges:
+      circuit_edge = (CircuitNode(edge.src.module_name, edge.src.head_idx),
+                      CircuitNode(edge.dest.module_name, edge.dest.head_idx))
+      score = abs(attribution_scores[edge.dest.module_name][edge.patch_idx].item())
+      assert (score > threshold) == (circuit_edge in circuit.edges)
+
+  def test_batch_size_fits_max_memory(self):
+    _, ll_model = get_ll_model_loader(
+      Case3(),
+      natural=False,
+      tracr=True,
+      interp_bench=False,
+      siit_weights=None,
+      load_from_wandb=False
+    ).load_ll_model_and_correspondence(device="cpu")
+    seq_len = Case3().get_max_seq_len()
+    memory_per_sample = estimate_memory_per_sample(ll_model.cfg, seq_len)
+
+    assert get_batch_size(ll_model.cfg, seq_len, 1000) == 1000
+    assert get_batch_size(ll_model.cfg, seq_len, 1000, batch_size=64, max_memory=1e-9) == 64
+    assert get_batch_size(ll_model.cfg, seq_len, 1000, max_memory=10 * memory_per_sample / 1024 ** 3) == 10
+    assert get_batch_size(ll_model.cfg, seq_len, 1000, max_memory=1e-12) == 1
+
+    assert get_integrated_grad_steps_per_pass(ll_model.cfg, seq_len, 10, 49) == 50
+    assert get_integrated_grad_steps_per_pass(ll_model.cfg, seq_len, 10, 49,
+                                              max_memory=25 * memory_per_sample / 1024 ** 3) == 2
+    assert get_integrated_grad_steps_per_pass(ll_model.cfg, seq_len, 10, 49, max_memory=1e-12) == 1
+
   @pytest.mark.parametrize("loss_fn", ["mae", "mse"])
   def test_eap_works_on_interp_bench_model_for_case_3(self, loss_fn):
     case = Case3()
@@ -1,8 +1,22 @@
+import pickle
+import random
 import unittest
+from unittest import mock
+
+import networkx as nx
+import numpy as np
 
 from circuits_benchmark.benchmark.cases.case_16 import Case16
 from circuits_benchmark.benchmark.cases.case_3 import Case3
+from circuits_benchmark.benchmark.tracr_build_cache import TracrBuildArtifact
 from circuits_benchmark.transformers.tracr_circuits_builder import build_tracr_circuits
+from circuits_benchmark.utils.circuit.circuit import Circuit
+from circuits_benchmark.utils.circuit.circuit_eval import get_full_circuit, calculate_fpr_and_tpr
+from circuits_benchmark.utils.circuit.circuit_node import CircuitNode
+from circuits_benchmark.utils.circuit.circuit_roc import calculate_roc
+from circuits_benchmark.utils.circuit import prepare_circuit
+from circuits_benchmark.utils.circuit.compact_circuit import CircuitTopology, CompactCircuit
+from circuits_benchmark.utils.circuit.prepare_circuit import prepare_circuit_for_evaluation
 
 
 class CircuitTest(unittest.TestCase):
@@ -159,3 +173,138 @@ class CircuitTest(unittest.TestCase):
     tracr_circuits = build_tracr_circuits(tacr_output.graph, tacr_output.craft_model, granularity="acdc_hooks")
     for k, v in tracr_circuits.alignment.hl_to_ll_mapping.items():
       self.assertIsInstance(k, str)
+
+  def test_circuits_built_from_cached_tracr_build_match_tracr_output(self):
+    case = Case3()
+    tracr_output = case.get_tracr_output()
+    artifact = pickle.loads(pickle.dumps(TracrBuildArtifact.from_tracr_output(tracr_output)))
+
+    for granularity in ["component", "matrix", "acdc_hooks"]:
+      expected = build_tracr_circuits(tracr_output.graph, tracr_output.craft_model, granularity=granularity)
+      actual = build_tracr_circuits(artifact.graph, artifact.craft_model, granularity=granularity)
+      self.assertEqual(sorted(map(str, actual.tracr_transformer_circuit.nodes)),
+                       sorted(map(str, expected.tracr_transformer_circuit.nodes)))
+      self.assertEqual(sorted((str(u), str(v)) for u, v in actual.tracr_transformer_circuit.edges),
+                       sorted((str(u), str(v)) for u, v in expected.tracr_transformer_circuit.edges))
+
+  def test_compact_circuits_match_set_operations(self):
+    full_circuit = prepare_circuit_for_evaluation(get_full_circuit(n_layers=2, n_heads=2))
+    topology = CircuitTopology(full_circuit)
+    edges = list(full_circuit.edges)
+
+    random.seed(42)
+    for _ in range(10):
+      hypothesis_circuit = Circuit()
+      hypothesis_circuit.add_edges_from(random.sample(edges, 10))
+      true_circuit = Circuit()
+      true_circuit.add_edges_from(random.sample(edges, 12))
+
+      hypothesis, true = topology.compact(hypothesis_circuit), topology.compact(true_circuit)
+
+      # lossless conversion
+      circuit = hypothesis.to_circuit()
+      self.assertEqual(set(circuit.nodes), set(hypothesis_circuit.nodes))
+      self.assertEqual(set(circuit.edges), set(hypothesis_circuit.edges))
+      self.assertEqual(CompactCircuit.from_edge_mask(topology, hypothesis.edge_mask), hypothesis)
+
+      self.assertEqual(set((hypothesis & true).get_edges()), set(hypothesis_circuit.edges) & set(true_circuit.edges))
+      self.assertEqual(set((hypothesis | true).get_nodes()), set(hypothesis_circuit.nodes) | set(true_circuit.nodes))
+      self.assertEqual(set((hypothesis - true).get_edges()), set(hypothesis_circuit.edges) - set(true_circuit.edges))
+
+      result = calculate_fpr_and_tpr(hypothesis_circuit, true_circuit, full_circuit, print_summary=False)
+      true_edges, hypothesis_edges = set(true_circuit.edges), set(hypothesis_circuit.edges)
+      self.assertEqual(result.edges.true_positive, hypothesis_edges & true_edges)
+      self.assertEqual(result.edges.false_negative, true_edges - hypothesis_edges)
+      self.assertEqual(result.edges.tpr, len(hypothesis_edges & true_edges) / len(true_edges))
+      self.assertEqual(result.edges.fpr, len(hypothesis_edges - true_edges) / (len(edges) - len(true_edges)))
+
+  def test_circuit_nodes_are_interned(self):
+    node = CircuitNode("blocks.0.attn.hook_result", 1)
+    self.assertIs(CircuitNode("blocks.0.attn.hook_result", 1), node)
+    self.assertIs(pickle.loads(pickle.dumps(node)), node)
+    self.assertIsNot(CircuitNode("blocks.0.attn.hook_result"), node)
+
+    with self.assertRaises(AttributeError):
+      node.index = 2
+
+    # nodes of the full circuit are the same objects as the nodes built by callers
+    full_circuit = get_full_circuit(n_layers=1, n_heads=2)
+    self.assertTrue(any(full_node is node for full_node in full_circuit.nodes))
+
+    # nodes with an index go before the node with the same name and no index
+    self.assertEqual(sorted([CircuitNode("b"), CircuitNode("a"), CircuitNode("a", 2), CircuitNode("a", 1)]),
+                     [CircuitNode("a", 1), CircuitNode("a", 2), CircuitNode("a"), CircuitNode("b")])
+
+  def test_full_circuit_is_cached_and_frozen(self):
+    full_circuit = get_full_circuit(n_layers=2, n_heads=2)
+    self.assertIs(get_full_circuit(n_layers=2, n_heads=2), full_circuit)
+    self.assertEqual(len(full_circuit.nodes), 2 + 2 * (2 * 7 + 2) + 1)
+
+    with self.assertRaises(nx.NetworkXError):
+      full_circuit.add_node(CircuitNode("blocks.2.hook_mlp_in"))
+
+    circuit = full_circuit.copy()
+    circuit.add_node(CircuitNode("blocks.2.hook_mlp_in"))
+    self.assertNotIn(CircuitNode("blocks.2.hook_mlp_in"), full_circuit.nodes)
+
+    without_pos_embed = get_full_circuit(n_layers=2, n_heads=2, use_pos_embed=False)
+    self.assertEqual(set(without_pos_embed.nodes), set(full_circuit.nodes) - {CircuitNode("hook_pos_embed")})
+
+  def test_prepare_full_circuit_of_ioi_sized_model(self):
+    # same number of layers and heads as gpt2, used by the IOI case
+    full_circuit = get_full_circuit(n_layers=12, n_heads=12)
+
+    # the leaf and parent nodes are computed once for the whole circuit, instead of once per edge
+    with mock.patch.object(prepare_circuit, "is_ignorable_resid_edge",
+                           wraps=prepare_circuit.is_ignorable_resid_edge) as is_ignorable_resid_edge:
+      prepared_circuit = prepare_circuit_for_evaluation(full_circuit)
+    self.assertGreater(is_ignorable_resid_edge.call_count, 0)
+    self.assertLessEqual(is_ignorable_resid_edge.call_count, len(full_circuit.edges))
+    for call in is_ignorable_resid_edge.call_args_list:
+      self.assertIsNotNone(call.args[3])
+      self.assertIsNotNone(call.args[4])
+    leaf_nodes = {id(call.args[3]) for call in is_ignorable_resid_edge.call_args_list}
+    parent_nodes = {id(call.args[4]) for call in is_ignorable_resid_edge.call_args_list}
+    self.assertEqual((len(leaf_nodes), len(parent_nodes)), (1, 1))
+
+    # prepared circuits of frozen circuits are cached, and preparing them again does not change them
+    self.assertIs(prepare_circuit_for_evaluation(full_circuit), prepared_circuit)
+    self.assertTrue(nx.is_frozen(prepared_circuit))
+    reprepared_circuit = prepare_circuit_for_evaluation(prepared_circuit.copy())
+    self.assertEqual(set(reprepared_circuit.edges), set(prepared_circuit.edges))
+    self.assertIs(CircuitTopology.for_circuit(prepared_circuit), CircuitTopology.for_circuit(prepared_circuit))
+
+  def test_roc_matches_evaluation_of_each_threshold(self):
+    n_layers, n_heads = 2, 2
+
+    # edges with the same nodes as the ones of auto_circuit's patchable models
+    scored_edges = []
+    sources = [CircuitNode("blocks.0.hook_resid_pre")]
+    for layer in range(n_layers):
+      qkv_inputs = [CircuitNode(f"blocks.{layer}.hook_{qkv}_input", head) for qkv in "qkv" for head in range(n_heads)]
+      scored_edges += [(source, qkv_input) for source in sources for qkv_input in qkv_inputs]
+      sources += [CircuitNode(f"blocks.{layer}.attn.hook_result", head) for head in range(n_heads)]
+      scored_edges += [(source, CircuitNode(f"blocks.{layer}.hook_mlp_in")) for source in sources]
+      sources += [CircuitNode(f"blocks.{layer}.hook_mlp_out")]
+    scored_edges += [(source, CircuitNode(f"blocks.{n_layers - 1}.hook_resid_post")) for source in sources]
+
+    full_circuit = get_full_circuit(n_layers, n_heads)
+    true_circuit = Circuit()
+    true_circuit.add_edges_from(random.Random(0).sample(sorted(full_circuit.edges), 15))
+    # rounded, so that some edges have the same score
+    scores = np.round(np.random.default_rng(0).normal(size=len(scored_edges)), 1)
+
+    roc = calculate_roc(scored_edges, scores, true_circuit, full_circuit)
+    self.assertEqual(roc.edge_counts[0], 0)
+    self.assertEqual(roc.edge_counts[-1], len(scored_edges))
+    self.assertTrue(0 <= roc.nodes_auc <= 1 and 0 <= roc.edges_auc <= 1)
+
+    for i, threshold in enumerate(roc.thresholds):
+      circuit = Circuit()
+      circuit.add_edges_from([edge for edge, score in zip(scored_edges, scores) if score > threshold])
+      result = calculate_fpr_and_tpr(circuit, true_circuit, full_circuit, print_summary=False)
+
+      self.assertEqual(roc.nodes_tpr[i], result.nodes.tpr)
+      self.assertEqual(roc.nodes_fpr[i], result.nodes.fpr)
+      self.assertEqual(roc.edges_tpr[i], result.edges.tpr)
+      self.assertEqual(roc.edges_fpr[i], result.edges.fpr)
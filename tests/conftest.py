@@ -0,0 +1,15 @@
+import pytest
+
+from circuits_benchmark.benchmark import dataset_cache, tracr_build_cache
+from circuits_benchmark.utils import case_registry
+from circuits_benchmark.utils.iit import hl_lookup_table
+
+
+@pytest.fixture(autouse=True)
+def caches_in_tmp_dir(tmp_path, monkeypatch):
+  """Keeps the datasets, Tracr builds, HL lookup tables and case registry written by the tests out of the results
+  directory."""
+  monkeypatch.setattr(dataset_cache, "default_dataset_cache_dir", str(tmp_path / "datasets_cache"))
+  monkeypatch.setattr(tracr_build_cache, "default_tracr_build_cache_dir", str(tmp_path / "tracr_build_cache"))
+  monkeypatch.setattr(hl_lookup_table, "default_hl_lookup_table_cache_dir", str(tmp_path / "hl_lookup_tables"))
+  monkeypatch.setattr(case_registry, "default_case_registry_path", str(tmp_path / "case_registry.json"))
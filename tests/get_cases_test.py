@@ -1,6 +1,10 @@
+import os
+import tempfile
 import unittest
 
 from circuits_benchmark.utils.attr_dict import AttrDict
+from circuits_benchmark.utils.case_registry import get_case_registry, get_case_class_locations, \
+  update_case_registry, load_case_registry, get_case_metadata, find_class_bases, get_case_class_names
 from circuits_benchmark.utils.get_cases import get_cases
 
 
@@ -24,4 +28,38 @@ class GetCasesTest(unittest.TestCase):
   def test_get_cases_works_for_ioi_cases(self):
     args = AttrDict({"indices": "ioi,ioi_next_token"})
     cases = get_cases(args)
-    self.assertEqual(len(cases), 2)
\ No newline at end of file
+    self.assertEqual(len(cases), 2)
+
+  def test_case_registry_maps_names_to_classes_without_importing_them(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      registry_path = os.path.join(tmp_dir, "case_registry.json")
+      registry = get_case_registry(registry_path)
+      locations = get_case_class_locations(registry)
+
+      self.assertEqual(locations["3"], ("circuits_benchmark.benchmark.cases.case_3", "Case3"))
+      self.assertEqual(locations["ioi_next_token"][1], "CaseIOI_Next_Token")
+
+      # a second load finds the registry up to date
+      self.assertFalse(update_case_registry(load_case_registry(registry_path)))
+
+      metadata = get_case_metadata("3", registry_path)
+      self.assertEqual(metadata["max_seq_len"], 5)
+      self.assertEqual(metadata["total_data_len"], 320)
+      self.assertEqual(get_case_registry(registry_path)["files"]["case_3.py"]["metadata"]["Case3"], metadata)
+
+  def test_case_registry_only_registers_benchmark_case_subclasses(self):
+    source = b"""
+class CaseHelper:
+  pass
+
+class CaseParent(TracrBenchmarkCase):
+  pass
+
+class CaseChild(CaseParent):
+  pass
+
+class CaseOther(benchmark_case.BenchmarkCase):
+  pass
+"""
+    registry = {"files": {"case_x.py": {"module": "case_x", "classes": find_class_bases(source)}}}
+    self.assertEqual(get_case_class_names(registry), {"CaseParent", "CaseChild", "CaseOther"})
@@ -1,6 +1,7 @@
 import unittest
 from typing import List
 
+import numpy as np
 import pytest
 
 from circuits_benchmark.benchmark.cases.case_1 import Case1
@@ -17,11 +18,82 @@ class TestGetCleanData:
     assert len(data.get_inputs()) == expected_total_data_len
     assert case.get_total_data_len() == expected_total_data_len
 
+  def test_gen_all_data_enumerates_every_sequence_once(self):
+    case = Case3()
+    input_data, output_data = case.gen_all_data(case.get_min_seq_len(), case.get_max_seq_len())
+
+    assert len(input_data) == case.get_total_data_len()
+    assert len(set(tuple(i) for i in input_data)) == len(input_data)
+    assert all(i[0] == "BOS" and o[0] == "BOS" for i, o in zip(input_data, output_data))
+
+    # shorter sequences come first, padded to max_seq_len
+    assert input_data[0] == ["BOS", "a", "a", "a", "PAD"]
+    assert input_data[-1] == ["BOS", "x", "x", "x", "x"]
+    assert output_data[0][-1] == "PAD"
+
   def test_get_partial_clean_data(self):
     case = Case3()
     data = case.get_clean_data(max_samples=10, variable_length_seqs=True)
     assert len(data.get_inputs()) == 10
 
+  def test_get_unique_clean_data(self):
+    case = Case3()
+    data = case.get_clean_data(max_samples=200, unique_data=True, variable_length_seqs=True, encoded_dataset=False,
+                               use_cache=False)
+
+    assert len(data.get_inputs()) == 200
+    assert len(set(tuple(i) for i in data.get_inputs())) == 200
+
+  def test_sample_unique_indices(self):
+    # dense_threshold=0 forces Floyd's algorithm
+    for dense_threshold in [2 ** 24, 0]:
+      indices = Case3.sample_unique_indices(1000, 300, dense_threshold=dense_threshold)
+      assert len(indices) == len(set(indices.tolist())) == 300
+      assert 0 <= indices.min() and indices.max() < 1000
+
+  def test_decode_input_ids_matches_enumeration(self):
+    case = Case3()
+    min_seq_len, max_seq_len = case.get_min_seq_len(), case.get_max_seq_len()
+    all_ids = case.gen_all_input_ids(min_seq_len, max_seq_len)
+
+    indices = np.array([0, 5, 63, 64, len(all_ids) - 1])
+    assert np.array_equal(case.decode_input_ids(indices, min_seq_len, max_seq_len), all_ids[indices])
+
+  def test_input_ids_of_enumerations_larger_than_int64(self):
+    case = Case3()
+    base = len(case.get_vocab())
+    max_seq_len = 2
+    while case.get_total_input_ids(2, max_seq_len) <= np.iinfo(np.int64).max:
+      max_seq_len += 1
+    total = case.get_total_input_ids(2, max_seq_len)
+
+    indices = Case3.sample_unique_indices(total, 100, dense_threshold=0)
+    assert len(set(indices.tolist())) == 100
+    assert 0 <= min(indices.tolist()) and max(indices.tolist()) < total
+
+    last_ids = case.decode_input_ids(np.array([total - 1], dtype=object), 2, max_seq_len)
+    assert last_ids.tolist() == [[base] + [base - 1] * (max_seq_len - 1)]
+
+  def test_parallel_labelling_matches_single_process_labelling(self):
+    case = Case3()
+    data = case.get_clean_data(max_samples=100, variable_length_seqs=True, encoded_dataset=False)
+    parallel_data = case.get_clean_data(max_samples=100, variable_length_seqs=True, encoded_dataset=False,
+                                        num_workers=2)
+
+    assert parallel_data.get_inputs() == data.get_inputs()
+    assert parallel_data.get_targets() == data.get_targets()
+
+  @pytest.mark.parametrize("case", [Case3(), Case27()])
+  def test_hl_model_labelling_matches_rasp_labelling(self, case):
+    rasp_data = case.get_clean_data(max_samples=50, variable_length_seqs=True, encoded_dataset=False)
+    hl_data = case.get_clean_data(max_samples=50, variable_length_seqs=True, encoded_dataset=False,
+                                  labelling_mode="hl_model")
+
+    assert rasp_data.get_inputs() == hl_data.get_inputs()
+    for hl_output, rasp_output in zip(hl_data.get_targets(), rasp_data.get_targets()):
+      assert hl_output[0] == rasp_output[0]
+      assert case.outputs_match(hl_output[1:], rasp_output[1:])
+
   def test_case_1_should_have_balanced_inputs(self):
     case = Case1()
     data = case.get_clean_data(max_samples=100, encoded_dataset=False)
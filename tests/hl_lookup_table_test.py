@@ -0,0 +1,60 @@
+import os
+
+import pytest
+import torch as t
+
+from circuits_benchmark.benchmark.cases.case_3 import Case3
+from circuits_benchmark.commands.build_main_parser import build_main_parser
+from circuits_benchmark.commands.train.iit.iit_train import run_iit_train
+from circuits_benchmark.utils.iit.hl_lookup_table import make_lookup_table_iit_hl_model, LookupTableIITHLModel
+from circuits_benchmark.utils.iit.iit_hl_model import IITHLModel
+
+
+class TestHLLookupTable:
+  def test_lookup_table_hl_model_matches_hl_model(self):
+    case = Case3()
+    hl_model = case.get_hl_model(device="cpu", compact=True)
+    hook_names = sorted({hl_node.name for hl_node in case.get_correspondence().keys()})
+
+    iit_hl_model = IITHLModel(hl_model)
+    table_hl_model = make_lookup_table_iit_hl_model(case, hl_model, hook_names, use_cache=False)
+    assert isinstance(table_hl_model, LookupTableIITHLModel)
+
+    base = case.get_clean_data(max_samples=50, seed=1, use_cache=False).get_inputs().cpu()
+    source = case.get_clean_data(max_samples=50, seed=2, use_cache=False).get_inputs().cpu()
+
+    assert t.equal(table_hl_model((base, None)), iit_hl_model((base, None)))
+
+    table_output, table_cache = table_hl_model.run_with_cache((source, None))
+    output, cache = iit_hl_model.run_with_cache((source, None))
+    assert t.equal(table_output, output)
+    for name in hook_names:
+      assert t.allclose(table_cache[name], cache[name])
+
+    # interchange interventions: patch the activations of the source into the base
+    for name in hook_names:
+      def interchange_hook(activation, hook):
+        return cache[hook.name]
+
+      assert t.equal(table_hl_model.run_with_hooks((base, None), fwd_hooks=[(name, interchange_hook)]),
+                     iit_hl_model.run_with_hooks((base, None), fwd_hooks=[(name, interchange_hook)]))
+
+  def test_lookup_table_is_skipped_for_large_input_spaces(self):
+    case = Case3()
+    hl_model = case.get_hl_model(device="cpu")
+
+    iit_hl_model = make_lookup_table_iit_hl_model(case, hl_model, [], max_inputs=1, use_cache=False)
+    assert not isinstance(iit_hl_model, LookupTableIITHLModel)
+
+  @pytest.mark.parametrize("extra_args", [[], ["--hl-lookup-table"]])
+  def test_iit_training_runs_end_to_end(self, tmp_path, extra_args):
+    args, _ = build_main_parser().parse_known_args(["train",
+                                                    "iit",
+                                                    "-i=3",
+                                                    "--epochs=1",
+                                                    "--early-stop",
+                                                    "--num-samples=10",
+                                                    "--device=cpu",
+                                                    f"--output-dir={tmp_path}"] + extra_args)
+    run_iit_train(Case3(), args)
+    assert os.path.exists(f"{tmp_path}/ll_models/3/ll_model_510.pth")
@@ -1,12 +1,18 @@
 import logging
 import unittest
 
+import einops
 import jax
+import numpy as np
+import torch as t
 
 from circuits_benchmark.benchmark.common_programs import make_reverse
+from circuits_benchmark.benchmark.tracr_benchmark_case import TracrBenchmarkCase
 from circuits_benchmark.benchmark.vocabs import TRACR_BOS, TRACR_PAD
 from circuits_benchmark.transformers.hooked_tracr_transformer import HookedTracrTransformer
+from circuits_benchmark.utils.get_cases import get_cases
 from tracr.compiler import compiling
+from tracr.craft import vectorspace_fns
 from tracr.rasp import rasp
 
 # The default of float16 can lead to discrepancies between outputs of
@@ -39,4 +45,123 @@ class HookedTracrTransformerTest(unittest.TestCase):
     tl_output_decoded = tl_model([input], return_type="decoded")[0]
     print("TransformerLens Replicated Decoding:", tl_output_decoded)
 
-    self.assertEqual(tracr_output_decoded, tl_output_decoded)
\ No newline at end of file
+    self.assertEqual(tracr_output_decoded, tl_output_decoded)
+
+  def test_batch_encoding_and_decoding_match_tracr_encoders(self):
+    program = make_reverse(rasp.tokens)
+    tracr_output = compiling.compile_rasp_to_model(
+        program,
+        vocab={1, 2, 3},
+        max_seq_len=5,
+        compiler_bos=TRACR_BOS,
+        compiler_pad=TRACR_PAD,
+    )
+    tl_model = HookedTracrTransformer.from_tracr_model(tracr_output.model, device="cpu")
+
+    inputs = [[TRACR_BOS, 1, 2, 3, TRACR_PAD], [TRACR_BOS, 3, 3, 1, 2]]
+    tl_inputs = tl_model.map_tracr_input_to_tl_input(inputs)
+    expected_tl_inputs = [tl_model.tracr_input_encoder.encode(input) for input in inputs]
+    self.assertEqual(tl_inputs.tolist(), expected_tl_inputs)
+
+    # integer inputs are taken as token ids
+    self.assertEqual(tl_model.map_tracr_input_to_tl_input(tl_inputs.numpy()).tolist(), expected_tl_inputs)
+
+    logits = tl_model(tl_inputs)
+    expected_outputs = [[TRACR_BOS] + tl_model.tracr_output_encoder.decode(output)
+                        for output in logits.argmax(dim=-1)[:, 1:].tolist()]
+    self.assertEqual(tl_model.map_tl_output_to_tracr_output(logits), expected_outputs)
+
+    with self.assertRaises(ValueError):
+      tl_model.map_tracr_input_to_tl_input([[TRACR_BOS, 1, 2, 4, TRACR_PAD]])
+
+  def test_tracr_weights_are_loaded_bit_identical(self):
+    program = make_reverse(rasp.tokens)
+    tracr_output = compiling.compile_rasp_to_model(
+        program,
+        vocab={1, 2, 3},
+        max_seq_len=5,
+        compiler_bos=TRACR_BOS,
+        compiler_pad=TRACR_PAD,
+    )
+    tracr_model = tracr_output.model
+    tl_model = HookedTracrTransformer.from_tracr_model(tracr_model, device="cpu")
+    cfg = tl_model.cfg
+
+    def tracr_param(name, key):
+      return t.tensor(np.array(tracr_model.params[name][key]))
+
+    expected_sd = {
+      "pos_embed.W_pos": tracr_param("pos_embed", "embeddings"),
+      "embed.W_E": tracr_param("token_embed", "embeddings"),
+      "unembed.W_U": t.tensor(vectorspace_fns.project(
+        tl_model.get_tracr_model_residual_space(tracr_model),
+        tl_model.get_tracr_model_output_space(tracr_model)).matrix, dtype=cfg.dtype),
+    }
+    for l in range(cfg.n_layers):
+      for tracr_name, tl_name in [("key", "K"), ("query", "Q"), ("value", "V")]:
+        expected_sd[f"blocks.{l}.attn.W_{tl_name}"] = einops.rearrange(
+          tracr_param(f"transformer/layer_{l}/attn/{tracr_name}", "w"),
+          "d_model (n_heads d_head) -> n_heads d_model d_head", n_heads=cfg.n_heads)
+        expected_sd[f"blocks.{l}.attn.b_{tl_name}"] = einops.rearrange(
+          tracr_param(f"transformer/layer_{l}/attn/{tracr_name}", "b"),
+          "(n_heads d_head) -> n_heads d_head", n_heads=cfg.n_heads)
+      expected_sd[f"blocks.{l}.attn.W_O"] = einops.rearrange(
+        tracr_param(f"transformer/layer_{l}/attn/linear", "w"),
+        "(n_heads d_head) d_model -> n_heads d_head d_model", n_heads=cfg.n_heads)
+      expected_sd[f"blocks.{l}.attn.b_O"] = tracr_param(f"transformer/layer_{l}/attn/linear", "b")
+      expected_sd[f"blocks.{l}.mlp.W_in"] = tracr_param(f"transformer/layer_{l}/mlp/linear_1", "w")
+      expected_sd[f"blocks.{l}.mlp.b_in"] = tracr_param(f"transformer/layer_{l}/mlp/linear_1", "b")
+      expected_sd[f"blocks.{l}.mlp.W_out"] = tracr_param(f"transformer/layer_{l}/mlp/linear_2", "w")
+      expected_sd[f"blocks.{l}.mlp.b_out"] = tracr_param(f"transformer/layer_{l}/mlp/linear_2", "b")
+
+    sd = tl_model.state_dict()
+    for k, expected in expected_sd.items():
+      self.assertTrue(t.equal(sd[k], expected), k)
+
+    # the model owns its weights, even though they were loaded from views of the Tracr parameters
+    with t.no_grad():
+      tl_model.embed.W_E.add_(1)
+    self.assertTrue(t.equal(tracr_param("token_embed", "embeddings"), expected_sd["embed.W_E"]))
+
+    # weights of the wrong shape are rejected, even if they could be broadcast to the parameter
+    with self.assertRaises(ValueError):
+      tl_model.load_tracr_state_dict({"blocks.0.attn.b_O": np.zeros(1, dtype=np.float32)})
+
+  def test_compact_model_has_the_same_outputs_for_all_cases(self):
+    cases = [case for case in get_cases() if isinstance(case, TracrBenchmarkCase)]
+    max_inputs_per_case = 10_000
+
+    for case in cases:
+      hl_model = case.get_hl_model(device="cpu")
+      compact_hl_model = hl_model.compact()
+      self.assertLessEqual(compact_hl_model.cfg.d_model, hl_model.cfg.d_model)
+      self.assertEqual(len(compact_hl_model.residual_stream_labels), compact_hl_model.cfg.d_model)
+
+      # every sequence length is checked: all its inputs if they fit in its share of the cap, a sample otherwise
+      min_seq_len, max_seq_len = case.get_min_seq_len(), case.get_max_seq_len()
+      max_inputs_per_len = max_inputs_per_case // (max_seq_len - min_seq_len + 1)
+      pad_id = len(case.get_vocab()) + 1
+      np.random.seed(0)
+      input_ids = []
+      for seq_len in range(min_seq_len, max_seq_len + 1):
+        total = case.get_total_input_ids(seq_len, seq_len)
+        indices = case.sample_unique_indices(total, min(total, max_inputs_per_len))
+        ids = case.decode_input_ids(indices, seq_len, seq_len)
+        input_ids.append(np.pad(ids, ((0, 0), (0, max_seq_len - seq_len)), constant_values=pad_id))
+      inputs = hl_model.map_tracr_input_to_tl_input(case.get_input_token_table()[np.concatenate(input_ids)].tolist())
+
+      with t.no_grad():
+        logits = hl_model(inputs)
+        compact_logits = compact_hl_model(inputs)
+
+      output = hl_model.map_tl_output_to_tracr_output(logits)
+      compact_output = compact_hl_model.map_tl_output_to_tracr_output(compact_logits)
+      if hl_model.is_categorical():
+        self.assertEqual(compact_output, output, case.get_name())
+      else:
+        # the kept dimensions may be summed in a different order, so numerical outputs can differ in the last bits
+        np.testing.assert_allclose(np.array(compact_output, dtype=object)[:, 1:].astype(np.float64),
+                                   np.array(output, dtype=object)[:, 1:].astype(np.float64),
+                                   rtol=0, atol=1e-5, err_msg=case.get_name())
+
+      t.testing.assert_close(compact_logits, logits, rtol=0, atol=1e-5, msg=case.get_name())
@@ -0,0 +1,62 @@
+import subprocess
+import sys
+from typing import List, Tuple
+
+from circuits_benchmark.utils.project_paths import detect_project_root
+
+# Maximum total import time for `./main.py --help`, in seconds. A typical run takes a fraction of this, so that the
+# budget only catches regressions like importing a heavy dependency.
+MAIN_HELP_IMPORT_TIME_BUDGET = 1.0
+
+# The import time is the minimum over this many runs, so that a single slow run (e.g., on a loaded machine or with a
+# cold file cache) does not fail the test.
+MAIN_HELP_IMPORT_TIME_RUNS = 5
+
+# Dependencies that only the subcommands should import.
+HEAVY_MODULES = ["jax", "torch", "tracr", "acdc", "auto_circuit", "subnetwork_probing", "iit", "transformer_lens",
+                 "wandb", "matplotlib", "pygraphviz", "huggingface_hub"]
+
+
+def get_main_imports(*args: str) -> List[Tuple[str, int]]:
+  """Runs `./main.py` with the given arguments and -X importtime and returns the imported modules with their
+  cumulative import time (in us). Nested imports keep the indentation of the -X importtime output."""
+  result = subprocess.run([sys.executable, "-X", "importtime", "main.py", *args],
+                          cwd=detect_project_root(),
+                          capture_output=True,
+                          text=True,
+                          check=True)
+
+  imports = []
+  for line in result.stderr.splitlines():
+    if line.startswith("import time:") and "cumulative" not in line:
+      _, cumulative, module = line[len("import time:"):].split("|")
+      imports.append((module[1:], int(cumulative)))
+  return imports
+
+
+def get_imported_packages(imports: List[Tuple[str, int]]) -> set:
+  return {module.strip().split(".")[0] for module, _ in imports}
+
+
+class TestMainStartup:
+  def test_main_help_does_not_import_heavy_dependencies(self):
+    imported_packages = get_imported_packages(get_main_imports("--help"))
+
+    assert "circuits_benchmark" in imported_packages
+    assert imported_packages.isdisjoint(HEAVY_MODULES), imported_packages.intersection(HEAVY_MODULES)
+
+  def test_eap_help_does_not_import_acdc_nor_jax(self):
+    imported_packages = get_imported_packages(get_main_imports("run", "eap", "-i", "3", "--help"))
+
+    assert "circuits_benchmark" in imported_packages
+    assert "auto_circuit" in imported_packages
+    assert imported_packages.isdisjoint(["acdc", "jax"]), imported_packages.intersection(["acdc", "jax"])
+
+  def test_main_help_import_time_is_within_budget(self):
+    total_import_times = []
+    for _ in range(MAIN_HELP_IMPORT_TIME_RUNS):
+      top_level_imports = [cumulative for module, cumulative in get_main_imports("--help") if not module.startswith(" ")]
+      total_import_times.append(sum(top_level_imports) / 1e6)
+
+    assert min(total_import_times) < MAIN_HELP_IMPORT_TIME_BUDGET, \
+      f"`./main.py --help` spends at least {min(total_import_times):.2f}s importing modules"
@@ -1,7 +1,18 @@
+import gc
+import os
+import random
+
+import numpy as np
 import pytest
+import torch as t
 
 from circuits_benchmark.benchmark.cases.case_3 import Case3
 from circuits_benchmark.benchmark.cases.case_9 import Case9
+from circuits_benchmark.benchmark import common_programs, vocabs
+from circuits_benchmark.benchmark.cases import case_3
+from circuits_benchmark.benchmark.dataset_cache import get_dataset_cache_key, load_cached_dataset, \
+  save_dataset_to_cache, get_project_source_files
+from circuits_benchmark.benchmark.tracr_memmap_encoded_dataset import TracrMemmapEncodedDataset
 
 
 class TestTracrDataset:
@@ -10,3 +21,131 @@ class TestTracrDataset:
   def test_get_encoded_dataset(self, case):
     data = case.get_clean_data()
     assert len(data) == 10
+
+  @pytest.mark.parametrize("case", [Case3(), Case9()])
+  def test_dataset_cache_round_trip(self, case, tmp_path):
+    data = case.get_clean_data(max_samples=20, use_cache=False)
+
+    key = get_dataset_cache_key(case, max_samples=20, seed=42)
+    assert key != get_dataset_cache_key(case, max_samples=20, seed=43)
+    assert load_cached_dataset(key, cache_dir=str(tmp_path)) is None
+
+    save_dataset_to_cache(key, data, cache_dir=str(tmp_path))
+    cached_data = load_cached_dataset(key, cache_dir=str(tmp_path), device=t.device("cpu"))
+
+    assert t.equal(cached_data.get_inputs(), data.get_inputs().cpu())
+    assert t.equal(cached_data.get_targets(), data.get_targets().cpu())
+
+  def test_random_state_does_not_depend_on_cache_hits(self, tmp_path):
+    case = Case3()
+    assert not os.path.exists(os.path.join(str(tmp_path), "datasets_cache"))
+
+    data = case.get_clean_data(max_samples=20)
+    draws_after_miss = (np.random.rand(), random.random(), t.rand(1).item())
+    assert os.path.exists(os.path.join(str(tmp_path), "datasets_cache"))
+
+    cached_data = case.get_clean_data(max_samples=20)
+    draws_after_hit = (np.random.rand(), random.random(), t.rand(1).item())
+
+    assert t.equal(cached_data.get_inputs().cpu(), data.get_inputs().cpu())
+    assert draws_after_hit == draws_after_miss
+
+  def test_cache_keys_depend_on_the_modules_imported_by_the_case(self):
+    source_files = get_project_source_files(os.path.abspath(case_3.__file__))
+    assert os.path.abspath(common_programs.__file__) in source_files
+    assert os.path.abspath(vocabs.__file__) in source_files
+
+  @pytest.mark.parametrize("case", [Case3(), Case9()])
+  def test_memmap_encoded_dataset_matches_in_memory_dataset(self, case, tmp_path):
+    tracr_dataset = case.get_clean_data(max_samples=20, encoded_dataset=False)
+    data = tracr_dataset.get_encoded_dataset()
+    memmap_data = tracr_dataset.get_encoded_dataset(memmap_dir=str(tmp_path / "memmap"), batch_size=7)
+
+    assert len(memmap_data) == len(data)
+    assert t.equal(memmap_data.get_inputs(), data.get_inputs().cpu())
+    assert t.equal(memmap_data.get_targets(), data.get_targets().cpu())
+
+    inputs, targets = next(iter(memmap_data.make_loader(batch_size=5, device="cpu")))
+    assert t.equal(inputs, data.get_inputs()[:5].cpu())
+    assert t.equal(targets, data.get_targets()[:5].cpu())
+
+  def test_memmap_dataset_stored_concurrently_is_reused(self, tmp_path, monkeypatch):
+    tracr_dataset = Case3().get_clean_data(max_samples=20, encoded_dataset=False)
+    dirname = str(tmp_path / "cache" / "memmap")
+    data = tracr_dataset.get_encoded_dataset(memmap_dir=dirname)
+
+    # another process misses the cache before the dataset is stored, and stores it again
+    exists = TracrMemmapEncodedDataset.exists
+    missed = []
+
+    def exists_after_a_miss(memmap_dir: str) -> bool:
+      if not missed:
+        missed.append(memmap_dir)
+        return False
+      return exists(memmap_dir)
+
+    monkeypatch.setattr(TracrMemmapEncodedDataset, "exists", staticmethod(exists_after_a_miss))
+    concurrent_data = tracr_dataset.get_encoded_dataset(memmap_dir=dirname)
+
+    assert t.equal(concurrent_data.get_inputs(), data.get_inputs())
+    assert t.equal(concurrent_data.get_targets(), data.get_targets())
+    # the temporary directories are removed
+    assert os.listdir(str(tmp_path / "cache")) == ["memmap"]
+
+  def test_memmap_dataset_split_and_cleanup(self):
+    data = Case3().get_clean_data(max_samples=20, use_cache=False, memmap_dataset=True)
+    assert isinstance(data, TracrMemmapEncodedDataset)
+    dirname = data.dirname
+
+    train_data, test_data = data.split(test_size=0.2)
+    assert len(train_data) == 16 and len(test_data) == 4
+    assert t.equal(test_data.get_inputs(), data.get_inputs()[16:])
+    assert t.equal(test_data.get_targets(), data.get_targets()[16:])
+
+    # the temporary files are removed once the dataset and its splits are no longer used
+    del data, train_data, test_data
+    gc.collect()
+    assert not os.path.exists(dirname)
+
+  def test_streaming_dataset_is_deterministic(self):
+    case = Case3()
+    random_state, np_random_state = random.getstate(), np.random.get_state()
+
+    stream = case.get_streaming_clean_data(seed=7, samples_per_epoch=10, chunk_size=4, labelling_mode="rasp")
+    first_epoch = list(stream)
+    second_epoch = list(stream)
+    same_seed_epoch = list(case.get_streaming_clean_data(seed=7, samples_per_epoch=10, chunk_size=4,
+                                                         labelling_mode="rasp"))
+
+    assert len(first_epoch) == len(stream) == 10
+    assert all(t.equal(a[0], b[0]) and t.equal(a[1], b[1]) for a, b in zip(first_epoch, same_seed_epoch))
+    assert not all(t.equal(a[0], b[0]) for a, b in zip(first_epoch, second_epoch))
+
+    # generating data does not consume the global random generators
+    assert random.getstate() == random_state
+    assert np.array_equal(np.random.get_state()[1], np_random_state[1])
+
+  @pytest.mark.parametrize("case", [Case3(), Case9()])
+  def test_hl_model_is_memoized_per_device(self, case):
+    hl_model = case.get_hl_model(device="cpu")
+    assert case.get_hl_model(device=t.device("cpu")) is hl_model
+    assert case.get_hl_model(device="cpu", cached=False) is not hl_model
+    assert not any(p.requires_grad for p in hl_model.parameters())
+
+    assert case.is_categorical() == hl_model.is_categorical()
+    assert case.get_d_vocab_out() == hl_model.cfg.d_vocab_out
+    assert case.get_hl_model_cfg().d_model == hl_model.cfg.d_model
+
+  def test_streaming_dataset_labels_each_sample_once(self, monkeypatch):
+    case = Case3()
+    stream = case.get_streaming_clean_data(seed=7, samples_per_epoch=10, chunk_size=4)
+    expected_epoch = list(stream)
+
+    # the targets are produced by the HL model when encoding, so the RASP program and spot-checks are never run
+    def fail(*args, **kwargs):
+      raise AssertionError("Streaming data should not be labelled before encoding")
+    monkeypatch.setattr(case, "get_correct_outputs_for_inputs", fail)
+
+    stream.epoch = 0
+    epoch = list(stream)
+    assert all(t.equal(a[0], b[0]) and t.equal(a[1], b[1]) for a, b in zip(epoch, expected_epoch))